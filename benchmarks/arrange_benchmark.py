@@ -0,0 +1,65 @@
+"""
+edit.arrangeのエンジン比較
+合成したSpeakerComposeでoverlay(旧実装),buffer,wav逐次書き出しの時間を計測する
+bufferは旧実装と同じ44.1kHzのキャンバスと，クリップのサンプリングレートのままの出力を比較する
+
+python -m benchmarks.arrange_benchmark --n_units 2000
+"""
+import datetime
+import tempfile
+from pathlib import Path
+
+import fire
+import numpy as np
+from pydub import AudioSegment
+from srt import Subtitle
+
+from zunda_w import edit
+from zunda_w.etc.timer import Timer
+from zunda_w.srt_ops import SpeakerCompose, SpeakerUnit
+
+
+def synthetic_compose(n_units: int, frame_rate: int = 24000, seed: int = 0) -> SpeakerCompose:
+    """
+    ランダムな長さ(0.3~4秒)のノイズ音声を持つSpeakerComposeを作成
+    """
+    rng = np.random.default_rng(seed)
+    units = []
+    start = datetime.timedelta()
+    for i in range(n_units):
+        ms = int(rng.integers(300, 4000))
+        end = start + datetime.timedelta(milliseconds=ms)
+        samples = (rng.standard_normal(int(frame_rate * ms / 1000)) * 3000).astype(np.int16)
+        unit = SpeakerUnit(Subtitle(i + 1, start, end, f"line {i}"), None)
+        unit.audio = AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=2, channels=1)
+        units.append(unit)
+        start = end
+    return SpeakerCompose(tuple(units), start)
+
+
+def main(n_units: int = 500, frame_rate: int = 24000, skip_overlay: bool = False):
+    compose = synthetic_compose(n_units, frame_rate)
+    print(f"units:{n_units} duration:{compose.audio_duration}")
+    results = {}
+    if not skip_overlay:
+        with Timer() as t:
+            results["overlay"] = edit.arrange(compose, engine="overlay")
+        print(f"overlay : {t.elapsed:.3f}s")
+    with Timer() as t:
+        results["buffer"] = edit.arrange(compose, engine="buffer", base_format=edit.LEGACY_FORMAT)
+    print(f"buffer(44.1kHz) : {t.elapsed:.3f}s")
+    with Timer() as t:
+        edit.arrange(compose, engine="buffer")
+    print(f"buffer(native)  : {t.elapsed:.3f}s")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, base_format in [("wav(44.1kHz)", edit.LEGACY_FORMAT), ("wav(native)", None)]:
+            output = Path(tmp_dir).joinpath("arrange.wav")
+            with Timer() as t:
+                edit.arrange_to_wav(compose, str(output), base_format=base_format)
+            print(f"{name:<16}: {t.elapsed:.3f}s {output.stat().st_size / 1024 / 1024:.1f}MB")
+    if "overlay" in results:
+        print(f"same output: {results['overlay'].raw_data == results['buffer'].raw_data}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,58 @@
+"""
+複数のVOICEVOX engineに振り分けた場合のスループット計測
+engineごとにワーカー1つのスタブ(stub_voicevox.py)を起動し，engine数を変えて1エピソード分の行を合成する
+fail_engineを指定すると1つのengineが全て失敗し，残りのengineでやり直す
+
+python -m benchmarks.engine_pool_benchmark --n_lines 300 --engines 1,2,4
+"""
+import tempfile
+from contextlib import ExitStack
+from typing import Sequence
+
+import fire
+
+from benchmarks.stub_voicevox import stub_engine
+from zunda_w.etc.timer import Timer
+from zunda_w.voicevox import voice_vox
+from zunda_w.voicevox.pool import EnginePool
+
+
+def _lines(n_lines: int):
+    return [f"これは{i}行目のテスト用の文章です" for i in range(n_lines)]
+
+
+def main(
+        n_lines: int = 300,
+        engines: Sequence[int] = (1, 2, 4),
+        max_in_flight: int = 2,
+        batch_size: int = 8,
+        synthesis_latency: float = 0.002,
+        fail_engine: bool = False,
+):
+    contents = _lines(n_lines)
+    speakers = [3 for _ in contents]
+    base = None
+    for n_engines in engines:
+        with ExitStack() as stack:
+            stubs = [
+                stack.enter_context(
+                    stub_engine(port=0, workers=1, synthesis_latency=synthesis_latency,
+                                fail_rate=1.0 if fail_engine and i == 0 and n_engines > 1 else 0.0)
+                )
+                for i in range(n_engines)
+            ]
+            pool = stack.enter_context(
+                EnginePool([s.url for s in stubs], max_in_flight=max_in_flight, batch_size=batch_size,
+                           retry_interval=0.1)
+            )
+            with tempfile.TemporaryDirectory() as tmp_dir, Timer() as t:
+                voice_vox.text_to_speech_order(contents, speakers, tmp_dir, {}, use_cache=False, client=pool)
+            base = base or t.elapsed
+            print(
+                f"engines:{n_engines} {t.elapsed:.2f}s {n_lines / t.elapsed:.1f} lines/s "
+                f"x{base / t.elapsed:.2f}  [{pool.summary()}]"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
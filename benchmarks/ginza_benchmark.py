@@ -0,0 +1,55 @@
+"""
+GiNZAによる字幕の再分割の計測
+モデルの読み込み時間と,1行ずつnlp()した場合とnlp.pipeでまとめた場合の1行あたりの時間を分けて出力する
+
+python -m benchmarks.ginza_benchmark --n_lines 5000 --batch_size 256
+"""
+import datetime
+
+import fire
+import spacy
+from srt import Subtitle
+
+from zunda_w.etc.timer import Timer
+from zunda_w.sentence import ginza_sentence
+
+_TEXTS = [
+    "今日はポッドキャストの収録をしているんですけど、最近は音声の編集がすごく楽になってきたと思っていて",
+    "そうですね",
+    "昨日の夜に新しいマイクが届いたので試してみたんですが、思ったよりもノイズが少なくて驚きました",
+    "なるほど、それは良かったですね、ちなみにどのメーカーのものを買ったんですか",
+]
+
+
+def _subtitles(n_lines: int):
+    start = datetime.timedelta()
+    for i in range(n_lines):
+        end = start + datetime.timedelta(seconds=3)
+        yield Subtitle(i + 1, start, end, _TEXTS[i % len(_TEXTS)])
+        start = end
+
+
+def main(n_lines: int = 5000, batch_size: int = 256, n_process: int = 1, n_single: int = 500):
+    subtitles = list(_subtitles(n_lines))
+    with Timer() as t:
+        spacy.load(ginza_sentence.GINZA_MODEL)
+    print(f"model load(spacy.load)        : {t.elapsed:.2f}s")
+    with Timer() as t:
+        nlp = ginza_sentence.load_nlp()
+    print(f"model load(registry, 1st)     : {t.elapsed:.2f}s  pipes:{nlp.pipe_names}")
+    with Timer() as t:
+        ginza_sentence.load_nlp()
+    print(f"model load(registry, cached)  : {t.elapsed * 1000:.3f}ms")
+
+    with Timer() as t:
+        for sub in subtitles[:n_single]:
+            nlp(sub.content)
+    print(f"per line nlp()                : {t.elapsed / n_single * 1000:.2f}ms/line ({n_single} lines)")
+    with Timer() as t:
+        result = ginza_sentence.reconstruct_subtitles(subtitles, batch_size=batch_size, n_process=n_process)
+    print(f"nlp.pipe(batch_size={batch_size})      : {t.elapsed / n_lines * 1000:.2f}ms/line "
+          f"({n_lines} lines -> {len(result)} lines, {t.elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
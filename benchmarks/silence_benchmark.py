@@ -0,0 +1,53 @@
+"""
+無音区間検出の比較
+合成した長時間音声でpydub.silence.detect_nonsilentとsilent.detect_nonsilent(numpy)の時間を計測する
+pydubは長時間の音声では終わらないため,先頭のpydub_minutes分だけで計測して全体の時間を推定する
+
+python -m benchmarks.silence_benchmark --minutes 120
+"""
+import fire
+import numpy as np
+from pydub import AudioSegment, effects, silence
+
+from zunda_w import silent
+from zunda_w.etc.timer import Timer
+
+
+def synthetic_audio(minutes: float, frame_rate: int = 16000, seed: int = 0) -> AudioSegment:
+    rng = np.random.default_rng(seed)
+    n = int(minutes * 60 * frame_rate)
+    x = (rng.standard_normal(n) * 30).astype(np.float32)
+    t = 0
+    while t < n:
+        length, gap = int(rng.uniform(0.3, 8) * frame_rate), int(rng.uniform(0.5, 7) * frame_rate)
+        end = min(n, t + length)
+        x[t:end] += rng.standard_normal(end - t).astype(np.float32) * rng.uniform(500, 6000)
+        t += length + gap
+    return AudioSegment(np.clip(x, -32768, 32767).astype(np.int16).tobytes(),
+                        frame_rate=frame_rate, sample_width=2, channels=1)
+
+
+def main(minutes: float = 120, frame_rate: int = 16000, pydub_minutes: float = 5,
+         min_silence_len: int = 4000, seek_step: int = 10, silence_thresh_down: int = -20):
+    segment = synthetic_audio(minutes, frame_rate)
+    print(f"audio: {minutes}min {frame_rate}Hz")
+    with Timer() as t:
+        result = silent.detect_nonsilent(segment, min_silence_len, seek_step, silence_thresh_down,
+                                         gain=silent.normalize_gain(segment))
+    print(f"numpy : {t.elapsed:.2f}s ({len(result)} segments)")
+
+    if pydub_minutes > 0:
+        head = segment[: int(pydub_minutes * 60 * 1000)]
+        with Timer() as t:
+            normalized = effects.normalize(head)
+            expected = silence.detect_nonsilent(normalized, min_silence_len=min_silence_len, seek_step=seek_step,
+                                                silence_thresh=normalized.dBFS + silence_thresh_down)
+        estimate = t.elapsed * minutes / pydub_minutes
+        print(f"pydub : {t.elapsed:.2f}s for {pydub_minutes}min (estimated {estimate:.1f}s for {minutes}min)")
+        head_result = silent.detect_nonsilent(head, min_silence_len, seek_step, silence_thresh_down,
+                                              gain=silent.normalize_gain(head))
+        print(f"same result for {pydub_minutes}min: {head_result == expected}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
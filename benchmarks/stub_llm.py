@@ -0,0 +1,41 @@
+"""
+ベンチマーク,テスト用のチャットモデルのスタブ
+英単語をアルファベットの読み(エー,ビー,...)に置き換えて返す.応答までの待ち時間を指定できる
+"""
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+_LETTERS = {
+    "a": "エー", "b": "ビー", "c": "シー", "d": "ディー", "e": "イー", "f": "エフ", "g": "ジー", "h": "エイチ",
+    "i": "アイ", "j": "ジェー", "k": "ケー", "l": "エル", "m": "エム", "n": "エヌ", "o": "オー", "p": "ピー",
+    "q": "キュー", "r": "アール", "s": "エス", "t": "ティー", "u": "ユー", "v": "ブイ", "w": "ダブリュー",
+    "x": "エックス", "y": "ワイ", "z": "ゼット",
+}
+_WORD = re.compile(r"[A-Za-z]+")
+
+
+def to_kana(text: str) -> str:
+    return _WORD.sub(lambda m: "".join(_LETTERS[c] for c in m.group(0).lower()), text)
+
+
+class StubChatModel:
+    """
+    :param latency: 1リクエストの応答時間(秒)
+    """
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.n_requests = 0
+        self.inputs = []
+        self._lock = threading.Lock()
+
+    def invoke(self, messages) -> SimpleNamespace:
+        text = messages[-1].content
+        with self._lock:
+            self.n_requests += 1
+            self.inputs.append(text)
+        time.sleep(self.latency)
+        body = text.split("# Input\n", 1)[-1].rsplit("\n\n#Output", 1)[0]
+        return SimpleNamespace(content=to_kana(body))
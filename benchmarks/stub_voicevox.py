@@ -0,0 +1,173 @@
+"""
+ベンチマーク用のVOICEVOX engineのスタブ
+音声合成はせず，テキスト長に比例した待ち時間の後に無音のwavを返す
+
+python -m benchmarks.stub_voicevox --port 50021 --workers 2
+"""
+import io
+import json
+import threading
+import time
+import wave
+import zipfile
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+from urllib.parse import parse_qs, urlparse
+
+import fire
+
+FRAME_RATE = 24000
+
+
+def _silent_wav(ms: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(FRAME_RATE)
+        wav.writeframes(b"\0\0" * int(FRAME_RATE * ms / 1000))
+    return buffer.getvalue()
+
+
+class StubEngine(ThreadingHTTPServer):
+    """
+    :param workers: 同時に処理できるリクエスト数(engineのワーカー数)
+    :param query_latency: audio_query 1回の処理時間(秒)
+    :param synthesis_latency: 1文字あたりの合成時間(秒)
+    :param request_overhead: リクエスト1回ごとに掛かる固定の処理時間(秒)
+    :param multi_synthesis: /multi_synthesisを提供するか
+    :param fail_rate: 500を返す割合(0~1)
+    """
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            port: int = 50021,
+            workers: int = 1,
+            query_latency: float = 0.002,
+            synthesis_latency: float = 0.001,
+            request_overhead: float = 0.005,
+            multi_synthesis: bool = True,
+            fail_rate: float = 0.0,
+    ):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.workers = threading.Semaphore(workers)
+        self.query_latency = query_latency
+        self.synthesis_latency = synthesis_latency
+        self.request_overhead = request_overhead
+        self.multi_synthesis = multi_synthesis
+        self.fail_rate = fail_rate
+        self.n_requests = 0
+        self.imported_dict = None
+        self._count_lock = threading.Lock()
+
+    def count(self) -> int:
+        with self._count_lock:
+            self.n_requests += 1
+            return self.n_requests
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: StubEngine
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b"", content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _work(self, seconds: float):
+        with self.server.workers:
+            time.sleep(self.server.request_overhead + seconds)
+
+    def _should_fail(self) -> bool:
+        n = self.server.count()
+        return self.server.fail_rate > 0 and n % max(1, round(1 / self.server.fail_rate)) == 0
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/version":
+            self._send(200, b'"0.0.0-stub"')
+        elif path == "/openapi.json":
+            paths = {"/audio_query": {}, "/synthesis": {}}
+            if self.server.multi_synthesis:
+                paths["/multi_synthesis"] = {}
+            self._send(200, json.dumps({"paths": paths}).encode())
+        elif path == "/speakers":
+            self._send(200, json.dumps([{"name": "stub", "speaker_uuid": "0", "version": "0",
+                                         "styles": [{"id": 3, "name": "normal"}]}]).encode())
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self._should_fail():
+            self._work(0)
+            return self._send(500, b'{"detail":"stub failure"}')
+        if url.path == "/audio_query":
+            self._work(self.server.query_latency)
+            text = params.get("text", "")
+            self._send(200, json.dumps({"text": text, "speedScale": 1.0, "outputSamplingRate": FRAME_RATE}).encode())
+        elif url.path == "/synthesis":
+            text = json.loads(body).get("text", "")
+            self._work(self.server.synthesis_latency * len(text))
+            self._send(200, _silent_wav(100 * len(text)), "audio/wav")
+        elif url.path == "/multi_synthesis" and self.server.multi_synthesis:
+            queries = json.loads(body)
+            self._work(sum(self.server.synthesis_latency * len(q.get("text", "")) for q in queries))
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as archive:
+                for i, q in enumerate(queries):
+                    archive.writestr(f"{i + 1:03d}.wav", _silent_wav(100 * len(q.get("text", ""))))
+            self._send(200, buffer.getvalue(), "application/zip")
+        elif url.path == "/import_user_dict":
+            self.server.imported_dict = json.loads(body)
+            self._send(204)
+        else:
+            self._send(404)
+
+
+@contextmanager
+def stub_engine(**kwargs) -> Iterator[StubEngine]:
+    """
+    スタブを別スレッドで起動する
+    """
+    server = StubEngine(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main(
+        port: int = 50021, workers: int = 1, multi_synthesis: bool = True, use_gpu: bool = False,
+        cpu_num_threads: int = 0,
+):
+    """
+    :param use_gpu: engineと同じ引数で起動できるようにするためのもの.使わない
+    :param cpu_num_threads: 同上
+    """
+    server = StubEngine(port=port, workers=workers, multi_synthesis=multi_synthesis)
+    print(f"stub voicevox engine: {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,62 @@
+"""
+トラックの字幕の結合,並べ替え,絞り込みの比較
+SpeakerUnitのリストを並べ替える旧実装と，SubtitleTableの配列操作の時間を計測する(srtの読み込みは含まない)
+
+python -m benchmarks.subtitle_table_benchmark --n_tracks 4 --n_lines 5000
+"""
+from datetime import timedelta
+from itertools import chain
+
+import fire
+import numpy as np
+import srt
+
+from zunda_w.etc.timer import Timer
+from zunda_w.srt_ops import SpeakerUnit, units_from_table
+from zunda_w.subtitle_table import SubtitleTable
+
+
+def synthetic_tracks(n_tracks: int, n_lines: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    tracks = []
+    for track in range(n_tracks):
+        starts = np.sort(rng.integers(0, n_lines * 3000, n_lines))
+        subtitles = [
+            srt.Subtitle(i + 1, timedelta(milliseconds=int(s)), timedelta(milliseconds=int(s) + 1500),
+                         f"track{track} line{int(rng.integers(0, 1000))}", str(track))
+            for i, s in enumerate(starts)
+        ]
+        tracks.append((subtitles, [f"{track}_{i}.wav" for i in range(n_lines)]))
+    return tracks
+
+
+def main(n_tracks: int = 4, n_lines: int = 5000, repeat: int = 20):
+    tracks = synthetic_tracks(n_tracks, n_lines)
+    exclude = {f"track0 line{i}" for i in range(100)}
+    print(f"tracks:{n_tracks} lines:{n_lines}")
+
+    with Timer() as t:
+        for _ in range(repeat):
+            units = list(chain.from_iterable(
+                [SpeakerUnit(s, a) for s, a in zip(subtitles, audio_files)] for subtitles, audio_files in tracks
+            ))
+            units.sort(key=lambda u: u.subtitle.start)
+            units = list(filter(lambda u: u.subtitle.content not in exclude, units))
+    print(f"units sort+filter  : {t.elapsed / repeat * 1000:.2f}ms")
+
+    tables = [SubtitleTable.from_subtitles(s, i, a) for i, (s, a) in enumerate(tracks)]
+    with Timer() as t:
+        for _ in range(repeat):
+            table = SubtitleTable.concat(tables).sort()
+    print(f"table concat+sort  : {t.elapsed / repeat * 1000:.2f}ms")
+    with Timer() as t:
+        for _ in range(repeat):
+            merged = table.filter(table.text_mask(lambda text: text not in exclude))
+    print(f"table text filter  : {t.elapsed / repeat * 1000:.2f}ms")
+    with Timer() as t:
+        units_from_table(merged)
+    print(f"to SpeakerUnit     : {t.elapsed * 1000:.2f}ms ({len(merged)} lines)")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
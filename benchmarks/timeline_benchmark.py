@@ -0,0 +1,57 @@
+"""
+SpeakerComposeの編集,時刻の問い合わせの比較
+毎回並べ替えて全件を走査する場合と，TimelineIndexを使う場合の時間を計測する
+
+python -m benchmarks.timeline_benchmark --n_lines 10000 --n_edits 1000
+"""
+from datetime import timedelta
+
+import fire
+import numpy as np
+from srt import Subtitle
+
+from zunda_w.etc.timer import Timer
+from zunda_w.srt_ops import SpeakerCompose, SpeakerUnit
+
+
+def synthetic_units(n_lines: int, n_speakers: int = 2, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    units = []
+    start = 0
+    for i in range(n_lines):
+        start += int(rng.integers(0, 3000))
+        end = start + int(rng.integers(300, 8000))
+        s = Subtitle(i + 1, timedelta(milliseconds=start), timedelta(milliseconds=end), f"line {i}", str(i % n_speakers))
+        units.append(SpeakerUnit(s, None))
+    return units
+
+
+def main(n_lines: int = 10000, n_edits: int = 1000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    units = synthetic_units(n_lines, seed=seed)
+    duration = units[-1].subtitle.end
+    times = [timedelta(milliseconds=int(t)) for t in rng.integers(0, duration // timedelta(milliseconds=1), n_edits)]
+    targets = [int(i) for i in rng.integers(0, n_lines, n_edits)]
+    print(f"lines:{n_lines} edits:{n_edits}")
+
+    # 編集のたびに並べ替え，全件を走査する
+    with Timer() as t:
+        current = list(units)
+        for target, at in zip(targets, times):
+            unit = current[target % len(current)]
+            unit.subtitle.start, unit.subtitle.end = at, at + timedelta(seconds=1)
+            current.sort(key=lambda u: u.subtitle.start)
+            _ = [u for u in current if u.subtitle.start <= at < u.subtitle.end]
+    print(f"sort+scan : {t.elapsed:.3f}s")
+
+    units = synthetic_units(n_lines, seed=seed)
+    with Timer() as t:
+        compose = SpeakerCompose(tuple(units), duration)
+        for target, at in zip(targets, times):
+            compose.retime(compose.unit[target % len(compose.unit)], at, at + timedelta(seconds=1))
+            _ = compose.timeline.at(at)
+    print(f"timeline  : {t.elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,37 @@
+"""
+VOICEVOXへの音声合成のスループット計測
+スタブのengine(stub_voicevox.py)に対して，クライアントの設定ごとに1エピソード分の行を合成する
+
+python -m benchmarks.voicevox_benchmark --n_lines 500 --workers 2
+"""
+import tempfile
+
+import fire
+
+from benchmarks.stub_voicevox import stub_engine
+from zunda_w.etc.timer import Timer
+from zunda_w.voicevox import voice_vox
+from zunda_w.voicevox.client import VoiceVoxClient
+
+
+def _lines(n_lines: int):
+    return [f"これは{i}行目のテスト用の文章です" for i in range(n_lines)]
+
+
+def main(n_lines: int = 300, workers: int = 2, port: int = 50121):
+    contents = _lines(n_lines)
+    speakers = [3 for _ in contents]
+    settings = {
+        "serial(per line)": dict(max_in_flight=1, batch_size=1),
+        "pipelined": dict(max_in_flight=workers, batch_size=1),
+        "pipelined+multi_synthesis": dict(max_in_flight=workers, batch_size=16),
+    }
+    with stub_engine(port=port, workers=workers) as engine:
+        for name, setting in settings.items():
+            with tempfile.TemporaryDirectory() as tmp_dir, VoiceVoxClient(engine.url, **setting) as client, Timer() as t:
+                voice_vox.text_to_speech_order(contents, speakers, tmp_dir, {}, use_cache=False, client=client)
+            print(f"{name.ljust(28)}: {t.elapsed:.2f}s {n_lines / t.elapsed:.1f} lines/s  {client.stats.summary()}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,43 @@
+"""
+word2kanaのLLM呼び出しの計測
+スタブのチャットモデル(stub_llm.py)に対して,直列,並列(sentence),単語をまとめる(word)の順に変換する
+
+python -m benchmarks.word2kana_benchmark --n_lines 300 --latency 0.2
+"""
+import tempfile
+from pathlib import Path
+
+import fire
+
+from benchmarks.stub_llm import StubChatModel
+from zunda_w.etc.timer import Timer
+from zunda_w.llm.convert_word_to_kana import KanaCache, convert_sentences
+
+_TERMS = ["Python", "Rust", "GPU", "Docker", "Kubernetes", "Whisper", "VOICEVOX", "GitHub", "API", "LLM"]
+
+
+def _lines(n_lines: int):
+    return [f"今日は{_TERMS[i % len(_TERMS)]}と{_TERMS[(i * 3) % len(_TERMS)]}の話を{i}回目します" for i in range(n_lines)]
+
+
+def main(n_lines: int = 300, latency: float = 0.2, max_concurrency: int = 8):
+    texts = _lines(n_lines)
+    settings = {
+        "serial(sentence)": dict(mode="sentence", max_concurrency=1),
+        "concurrent(sentence)": dict(mode="sentence", max_concurrency=max_concurrency),
+        "packed(word)": dict(mode="word", max_concurrency=max_concurrency),
+    }
+    for name, setting in settings.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            kana_cache = KanaCache(str(Path(tmp_dir).joinpath("word2kana.sqlite")))
+            llm = StubChatModel(latency)
+            with Timer() as t:
+                convert_sentences(texts, llm, kana_cache, **setting)
+            with Timer() as t2:
+                convert_sentences(texts, llm, kana_cache, **setting)
+            kana_cache.close()
+        print(f"{name.ljust(22)}: {t.elapsed:.2f}s requests:{llm.n_requests}  cached run:{t2.elapsed * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
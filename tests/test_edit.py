@@ -0,0 +1,211 @@
+import datetime
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pydub import AudioSegment
+from srt import Subtitle
+
+from zunda_w import edit
+from zunda_w.audio import (
+    AudioFormat,
+    Resampler,
+    concatenate,
+    concatenate_to_wav,
+    memory_audio,
+    parse_wav,
+    resample,
+)
+from zunda_w.srt_ops import SpeakerCompose, SpeakerUnit
+
+
+def _compose(frame_rate: int, channels: int) -> SpeakerCompose:
+    rng = np.random.default_rng(0)
+    units = []
+    t = datetime.timedelta()
+    for i in range(20):
+        ms = int(rng.integers(100, 1500))
+        samples = (rng.standard_normal((int(frame_rate * ms / 1000), channels)) * 8000).astype(np.int16)
+        unit = SpeakerUnit(Subtitle(i, t, t + datetime.timedelta(milliseconds=ms), "a"), None)
+        if i % 5:
+            unit.audio = AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=2, channels=channels)
+        units.append(unit)
+    return SpeakerCompose(tuple(units), t)
+
+
+def test_arrange_engine_same_output(tmp_path):
+    """
+    44.1kHzのキャンバスに配置した場合,bufferエンジン,wav書き出しの結果がoverlayの結果と一致する
+    """
+    for frame_rate, channels in [(24000, 1), (48000, 1), (24000, 2)]:
+        compose = _compose(frame_rate, channels)
+        expected = edit.arrange(compose, engine="overlay")
+        assert edit.arrange(compose, engine="buffer", base_format=edit.LEGACY_FORMAT).raw_data == expected.raw_data
+
+        output = tmp_path.joinpath("arrange.wav")
+        edit.arrange_to_wav(compose, str(output), base_format=edit.LEGACY_FORMAT)
+        assert AudioSegment.from_file(output).raw_data == expected.raw_data
+
+
+def test_arrange_from_memory_audio(tmp_path):
+    """
+    メモリ上の合成音声(parse_wav)を使った配置がファイルから読んだ場合と一致する
+    """
+    compose = _compose(24000, 1)
+    for i, unit in enumerate(compose.unit):
+        if unit.has_audio:
+            unit.audio_file_path = str(tmp_path.joinpath(f"{i}.wav"))
+            unit.audio.export(unit.audio_file_path, format="wav")
+            unit.audio = None
+    expected = edit.arrange(compose, engine="overlay")
+    try:
+        for unit in compose.unit:
+            if unit.audio_file_path:
+                memory_audio.put(unit.audio_file_path, parse_wav(Path(unit.audio_file_path).read_bytes()))
+        fmt = AudioFormat(24000, 1, 2)
+        clip = memory_audio.get(compose.unit[1].audio_file_path)
+        assert clip.samples.base is not None and np.shares_memory(compose.unit[1].samples(fmt), clip.samples)
+        assert clip.to_segment().raw_data == AudioSegment.from_file(compose.unit[1].audio_file_path).raw_data
+        assert edit.arrange(compose, engine="buffer", base_format=edit.LEGACY_FORMAT).raw_data == expected.raw_data
+    finally:
+        memory_audio.clear()
+
+
+def test_arrange_native_format(tmp_path):
+    """
+    クリップのサンプリングレート,チャンネル数のまま配置し，指定した場合は最後に1回だけ変換する
+    """
+    compose = _compose(24000, 1)
+    native = edit.arrange(compose)
+    assert AudioFormat.of(native) == AudioFormat(24000, 1, 2)
+    assert len(native) == len(edit.arrange(compose, engine="overlay"))
+
+    output = tmp_path.joinpath("arrange.wav")
+    edit.arrange_to_wav(compose, str(output))
+    assert AudioSegment.from_file(output).raw_data == native.raw_data
+
+    resampled = edit.arrange(compose, frame_rate=48000)
+    expected = resample(np.frombuffer(native.raw_data, dtype=np.int16).reshape(-1, 1), 24000, 48000)
+    assert resampled.frame_rate == 48000 and resampled.raw_data == expected.tobytes()
+    edit.arrange_to_wav(compose, str(output), frame_rate=48000)
+    assert AudioSegment.from_file(output).raw_data == expected.tobytes()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_arrange_to_flac(tmp_path):
+    compose = _compose(24000, 1)
+    output = tmp_path.joinpath("arrange.flac")
+    edit.arrange_to_wav(compose, str(output))
+    assert AudioSegment.from_file(output).raw_data == edit.arrange(compose).raw_data
+
+
+def test_resampler():
+    """
+    chunkに分けて変換しても一度に変換した結果と一致し，線形補間の値になる
+    """
+    rng = np.random.default_rng(3)
+    samples = (rng.standard_normal((10007, 2)) * 8000).astype(np.int16)
+    for src, dst in [(24000, 48000), (24000, 44100), (48000, 22050), (44100, 44100)]:
+        expected = resample(samples, src, dst)
+        assert len(expected) == -(-len(samples) * dst // src)
+        resampler = Resampler(src, dst, 2, np.int16)
+        chunks = [resampler.process(samples[i: i + 999]) for i in range(0, len(samples), 999)]
+        assert np.array_equal(np.concatenate([*chunks, resampler.flush()]), expected)
+        t = np.arange(len(expected)) * src / dst
+        interp = np.interp(t, np.arange(len(samples)), samples[:, 0].astype(np.float64))
+        assert np.abs(expected[:, 0] - np.rint(interp)).max() <= 1
+
+
+def test_concatenate_to_wav(tmp_path):
+    """
+    chunkごとの変換,書き出しが各音声をAudioSegmentで1回だけ変換して結合した結果と一致する
+    """
+    rng = np.random.default_rng(1)
+    segments = []
+    for frame_rate, channels in [(24000, 1), (44100, 2), (48000, 1), (24000, 2)]:
+        samples = (rng.standard_normal((frame_rate // 3 + 17, channels)) * 8000).astype(np.int16)
+        segments.append(AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=2, channels=channels))
+    files = []
+    for i, segment in enumerate(segments[:2]):
+        files.append(str(tmp_path.joinpath(f"{i}.wav")))
+        segment.export(files[-1], format="wav")
+    expected = AudioSegment(
+        b"".join(s.set_channels(2).set_frame_rate(48000).raw_data for s in segments),
+        frame_rate=48000, sample_width=2, channels=2,
+    )
+    assert concatenate(segments).raw_data == expected.raw_data
+
+    output = tmp_path.joinpath("mix.wav")
+    clip = parse_wav(tmp_path.joinpath("1.wav").read_bytes())
+    concatenate_to_wav([files[0], clip, *segments[2:]], str(output), chunk_frames=1000)
+    mixed = AudioSegment.from_file(output)
+    assert (mixed.frame_rate, mixed.channels) == (48000, 2)
+    assert mixed.raw_data == expected.raw_data
+
+
+def _pcm(rng, frame_rate: int, channels: int, seconds: float) -> AudioSegment:
+    samples = (rng.standard_normal((int(frame_rate * seconds), channels)) * 8000).astype(np.int16)
+    return AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=2, channels=channels)
+
+
+def test_edit_from_yml(tmp_path):
+    """
+    planに従った配置がAudioSegmentのoverlay,結合の結果と一致する
+    """
+    rng = np.random.default_rng(2)
+    sounds = {
+        "intro": _pcm(rng, 24000, 2, 0.7),
+        "mic0": _pcm(rng, 48000, 1, 1.3),
+        "mic1": _pcm(rng, 48000, 1, 1.1),
+        "ending": _pcm(rng, 44100, 1, 0.9),
+    }
+    paths = {}
+    for name, sound in sounds.items():
+        paths[name] = str(tmp_path.joinpath(f"{name}.wav"))
+        sound.export(paths[name], format="wav")
+    blueprint = {
+        "mode": "editor",
+        "components": [
+            {"audio": {"path": paths["intro"]}},
+            {"audio_placeholder": {"index": 0, "var": 0}},
+            {"audio_placeholder": {"index": 0, "var": 1, "gain": -6}},
+            {"audio": {"path": paths["ending"]}},
+        ],
+    }
+    plan = edit.plan_edit([paths["mic0"], paths["mic1"]], blueprint)
+    assert plan.fmt == AudioFormat(48000, 2, 2)
+
+    def convert(sound: AudioSegment) -> AudioSegment:
+        return sound.set_channels(2).set_frame_rate(48000)
+
+    intro, mic0, mic1 = convert(sounds["intro"]), convert(sounds["mic0"]), convert(sounds["mic1"]).apply_gain(-6)
+    n_intro, n_mic = int(intro.frame_count()), int(mic0.frame_count())
+    assert [(e.offset, e.n_frames) for e in plan.entries[:3]] == [
+        (0, n_intro), (n_intro, n_mic), (n_intro, int(mic1.frame_count()))
+    ]
+    assert plan.entries[3].offset == n_intro + n_mic
+    mic1 = mic1._spawn(mic1.raw_data + b"\0" * (len(mic0.raw_data) - len(mic1.raw_data)))
+    expected = convert(sounds["intro"]).raw_data + mic0.overlay(mic1).raw_data + convert(sounds["ending"]).raw_data
+    assert plan.n_frames * 4 == len(expected)
+    assert edit.edit_from_yml([paths["mic0"], paths["mic1"]], blueprint, n_workers=2).raw_data == expected
+
+    output = tmp_path.joinpath("mix.wav")
+    edit.edit_from_yml_to_wav([paths["mic0"], paths["mic1"]], blueprint, str(output), n_workers=1)
+    assert AudioSegment.from_file(output).raw_data == expected
+
+
+def test_plan_edit_validation(tmp_path):
+    blueprint = {
+        "components": [
+            {"audio": {"path": str(tmp_path.joinpath("missing.wav"))}},
+            {"audio_placeholder": {"index": 0, "var": 0}},
+            {"audio_placeholder": {"index": 0, "var": 1}},
+        ]
+    }
+    with pytest.raises(ValueError):
+        edit.plan_edit(["a.wav"], blueprint)
+    with pytest.raises(ValueError):
+        edit.plan_edit(["a.wav", "b.wav", "c.wav"], blueprint)
+    with pytest.raises(FileNotFoundError):
+        edit.plan_edit(["a.wav", "b.wav"], blueprint)
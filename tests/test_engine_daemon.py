@@ -0,0 +1,78 @@
+import os
+import socket
+import stat
+import sys
+from pathlib import Path
+
+import pytest
+
+from benchmarks.stub_voicevox import stub_engine
+from zunda_w.voicevox.engine_daemon import EngineDaemon, LockFile, pid_alive
+
+ROOT = Path(__file__).parents[1]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _stub_exe(tmp_path: Path) -> str:
+    exe = tmp_path / "run"
+    exe.write_text(
+        f"#!{sys.executable}\n"
+        "import sys\n"
+        f"sys.path.insert(0, {str(ROOT)!r})\n"
+        "import fire\n"
+        "from benchmarks.stub_voicevox import main\n"
+        "fire.Fire(main)\n"
+    )
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+    return str(exe)
+
+
+def _fail_launch():
+    raise AssertionError("engine should not be launched")
+
+
+def test_attach_running_engine(tmp_path):
+    with stub_engine(port=0) as engine:
+        daemon = EngineDaemon(engine.server_address[1], str(tmp_path))
+        with daemon.session(_fail_launch) as url:
+            assert url == daemon.url
+            assert len(daemon.active_leases()) == 1
+        assert daemon.active_leases() == []
+        # 他で起動されたengineは停止しない
+        assert daemon.read_state() is None
+        assert not daemon.stop()
+
+
+@pytest.mark.skipif(os.name == "nt", reason="stub engine is launched by shebang")
+def test_launch_once_and_stop_when_idle(tmp_path):
+    exe = _stub_exe(tmp_path)
+    daemon = EngineDaemon(_free_port(), str(tmp_path / "state"), idle_timeout=0, watch_interval=3600)
+    try:
+        with daemon.session(exe):
+            state = daemon.read_state()
+            assert state is not None and pid_alive(state.pid) and pid_alive(state.watcher_pid)
+            # 使用中はアイドル扱いにならない
+            assert not daemon.check_idle()
+            # 2つ目のプロセス(セッション)は起動済みのengineに接続する
+            with EngineDaemon(daemon.port, daemon.state_dir).session(_fail_launch):
+                assert daemon.read_state().pid == state.pid
+        assert daemon.check_idle()
+        assert not pid_alive(state.pid)
+        assert daemon.read_state() is None
+        assert not daemon.is_ready()
+    finally:
+        daemon.stop()
+
+
+def test_stale_lock_is_removed(tmp_path):
+    lock = tmp_path / "engine.lock"
+    # 存在しないpidが保持しているlock
+    lock.write_text(str(2 ** 22 + 1))
+    with LockFile(str(lock), timeout=1):
+        assert lock.read_text() == str(os.getpid())
+    assert not lock.exists()
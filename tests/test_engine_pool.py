@@ -0,0 +1,50 @@
+from contextlib import ExitStack
+from pathlib import Path
+
+from benchmarks.stub_voicevox import stub_engine
+from zunda_w.voicevox import voice_vox
+from zunda_w.voicevox.pool import EnginePool
+
+
+def test_spread_over_engines(tmp_path):
+    contents = [f"{i}行目" for i in range(40)]
+    with ExitStack() as stack:
+        engines = [stack.enter_context(stub_engine(port=0, workers=1)) for _ in range(3)]
+        with EnginePool([e.url for e in engines], max_in_flight=2, batch_size=4) as pool:
+            results = voice_vox.text_to_speech_order(contents, [3] * len(contents), str(tmp_path), {}, client=pool)
+            assert all(n > 0 for n in pool.n_requests)
+        assert all(e.n_requests > 0 for e in engines)
+    assert all(Path(r).exists() for r in results)
+    assert len(set(results)) == len(contents)
+
+
+def test_retry_on_another_engine(tmp_path):
+    contents = [f"{i}行目" for i in range(10)]
+    with stub_engine(port=0, fail_rate=1.0) as broken, stub_engine(port=0) as engine:
+        with EnginePool([broken.url, engine.url], batch_size=1, retry_interval=0) as pool:
+            results = voice_vox.text_to_speech_order(contents, [3] * len(contents), str(tmp_path), {}, client=pool)
+            assert pool.n_requests[0] == 0
+            assert pool.n_failures[0] > 0
+            # 送信して失敗したか，枠を待つ間にbreakerが開いて送らなかった分だけやり直す
+            assert pool.stats.n_retry == pool.n_failures[0] + pool.n_skipped[0]
+    assert all(Path(r).exists() for r in results)
+
+
+def test_retry_when_engine_is_down(tmp_path):
+    with stub_engine(port=0) as down:
+        down_url = down.url
+    with stub_engine(port=0) as engine:
+        with EnginePool([down_url, engine.url], batch_size=1, retry_interval=0) as pool:
+            assert pool.audio_query("テスト", 3)["text"] == "テスト"
+            assert pool.stats.n_retry <= 1
+
+
+def test_breaker_skips_broken_engine(tmp_path):
+    contents = [f"{i}行目" for i in range(30)]
+    with stub_engine(port=0, fail_rate=1.0) as broken, stub_engine(port=0) as engine:
+        with EnginePool([broken.url, engine.url], batch_size=1) as pool:
+            voice_vox.text_to_speech_order(contents, [3] * len(contents), str(tmp_path), {}, client=pool)
+            assert pool.clients[0].breaker.is_open
+            # breakerが開いた後は枠を待っていたリクエストも送らない.開いた時点で送信中のもの(engineの枠の数まで)だけが失敗しうる
+            broken_client = pool.clients[0]
+            assert pool.n_failures[0] <= broken_client.breaker.failure_threshold + broken_client.max_in_flight
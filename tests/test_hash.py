@@ -0,0 +1,32 @@
+import hashlib
+import os
+
+from zunda_w import hash as zhash
+from zunda_w.util import file_hash
+
+
+def test_file_hash_same_as_whole_read(tmp_path):
+    path = tmp_path.joinpath("data.bin")
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    path.write_bytes(data)
+    assert file_hash(path, chunk_size=1024 * 1024) == hashlib.md5(data).hexdigest()
+    assert file_hash(path, "blake2b") == hashlib.blake2b(data).hexdigest()
+
+
+def test_file_hash_cache(tmp_path, monkeypatch):
+    path = tmp_path.joinpath("audio.wav")
+    path.write_bytes(b"a" * 1000)
+    cache = zhash.FileHashCache(str(tmp_path.joinpath(zhash.HASH_DB)))
+    expected = hashlib.md5(b"a" * 1000).hexdigest()
+    assert cache.file_hash(path) == expected
+
+    calls = []
+    monkeypatch.setattr(zhash, "file_hash", lambda *args: calls.append(args) or "recomputed")
+    # 変わっていなければ別のインスタンス(別プロセス)でも再計算しない
+    assert zhash.FileHashCache(cache.db_path).file_hash(path) == expected
+    assert calls == []
+
+    path.write_bytes(b"b" * 1000)
+    os.utime(path, ns=(0, 10 ** 9))
+    assert zhash.FileHashCache(cache.db_path).file_hash(path) == "recomputed"
+    cache.close()
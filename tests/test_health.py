@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from benchmarks.stub_voicevox import stub_engine
+from zunda_w.voicevox import health
+from zunda_w.voicevox.client import RequestRejected, VoiceVoxClient
+from zunda_w.voicevox.health import Backoff, CircuitBreaker, EngineNotReadyError
+
+
+def test_backoff_grows_with_jitter():
+    backoff = Backoff(initial=0.1, maximum=1.0, jitter=0.5)
+    for attempt, expected in enumerate([0.1, 0.2, 0.4, 0.8, 1.0, 1.0]):
+        delay = backoff.delay(attempt)
+        assert expected * 0.5 <= delay <= expected
+
+
+def test_wait_until_ready_timeout():
+    with stub_engine(port=0) as engine:
+        url = engine.url
+    start = time.perf_counter()
+    with pytest.raises(EngineNotReadyError):
+        health.wait_until_ready(url, timeout=0.5)
+    assert time.perf_counter() - start < 2.0
+
+
+def test_wait_until_ready_records_startup():
+    with stub_engine(port=0) as engine:
+        elapsed = health.wait_until_ready(engine.url, timeout=5)
+        assert health.metrics.startup[engine.url] == elapsed
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    time.sleep(0.12)
+    # half openでは1つだけ通す
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.available()
+    time.sleep(0.12)
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open and breaker.allow()
+
+
+def test_client_backoff_and_rejected():
+    with stub_engine(port=0, fail_rate=0.5) as engine:
+        with VoiceVoxClient(engine.url, retry_interval=0.01) as client:
+            assert client.audio_query("テスト", 3)["text"] == "テスト"
+            assert client.stats.n_retry == client.stats.retries["/audio_query"]
+    with stub_engine(port=0) as engine:
+        with VoiceVoxClient(engine.url) as client:
+            # 4xxはリトライしない
+            with pytest.raises(RequestRejected):
+                client._post_with_retry("/unknown", "404")
+            assert client.stats.n_requests["/unknown"] == 1
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from zunda_w.pipeline import BackgroundWriter, run_overlapped
+
+
+def _producer(n: int, seconds: float):
+    for i in range(n):
+        time.sleep(seconds)
+        yield i
+
+
+def test_run_overlapped_keeps_order_and_overlaps():
+    def work(i):
+        time.sleep(0.1)
+        return i * 2
+
+    start = time.perf_counter()
+    results = list(run_overlapped(_producer(5, 0.1), work))
+    elapsed = time.perf_counter() - start
+    assert results == [0, 2, 4, 6, 8]
+    # 直列なら1.0秒
+    assert elapsed < 0.85
+
+
+def test_run_overlapped_raises_worker_error():
+    def work(i):
+        if i == 2:
+            raise ValueError("failed")
+        return i
+
+    with pytest.raises(ValueError):
+        list(run_overlapped(_producer(4, 0.01), work))
+
+
+def test_background_writer(tmp_path):
+    written = []
+    with BackgroundWriter() as writer:
+        for i in range(20):
+            writer.submit(str(tmp_path / f"{i}.bin"), bytes([i]) * 10, written.append)
+    assert len(written) == 20
+    assert all((tmp_path / f"{i}.bin").read_bytes() == bytes([i]) * 10 for i in range(20))
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_background_writer_flush(tmp_path):
+    written = []
+    with BackgroundWriter() as writer:
+        for i in range(5):
+            writer.submit(str(tmp_path / f"{i}.bin"), bytes([i]), lambda path: (time.sleep(0.01), written.append(path)))
+        writer.flush()
+        assert len(written) == 5
+        # flushの後も続けて書き込める
+        writer.submit(str(tmp_path / "5.bin"), b"5", written.append)
+    assert len(written) == 6
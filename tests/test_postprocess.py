@@ -0,0 +1,114 @@
+import datetime
+
+import srt
+
+from zunda_w.postprocess.srt import postprocess
+from zunda_w.sentence import sentiment
+
+
+def _subtitles(n: int):
+    return [
+        srt.Subtitle(i + 1, datetime.timedelta(seconds=i), datetime.timedelta(seconds=i + 1), f"line{i}")
+        for i in range(n)
+    ]
+
+
+def test_post_process_subtitles_in_memory():
+    subtitles = _subtitles(3)
+    result = postprocess.post_process_subtitles(subtitles, ["dummy", "not_found", "dummy"])
+    assert [s.content for s in result] == [f"line{i}_Dummy_Dummy" for i in range(3)]
+    # 元の字幕は変更しない
+    assert [s.content for s in subtitles] == [f"line{i}" for i in range(3)]
+
+
+def _register(monkeypatch, name, func, **kwargs):
+    # モジュールの_stepsに残さないよう，テストの終わりに元に戻す
+    monkeypatch.setitem(postprocess._steps, name, postprocess.PostProcessStep(name, func, **kwargs))
+
+
+def test_stream_post_process_waits_only_for_document_steps(monkeypatch):
+    chunks = []
+
+    def record(subtitles, options):
+        chunks.append(len(subtitles))
+        return subtitles
+
+    _register(monkeypatch, "_test_record_stream", record, streaming=True)
+    _register(monkeypatch, "_test_record_document", record, streaming=False)
+    result = list(postprocess.stream_post_process(_subtitles(10), ["_test_record_stream", "dummy"], chunk_size=4))
+    assert chunks == [4, 4, 2]
+    assert result[-1].content == "line9_Dummy"
+    chunks.clear()
+    list(postprocess.stream_post_process(_subtitles(10), ["_test_record_document"], chunk_size=4))
+    assert chunks == [10]
+
+
+def test_post_process_file(tmp_path):
+    path = tmp_path.joinpath("a.srt")
+    path.write_text(srt.compose(_subtitles(2)), encoding="utf-8")
+    assert postprocess.post_process(str(path), ["dummy"]) == str(path)
+    assert [s.content for s in srt.parse(path.read_text(encoding="utf-8"))] == ["line0_Dummy", "line1_Dummy"]
+
+
+def test_post_process_layered(tmp_path, monkeypatch):
+    calls = []
+    config = {"suffix": "_A"}
+
+    def add_suffix(subtitles, options):
+        calls.append("suffix")
+        for s in subtitles:
+            s.content += config["suffix"]
+        return subtitles
+
+    _register(monkeypatch, "_test_suffix", add_suffix, config=lambda options: dict(config))
+    path = tmp_path.joinpath("a.srt")
+    path.write_text(srt.compose(_subtitles(2)), encoding="utf-8")
+    original = path.read_text(encoding="utf-8")
+    cache_dir = str(tmp_path.joinpath(".layers"))
+
+    def contents(file):
+        return [s.content for s in srt.parse(open(file, encoding="utf-8").read())]
+
+    result = postprocess.post_process_layered(str(path), ["_test_suffix", "dummy"], cache_dir)
+    assert contents(result) == ["line0_A_Dummy", "line1_A_Dummy"]
+    # 入力は変更しない
+    assert path.read_text(encoding="utf-8") == original
+    assert postprocess.post_process_layered(str(path), ["_test_suffix", "dummy"], cache_dir) == result
+    assert calls == ["suffix"]
+    # 前の段が同じであれば再計算しない
+    assert contents(postprocess.post_process_layered(str(path), ["_test_suffix"], cache_dir)) == ["line0_A", "line1_A"]
+    assert calls == ["suffix"]
+    # 設定が変わった段から再計算する
+    config["suffix"] = "_B"
+    assert contents(postprocess.post_process_layered(str(path), ["_test_suffix", "dummy"], cache_dir)) == [
+        "line0_B_Dummy", "line1_B_Dummy"]
+    assert calls == ["suffix", "suffix"]
+
+
+def test_emotion_backend_from_options(tmp_path, monkeypatch):
+    """
+    emotion_analysisのbackendは環境変数ではなくPostProcessOptionsで指定し，キャッシュのキーにも含める
+    """
+    backends = []
+
+    class _Classifier:
+        def classify(self, texts):
+            return ["e:joy" for _ in texts]
+
+    def get_classifier(backend="torch"):
+        backends.append(backend)
+        return _Classifier()
+
+    monkeypatch.setattr(sentiment, "get_classifier", get_classifier)
+    path = tmp_path.joinpath("a.srt")
+    path.write_text(srt.compose(_subtitles(2)), encoding="utf-8")
+    cache_dir = str(tmp_path.joinpath(".layers"))
+    onnx = postprocess.post_process_layered(
+        str(path), ["emotion_analysis"], cache_dir, postprocess.PostProcessOptions(emotion_backend="onnx")
+    )
+    assert backends == ["onnx"]
+    torch = postprocess.post_process_layered(str(path), ["emotion_analysis"], cache_dir)
+    assert torch != onnx and backends == ["onnx", "torch"]
+    monkeypatch.setenv("EMOTION_BACKEND", "onnx")
+    assert postprocess.post_process_layered(str(path), ["emotion_analysis"], cache_dir) == torch
+    assert backends == ["onnx", "torch"]
@@ -0,0 +1,35 @@
+from zunda_w.sentence import sentiment
+
+
+class _Tokenizer:
+    def __call__(self, texts, **kwargs):
+        return {"input_ids": [list(t) for t in texts]}
+
+
+def test_emotion_classifier_memoize_and_order(monkeypatch):
+    classifier = sentiment.EmotionClassifier(batch_size=2)
+    batches = []
+
+    def load():
+        classifier._tokenizer = _Tokenizer()
+
+    def predict(texts):
+        batches.append(texts)
+        return [len(t) % len(sentiment.EMOTION_INDEX) for t in texts]
+
+    monkeypatch.setattr(classifier, "_load", load)
+    monkeypatch.setattr(classifier, "_predict", predict)
+    texts = ["うん", "なるほどですね", "うん", "そうですね", "はい"]
+    expected = [sentiment.EMOTION_INDEX[len(t) % len(sentiment.EMOTION_INDEX)] for t in texts]
+    assert classifier.classify(texts) == expected
+    # 重複を除いて長さ順にバッチを作る
+    assert batches == [["うん", "はい"], ["そうですね", "なるほどですね"]]
+    assert classifier.classify(["はい", "うん"]) == [expected[4], expected[0]]
+    assert len(batches) == 2
+
+
+def test_onnx_dir_per_model():
+    a = sentiment.EmotionClassifier(model_name="org/a", backend="onnx")
+    b = sentiment.EmotionClassifier(model_name="org/b", backend="onnx")
+    assert a.onnx_dir != b.onnx_dir
+    assert a.onnx_dir.endswith("org--a")
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from pydub import AudioSegment, effects, silence
+
+from zunda_w import silent
+
+
+def _speech_like(seconds: float, frame_rate: int, channels: int, seed: int) -> AudioSegment:
+    """
+    小さなノイズの上に長さの異なる発話区間(大きなノイズ)を並べた音声
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * frame_rate)
+    x = rng.standard_normal((n, channels)) * 30
+    t = 0
+    while t < n:
+        length, gap = int(rng.uniform(0.3, 8) * frame_rate), int(rng.uniform(0.5, 7) * frame_rate)
+        x[t:t + length] += rng.standard_normal((min(length, n - t), channels)) * rng.uniform(500, 6000)
+        t += length + gap
+    return AudioSegment(np.clip(x, -32768, 32767).astype(np.int16).tobytes(),
+                        frame_rate=frame_rate, sample_width=2, channels=channels)
+
+
+@pytest.mark.parametrize("frame_rate,channels,seconds", [(16000, 1, 60), (22050, 1, 45.3), (24000, 2, 30)])
+@pytest.mark.parametrize("min_silence_len,seek_step,silence_thresh_down", [(4000, 10, -20), (1000, 7, -16)])
+def test_detect_nonsilent_same_as_pydub(frame_rate, channels, seconds, min_silence_len, seek_step,
+                                        silence_thresh_down):
+    segment = _speech_like(seconds, frame_rate, channels, seed=frame_rate)
+    normalized = effects.normalize(segment)
+    expected = silence.detect_nonsilent(
+        normalized,
+        min_silence_len=min_silence_len,
+        seek_step=seek_step,
+        silence_thresh=normalized.dBFS + silence_thresh_down,
+    )
+    result = silent.detect_nonsilent(
+        segment, min_silence_len, seek_step, silence_thresh_down, gain=silent.normalize_gain(segment)
+    )
+    assert result == expected
+
+
+def test_detect_nonsilent_silent_audio():
+    segment = AudioSegment.silent(10000, 16000)
+    assert silent.detect_nonsilent(segment, gain=silent.normalize_gain(segment)) == []
+
+
+def test_iter_nonsilent_matches_divide_by_silence():
+    segment = _speech_like(40, 16000, 1, seed=1)
+    gain = silent.normalize_gain(segment)
+    ranges = [r for r in silent.detect_nonsilent(segment, gain=gain) if r[1] - r[0] >= 500]
+    pairs = list(silent.iter_nonsilent(segment))
+    assert [(seg.start, seg.end) for seg, _ in pairs] == [tuple(r) for r in ranges]
+    for (seg, samples), (s, e) in zip(pairs, ranges):
+        expected = effects.normalize(segment[s:e].apply_gain(gain))
+        assert samples.dtype == np.float32
+        assert np.array_equal(samples, np.frombuffer(expected.raw_data, np.int16) / np.float32(32768))
@@ -34,3 +34,27 @@ def test_update_srt_proprietary():
 def test_hatena_srt(test_srt_1):
     content = Path(test_srt_1).read_text(encoding="UTF-8")
     print(zunda_w.srt_ops.srt_as_blog_content(content))
+
+
+def test_compose_duration_without_decode(tmp_path):
+    """
+    SpeakerComposeの構築と総時間の計算では音声をデコードしない
+    """
+    from datetime import timedelta
+
+    from pydub import AudioSegment
+
+    from zunda_w import audio
+    from zunda_w.srt_ops import SpeakerCompose, SpeakerUnit
+
+    wav = tmp_path.joinpath("a.wav")
+    AudioSegment.silent(1234, 24000).export(wav, format="wav")
+    t = timedelta()
+    units = [SpeakerUnit(srt.Subtitle(i, t, t, "a"), str(wav)) for i in range(3)]
+    units.append(SpeakerUnit(srt.Subtitle(3, t, t, "a"), "empty"))
+    audio.pcm_cache.clear()
+    compose = SpeakerCompose(tuple(units), t)
+    assert compose.audio_duration == timedelta(milliseconds=1234 * 3)
+    assert audio.pcm_cache.n_bytes == 0
+    assert len(units[0].audio) == 1234
+    assert units[3].audio is None
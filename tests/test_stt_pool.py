@@ -0,0 +1,85 @@
+import dataclasses
+from pathlib import Path
+
+import numpy as np
+import pytest
+import srt
+
+from zunda_w import stt_pool, transcribe
+from zunda_w.postprocess.srt import postprocess
+from zunda_w.sentence.ginza_sentence import GinzaSentence
+from zunda_w.silent import Segment
+from zunda_w.transcribe import WhisperProfile
+from zunda_w.util import read_srt
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_run_keeps_order(tmp_path, n_workers):
+    files = []
+    for i in range(3):
+        path = tmp_path.joinpath(f"speaker{i}.srt")
+        path.write_text(f"1\n00:00:01,000 --> 00:00:02,000\nline{i}\n\n", encoding="utf-8")
+        files.append(str(path))
+    tasks = [
+        stt_pool.SttTask(i, file, 3, str(tmp_path.joinpath(".cache")), WhisperProfile(), str(tmp_path.joinpath("tmp")))
+        for i, file in enumerate(files)
+    ]
+    results = list(stt_pool.run(tasks, n_workers=n_workers))
+    assert [r.index for r in results] == [0, 1, 2]
+    assert all(r.is_srt for r in results)
+    assert [Path(r.stt_file).read_text(encoding="utf-8").splitlines()[2] for r in results] == ["line0", "line1", "line2"]
+
+
+class _SplitGinza(GinzaSentence):
+    # GiNZAのモデルを使わずに"、"で行を分割する
+    def reconstruct_subtitles(self, subtitles):
+        results = []
+        for s in subtitles:
+            for text in s.content.split("、"):
+                results.append(srt.Subtitle(s.index, s.start, s.end, text, s.proprietary))
+        return results
+
+
+def test_speech_to_text_streams_chunks(tmp_path, monkeypatch):
+    """
+    無音区間ごとの途中結果を次の区間の文字起こしの前に渡し，途中結果の行は最終的なsrtの行と一致する
+    """
+    events = []
+
+    def fake_whisper_x(profile, audio):
+        i = int(audio[0])
+        events.append(f"transcribe{i}")
+        words = [{"word": c, "start": 0.1 * k, "end": 0.1 * k + 0.1} for k, c in enumerate(f"あ{i}、い{i}")]
+        return {"segments": [{"id": 0, "start": 0.0, "end": 0.5, "text": f"あ{i}、い{i}", "words": words}]}
+
+    def fake_nonsilent(audio_file, **kwargs):
+        for i in range(3):
+            yield Segment(i * 10000, i * 10000 + 1000), np.full(16000, i, dtype=np.float32)
+
+    monkeypatch.setattr(transcribe, "_transcribe_with_whisper_x", fake_whisper_x)
+    monkeypatch.setattr(transcribe, "iter_nonsilent", fake_nonsilent)
+    audio_file = tmp_path.joinpath("a.wav")
+    audio_file.write_bytes(b"audio")
+    task = stt_pool.SttTask(
+        0, str(audio_file), 3, str(tmp_path.joinpath(".cache")), WhisperProfile(), str(tmp_path.joinpath("tmp")),
+        no_detect_silence=False, ginza=_SplitGinza(), post_processes=("dummy",),
+    )
+    chunks = []
+
+    def on_chunk(chunk):
+        events.append(f"chunk{len(chunks)}")
+        chunks.append(chunk)
+
+    result = stt_pool.speech_to_text(task, on_chunk)
+    assert events == ["transcribe0", "chunk0", "transcribe1", "chunk1", "transcribe2", "chunk2"]
+    assert all(c.audio_hash == result.audio_hash for c in chunks)
+    lines = [s for c in chunks for s in stt_pool.chunk_subtitles(task, c)]
+    final = read_srt(result.stt_file)
+    assert [(s.content, s.proprietary) for s in lines] == [(s.content, s.proprietary) for s in final]
+    assert final[0].content == "あ0_Dummy" and final[0].proprietary == "3"
+
+    # 文書全体が必要な後処理がある場合は途中結果の行を作らない
+    document_step = postprocess.PostProcessStep("_test_document", lambda subtitles, options: subtitles, streaming=False)
+    monkeypatch.setitem(postprocess._steps, "_test_document", document_step)
+    document_task = dataclasses.replace(task, post_processes=("dummy", "_test_document"))
+    assert stt_pool.chunk_subtitles(document_task, chunks[0]) == []
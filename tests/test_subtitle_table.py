@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+import numpy as np
+import srt
+
+from zunda_w.srt_ops import merge, sort_srt_files
+from zunda_w.subtitle_table import SubtitleTable
+from zunda_w.words import WordFilter
+
+
+def _track(rng, n: int, proprietary: str):
+    subtitles = []
+    for i in range(n):
+        start = timedelta(milliseconds=int(rng.integers(0, 60_000)))
+        end = start + timedelta(milliseconds=int(rng.integers(100, 3_000)))
+        subtitles.append(srt.Subtitle(i + 1, start, end, f"{proprietary}:{int(rng.integers(0, 20))}", proprietary))
+    return subtitles
+
+
+def test_merge_same_as_subtitle_objects(tmp_path):
+    """
+    SubtitleTableを使ったmergeが，Subtitleを並べ替え,絞り込んだ結果と一致する
+    """
+    rng = np.random.default_rng(0)
+    tracks = [_track(rng, 50, p) for p in ("a", "b", "c")]
+    srt_files, tts_files = [], []
+    for i, track in enumerate(tracks):
+        srt_files.append(str(tmp_path.joinpath(f"{i}.srt")))
+        tmp_path.joinpath(f"{i}.srt").write_text(srt.compose(track, reindex=False), encoding="UTF-8")
+        # 音声が足りないトラックはzipと同じく短い方に揃える
+        tts_files.append([f"{i}_{j}.wav" for j in range(len(track) - i)])
+    filter_file = tmp_path.joinpath("filter.txt")
+    filter_file.write_text("a:1\nr^b:1\\d$", encoding="UTF-8")
+    word_filter = WordFilter(str(filter_file))
+
+    expected = []
+    for i, (track, audio_files) in enumerate(zip(tracks, tts_files)):
+        for s, a in zip(track, audio_files):
+            s = srt.Subtitle(s.index, s.start, s.end, s.content, s.proprietary)
+            s.speaker = i
+            expected.append((s, a, i))
+    expected.sort(key=lambda x: x[0].start)
+    expected = [x for x in expected if word_filter.is_exclude(x[0].content)]
+
+    compose = merge(srt_files, tts_files, word_filter=word_filter)
+    assert [u.subtitle for u in compose.unit] == [x[0] for x in expected]
+    assert [u.audio_file_path for u in compose.unit] == [x[1] for x in expected]
+    assert [u.subtitle.speaker for u in compose.unit] == [x[2] for x in expected]
+    assert compose.n_length == expected[-1][0].end
+
+    sorted_compose = sort_srt_files(srt_files)
+    assert [u.subtitle for u in sorted_compose.unit] == sorted(sum(tracks, []), key=lambda s: s.start)
+    assert all(u.audio_file_path is None for u in sorted_compose.unit)
+
+
+def test_concat_and_mask():
+    rng = np.random.default_rng(1)
+    a = SubtitleTable.from_subtitles(_track(rng, 10, "a"), 0, [f"a{i}.wav" for i in range(10)])
+    b = SubtitleTable.from_subtitles(_track(rng, 10, "b"), 1)
+    c = SubtitleTable.from_subtitles(_track(rng, 5, "a"), 2, [f"a{i}.wav" for i in range(5)])
+    table = SubtitleTable.concat([a, b, c])
+    assert len(table) == 25 and table.proprietaries == ("a", "b")
+    assert [table.audio_file(i) for i in range(20, 25)] == [f"a{i}.wav" for i in range(5)]
+    assert table.audio_file(12) is None
+    assert list(table.contents()) == [s.content for t in (a, b, c) for s in t.subtitles()]
+
+    calls = []
+    mask = table.text_mask(lambda text: calls.append(text) or text.endswith("1"))
+    assert len(calls) == len(set(table.contents()))
+    filtered = table.sort().filter(mask[np.argsort(table.start, kind="stable")])
+    assert all(c.endswith("1") for c in filtered.contents())
+    assert np.all(np.diff(filtered.start) >= 0)
@@ -0,0 +1,197 @@
+import copy
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from srt import Subtitle
+
+from zunda_w.srt_ops import SpeakerCompose, SpeakerUnit
+from zunda_w.timeline import TimelineIndex, to_ms
+
+
+def _units(rng, n: int):
+    units = []
+    for i in range(n):
+        start = int(rng.integers(0, 100_000))
+        end = start + int(rng.integers(0, 5_000))
+        s = Subtitle(i + 1, timedelta(milliseconds=start), timedelta(milliseconds=end), f"line {i}", str(i % 3))
+        units.append(SpeakerUnit(s, None))
+    return units
+
+
+def _overlap(units, start, end, speaker=None):
+    return [
+        u for u in sorted(units, key=lambda u: to_ms(u.subtitle.start))
+        if to_ms(u.subtitle.start) < end and to_ms(u.subtitle.end) > start
+        and (speaker is None or u.subtitle.proprietary == speaker)
+    ]
+
+
+def _distance(u, t):
+    start, end = to_ms(u.subtitle.start), to_ms(u.subtitle.end)
+    return start - t if start > t else max(0, t - end)
+
+
+def test_timeline_queries_after_edits():
+    """
+    insert,remove,retimeを繰り返しても全件を走査した結果と一致する
+    """
+    rng = np.random.default_rng(0)
+    units = _units(rng, 500)
+    timeline = TimelineIndex(units[:400])
+    current = list(units[:400])
+    for step in range(300):
+        op = step % 3
+        if op == 0:
+            unit = units[400 + step // 3]
+            timeline.insert(unit)
+            current.append(unit)
+        elif op == 1:
+            unit = current.pop(int(rng.integers(len(current))))
+            timeline.remove(unit)
+        else:
+            unit = current[int(rng.integers(len(current)))]
+            start = int(rng.integers(0, 100_000))
+            timeline.retime(unit, start, start + int(rng.integers(0, 8_000)))
+        starts = [to_ms(u.subtitle.start) for u in timeline]
+        assert starts == sorted(starts) and len(timeline) == len(current)
+
+        t = int(rng.integers(0, 110_000))
+        assert timeline.at(t) == _overlap(current, t, t + 1)
+        assert timeline.between(t, t + 3_000, speaker="1") == _overlap(current, t, t + 3_000, "1")
+        nearest = timeline.nearest(t, speaker="2")
+        candidates = [u for u in current if u.subtitle.proprietary == "2"]
+        assert _distance(nearest, t) == min(_distance(u, t) for u in candidates)
+    unit = current[0]
+    assert timeline.find(unit.subtitle.index, unit.subtitle.proprietary) is unit
+    assert timeline.find(unit.subtitle.index, "unknown") is None
+
+
+def test_compose_edit():
+    rng = np.random.default_rng(1)
+    units = sorted(_units(rng, 50), key=lambda u: u.subtitle.start)
+    compose = SpeakerCompose(tuple(units), units[-1].subtitle.end)
+    assert list(compose.timeline) == list(compose.unit)
+
+    new = SpeakerUnit(Subtitle(100, timedelta(seconds=30), timedelta(seconds=31), "new", "0"), None)
+    compose.insert(new)
+    compose.retime(units[0], timedelta(seconds=60), timedelta(seconds=61))
+    compose.remove(units[1])
+    assert list(compose.timeline) == list(compose.unit)
+    assert [s.start for s in compose.srt] == sorted(s.start for s in compose.srt)
+    assert new in compose.timeline.at(timedelta(seconds=30.5))
+
+
+def test_update_srt_with_inserted_line():
+    """
+    match_keys=Trueでは行を追加,削除したsrtでも(index,proprietary)で対応するunitを差し替える
+    """
+    rng = np.random.default_rng(2)
+    units = sorted(_units(rng, 20), key=lambda u: u.subtitle.start)
+    for u in units:
+        u.audio_file_path = f"{u.subtitle.index}.wav"
+    originals = [copy.copy(u.subtitle) for u in units]
+    compose = SpeakerCompose(tuple(units), units[-1].subtitle.end)
+    srts = [copy.copy(u.subtitle) for u in units]
+    srts[3].content = "edited"
+    srts[5].start, srts[5].end = timedelta(seconds=200), timedelta(seconds=201)
+    del srts[7]
+    srts.insert(2, Subtitle(999, srts[1].end, srts[1].end + timedelta(seconds=1), "inserted", "0"))
+
+    compose.update_srt(srts, match_keys=True)
+    assert [u.subtitle for u in compose.unit] == srts
+    assert [u.audio_file_path for u in compose.unit] == [
+        None if s.index == 999 else f"{s.index}.wav" for s in srts
+    ]
+    assert compose.timeline.nearest(timedelta(seconds=200)).subtitle.index == srts[6].index
+    assert len(compose.timeline) == len(srts)
+    assert compose.n_length == timedelta(seconds=201)
+    # 元のunitは変更しない
+    assert [u.subtitle for u in units] == originals
+    assert all(a is not b for a, b in zip(compose.unit, units))
+
+
+def test_update_srt_by_position():
+    units = [
+        SpeakerUnit(Subtitle(i, timedelta(seconds=s), timedelta(seconds=s + 1), f"l{i}", "0"), f"{i}.wav")
+        for i, s in enumerate([3, 0, 2])
+    ]
+    compose = SpeakerCompose(tuple(units), timedelta(seconds=4))
+    srts = [Subtitle(i, timedelta(seconds=s), timedelta(seconds=s + 1), f"e{i}", "0") for i, s in enumerate([3, 0, 5])]
+    compose.update_srt(srts)
+    # 並べ替えずに先頭から順に差し替える
+    assert [u.subtitle for u in compose.unit] == srts
+    assert [u.audio_file_path for u in compose.unit] == ["0.wav", "1.wav", "2.wav"]
+    assert [u.subtitle.content for u in units] == ["l0", "l1", "l2"]
+    assert compose.n_length == timedelta(seconds=6)
+    with pytest.raises(ValueError):
+        compose.update_srt(srts[:2])
+
+
+def test_edit_after_update_srt():
+    """
+    update_srtで時刻を変えた後のremove,insertが指定したunitに作用する
+    """
+    units = [
+        SpeakerUnit(Subtitle(i, timedelta(seconds=i), timedelta(seconds=i + 1), f"l{i}", "0"), f"{i}.wav")
+        for i in range(5)
+    ]
+    compose = SpeakerCompose(tuple(units), timedelta(seconds=5))
+    _ = compose.timeline
+    srts = [copy.copy(u.subtitle) for u in units]
+    srts[0].start, srts[0].end = timedelta(seconds=10), timedelta(seconds=11)
+    del srts[3]
+    srts.append(Subtitle(9, timedelta(seconds=2.5), timedelta(seconds=3), "l9", "0"))
+    compose.update_srt(srts, match_keys=True)
+    assert [u.subtitle.content for u in compose.unit] == ["l0", "l1", "l2", "l4", "l9"]
+    assert [u.subtitle.content for u in compose.timeline] == ["l1", "l2", "l9", "l4", "l0"]
+    assert compose.n_length == timedelta(seconds=11)
+
+    assert compose.remove(compose.unit[1]) == 1
+    assert [u.subtitle.content for u in compose.unit] == ["l0", "l2", "l4", "l9"]
+    assert [u.subtitle.content for u in compose.timeline] == ["l2", "l9", "l4", "l0"]
+    # 索引で次にあるl0の直前に入る
+    new = SpeakerUnit(Subtitle(10, timedelta(seconds=5), timedelta(seconds=6), "l10", "0"), None)
+    assert compose.insert(new) == 0
+    assert [u.subtitle.content for u in compose.unit] == ["l10", "l0", "l2", "l4", "l9"]
+    assert [u.subtitle.content for u in compose.timeline] == ["l2", "l9", "l4", "l10", "l0"]
+    assert [u.audio_file_path for u in compose.unit] == [None, "0.wav", "2.wav", "4.wav", None]
+
+
+def test_timeline_keeps_unit_order():
+    """
+    索引を作ってもunitの並び(merge(sort=False)など)は変わらない
+    """
+    units = [
+        SpeakerUnit(Subtitle(i, timedelta(seconds=s), timedelta(seconds=s + 1), f"l{i}", "0"), None)
+        for i, s in enumerate([3, 0, 2, 1])
+    ]
+    compose = SpeakerCompose(tuple(units), timedelta(seconds=4))
+    assert [u.subtitle.content for u in compose.timeline] == ["l1", "l3", "l2", "l0"]
+    assert list(compose.unit) == units
+    assert compose.remove(units[2]) == 2
+    assert [u.subtitle.content for u in compose.unit] == ["l0", "l1", "l3"]
+
+
+def test_compose_command(tmp_path):
+    """
+    zunda composeは行数が同じsrtの字幕を先頭から順に差し替え，unitの並びと音声を保つ
+    """
+    from zunda_w.apis import cmd
+    from zunda_w.util import read_json, write_json, write_srt
+
+    units = [
+        SpeakerUnit(Subtitle(i + 1, timedelta(seconds=s), timedelta(seconds=s + 1), f"l{i}", str(i % 2)), f"{i}.wav")
+        for i, s in enumerate([3, 0, 2])
+    ]
+    compose_json = str(tmp_path.joinpath("compose.json"))
+    write_json(SpeakerCompose(tuple(units), timedelta(seconds=4)).to_json(), compose_json)
+    srts = [copy.copy(u.subtitle) for u in units]
+    srts[1].content = "edited"
+    srt_file = str(tmp_path.joinpath("edited.srt"))
+    write_srt(srt_file, srts)
+
+    output = cmd.compose(srt_file, compose_json, output_dir=str(tmp_path.joinpath("output")))
+    expected = read_json(compose_json)
+    expected["unit"][1]["subtitle"]["content"] = "edited"
+    assert read_json(output) == expected
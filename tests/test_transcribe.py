@@ -0,0 +1,107 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from zunda_w.silent import Segment
+from zunda_w.transcribe import pack_segments
+
+
+def _segments():
+    # 元の音声の 1.0~3.0s, 10.0~10.5s, 20.0~24.0s
+    ranges = [(1000, 3000), (10000, 10500), (20000, 24000)]
+    return [(Segment(s, e), np.full((e - s) * 16, i + 1, dtype=np.float32)) for i, (s, e) in enumerate(ranges)]
+
+
+def test_pack_segments():
+    packed = pack_segments(_segments(), gap_ms=500)
+    assert len(packed.audio) == (2000 + 500 + 500 + 500 + 4000) * 16
+    assert packed.packed_starts.tolist() == [0.0, 2.5, 3.5]
+    assert packed.audio[int(2.5 * 16000)] == 2
+    assert packed.audio[int(2.2 * 16000)] == 0
+
+
+@pytest.mark.parametrize(
+    "t,expected",
+    [(0.0, 1.0), (1.5, 2.5), (2.2, 3.0), (2.5, 10.0), (2.75, 10.25), (3.6, 20.1), (7.5, 24.0)],
+)
+def test_packed_to_original(t, expected):
+    packed = pack_segments(_segments(), gap_ms=500)
+    assert packed.to_original(t) == pytest.approx(expected)
+
+
+def _fake_whisper_x(calls):
+    def transcribe(profile, audio):
+        calls.append(len(audio))
+        words = [{"word": "こ", "start": 0.1, "end": 0.2}, {"word": "ん", "start": 0.2, "end": 0.4}]
+        return {"segments": [{"id": 0, "start": 0.1, "end": 0.4, "text": "こん", "words": words}]}
+
+    return transcribe
+
+
+def _fake_packed_whisper_x(calls):
+    # 区間の音声(値が1以上)ごとに，区間の始まりから0.1秒後に始まるsegmentを返す
+    def transcribe(profile, audio):
+        calls.append(len(audio))
+        voiced = np.concatenate([[0], (audio > 0).astype(np.int8), [0]])
+        starts, ends = np.flatnonzero(np.diff(voiced) == 1), np.flatnonzero(np.diff(voiced) == -1)
+        segments = []
+        for i, (s, e) in enumerate(zip(starts / 16000, ends / 16000)):
+            words = [{"word": "こ", "start": s + 0.1, "end": s + 0.2}, {"word": "、"}]
+            segments.append({"id": i, "start": s + 0.1, "end": e - 0.1, "text": "こ、", "words": words})
+        return {"segments": segments}
+
+    return transcribe
+
+
+@pytest.mark.parametrize("max_seconds,n_calls", [(1800, 1), (3, 2)])
+def test_transcribe_segments_raw_batched(monkeypatch, max_seconds, n_calls):
+    """
+    batch_sizeが2以上の場合は区間をまとめて1回ずつ文字起こしし，時刻を元の音声の時刻に戻す
+    """
+    from zunda_w import transcribe
+
+    calls = []
+    monkeypatch.setattr(transcribe, "_transcribe_with_whisper_x", _fake_packed_whisper_x(calls))
+    segments = _segments()
+    results = list(transcribe.transcribe_segments_raw(
+        segments, transcribe.WhisperProfile(batch_size=8), max_seconds=max_seconds
+    ))
+    # max_seconds=3では2.5秒(2.0s+0.5s)と4.0秒に分ける
+    assert len(calls) == n_calls and len(results) == n_calls
+    if n_calls == 2:
+        assert calls == [(2000 + 500 + 500) * 16, 4000 * 16]
+    raw = [seg for result in results for seg in result]
+    assert len(raw) == len(segments)
+    for seg, (meta, _) in zip(raw, segments):
+        assert seg["start"] == pytest.approx(meta.start / 1000 + 0.1)
+        assert seg["end"] == pytest.approx(meta.end / 1000 - 0.1)
+        assert seg["words"][0]["start"] == pytest.approx(meta.start / 1000 + 0.1)
+        assert seg["words"][0]["end"] == pytest.approx(meta.start / 1000 + 0.2)
+        # 時刻の無い単語はそのまま
+        assert seg["words"][1] == {"word": "、"}
+
+
+def test_transcribe_with_config_cache(tmp_path, monkeypatch):
+    from pydub import AudioSegment
+
+    from zunda_w import transcribe
+
+    calls = []
+    monkeypatch.setattr(transcribe, "_transcribe_with_whisper_x", _fake_whisper_x(calls))
+    audio_file = str(tmp_path.joinpath("a.wav"))
+    AudioSegment.silent(1000, frame_rate=16000).export(audio_file, format="wav")
+    profile = transcribe.WhisperProfile()
+
+    srt_file = list(transcribe.transcribe_with_config([audio_file, audio_file], profile, str(tmp_path)))
+    # 同じ音声,同じ設定はキャッシュを使う(2つ目のファイルも処理する)
+    assert len(srt_file) == 2 and srt_file[0] == srt_file[1]
+    assert len(calls) == 1
+    # srtが消えてもwhisperの結果から作り直す
+    Path(srt_file[0]).unlink()
+    assert list(transcribe.transcribe_with_config([audio_file], profile, str(tmp_path))) == srt_file[:1]
+    assert len(calls) == 1
+    # 設定が変われば文字起こしし直す
+    other = list(transcribe.transcribe_with_config([audio_file], transcribe.WhisperProfile(prompt="x"), str(tmp_path)))
+    assert other != srt_file[:1]
+    assert len(calls) == 2
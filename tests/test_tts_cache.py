@@ -0,0 +1,36 @@
+import os
+
+import srt
+
+from benchmarks.stub_voicevox import stub_engine
+from zunda_w.subtitle_util import from_proprietaries
+from zunda_w.voicevox import voice_vox
+from zunda_w.voicevox.client import VoiceVoxClient
+from zunda_w.voicevox.tts_cache import TtsCache
+
+
+def test_cached_episode_without_engine_call(tmp_path):
+    subtitles = [srt.Subtitle(i, s.start, s.end, f"{i}行目", "3") for i, s in
+                 enumerate(from_proprietaries("", ["3"] * 10))]
+    subtitles.append(srt.Subtitle(10, subtitles[0].start, subtitles[0].end, "[next]", "3"))
+    tts_cache = TtsCache(str(tmp_path.joinpath("tts_cache.sqlite")))
+    assert voice_vox.lookup_cache(subtitles, tts_cache, dict_version="v1") is None
+    with stub_engine(port=0) as engine, VoiceVoxClient(engine.url) as client:
+        first = voice_vox.run(subtitles, str(tmp_path), client=client, tts_cache=tts_cache, dict_version="v1")
+        n_requests = engine.n_requests
+        second = voice_vox.run(subtitles, str(tmp_path), client=client, tts_cache=tts_cache, dict_version="v1")
+        # キャッシュにある行はaudio_queryも行わない
+        assert engine.n_requests == n_requests
+        # 辞書が変わった場合は作り直す
+        voice_vox.run(subtitles[:1], str(tmp_path), client=client, tts_cache=tts_cache, dict_version="v2")
+        assert engine.n_requests > n_requests
+    assert first == second
+    assert voice_vox.lookup_cache(subtitles, tts_cache, dict_version="v1") == first
+    assert tts_cache.stats().n_entries == 11
+
+    # 1ファイル分だけ残す
+    size = os.path.getsize(first[0])
+    tts_cache.evict(size)
+    assert tts_cache.total_bytes() <= size
+    assert voice_vox.lookup_cache(subtitles, tts_cache, dict_version="v1") is None
+    tts_cache.close()
@@ -0,0 +1,51 @@
+from pathlib import Path
+
+from pydub import AudioSegment
+
+from benchmarks.stub_voicevox import stub_engine
+from zunda_w.audio import memory_audio
+from zunda_w.pipeline import BackgroundWriter
+from zunda_w.voicevox import voice_vox
+from zunda_w.voicevox.client import VoiceVoxClient
+
+
+def test_text_to_speech_order_keep_order(tmp_path):
+    contents = [f"{i}行目" * (i % 3 + 1) for i in range(20)] + ["[next]"]
+    speakers = [3 if i % 2 else 2 for i in range(len(contents))]
+    with stub_engine(port=0, workers=2) as engine:
+        with VoiceVoxClient(engine.url, max_in_flight=2, batch_size=4) as client:
+            results = voice_vox.text_to_speech_order(contents, speakers, str(tmp_path), {}, use_cache=True,
+                                                     client=client)
+            assert client.stats.n_requests["/multi_synthesis"] > 0
+            assert client.stats.n_requests["/synthesis"] == 0
+            n_multi = client.stats.n_requests["/multi_synthesis"]
+            # 2回目はキャッシュを使うためaudio_queryのみ
+            cached = voice_vox.text_to_speech_order(contents, speakers, str(tmp_path), {}, use_cache=True,
+                                                    client=client)
+            assert client.stats.n_requests["/multi_synthesis"] == n_multi
+    assert results[-1] == "empty"
+    assert all(Path(r).exists() for r in results[:-1])
+    assert cached == results
+
+
+def test_fallback_to_synthesis(tmp_path):
+    with stub_engine(port=0, multi_synthesis=False) as engine:
+        with VoiceVoxClient(engine.url, batch_size=8) as client:
+            results = voice_vox.text_to_speech_order(["a", "b", "c"], [3, 3, 3], str(tmp_path), {}, client=client)
+            assert client.stats.n_requests["/synthesis"] == 3
+    assert len(set(results)) == 3
+
+
+def test_keep_in_memory(tmp_path):
+    contents = [f"{i}行目" for i in range(10)]
+    with stub_engine(port=0) as engine, VoiceVoxClient(engine.url, batch_size=4) as client:
+        with BackgroundWriter() as writer:
+            results = voice_vox.text_to_speech_order(contents, [3] * len(contents), str(tmp_path), {}, client=client,
+                                                     writer=writer, keep_in_memory=True)
+    try:
+        for path in results:
+            clip = memory_audio.get(path)
+            assert clip is not None and clip.fmt.frame_rate == 24000
+            assert clip.to_segment().raw_data == AudioSegment.from_file(path).raw_data
+    finally:
+        memory_audio.clear()
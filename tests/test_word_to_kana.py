@@ -0,0 +1,87 @@
+from benchmarks.stub_llm import StubChatModel, to_kana
+from zunda_w.llm.convert_word_to_kana import KanaCache, convert_sentences, parse_word_answer
+
+TEXTS = ["PythonとRustの話", "そうですね", "Pythonは速い", "PythonとRustの話"]
+
+
+def test_convert_sentences_concurrent_and_cached(tmp_path):
+    kana_cache = KanaCache(str(tmp_path.joinpath("word2kana.sqlite")))
+    llm = StubChatModel(latency=0)
+    expected = [to_kana(t) for t in TEXTS]
+    assert convert_sentences(TEXTS, llm, kana_cache, mode="sentence") == expected
+    # 重複した文章は1回だけ送る.英単語の無い文章は送らない
+    assert llm.n_requests == 2
+    assert convert_sentences(TEXTS, llm, kana_cache, mode="sentence") == expected
+    assert llm.n_requests == 2
+    kana_cache.close()
+
+
+def test_convert_words_packed(tmp_path):
+    kana_cache = KanaCache(str(tmp_path.joinpath("word2kana.sqlite")))
+    llm = StubChatModel(latency=0)
+    expected = [to_kana(t) for t in TEXTS]
+    assert convert_sentences(TEXTS, llm, kana_cache, mode="word") == expected
+    assert llm.n_requests == 1
+    assert llm.inputs[0].count("Python") == 1
+    # 別のエピソードでも同じ単語は送らない
+    assert convert_sentences(["Rustを使う"], llm, kana_cache, mode="word") == [to_kana("Rustを使う")]
+    assert llm.n_requests == 1
+    kana_cache.close()
+
+
+def test_convert_sentences_use_word_cache(tmp_path):
+    kana_cache = KanaCache(str(tmp_path.joinpath("word2kana.sqlite")))
+    llm = StubChatModel(latency=0)
+    convert_sentences(TEXTS, llm, kana_cache, mode="word")
+    assert llm.n_requests == 1
+    # 既知の単語だけの新しい文章はLLMに送らない
+    assert convert_sentences(["Rustを使う"], llm, kana_cache, mode="sentence") == [to_kana("Rustを使う")]
+    assert llm.n_requests == 1
+    # 未知の単語が残る文章は，既知の単語をカナにしてから送る
+    assert convert_sentences(["PythonとGo"], llm, kana_cache, mode="sentence") == [to_kana("PythonとGo")]
+    assert llm.n_requests == 2
+    assert llm.inputs[-1].count("Python") == 0 and llm.inputs[-1].count("Go") == 1
+    kana_cache.close()
+
+
+def test_parse_word_answer():
+    assert parse_word_answer("1: パイソン\nfoo\n3: ラスト\n2：ゴー", ["Python", "Go"]) == {
+        "Python": "パイソン",
+        "Go": "ゴー",
+    }
+
+
+def test_word2kana_step_options(tmp_path, monkeypatch):
+    """
+    変換方法と同時リクエスト数はPostProcessOptionsで指定し，変換方法だけをキャッシュのキーに含める
+    """
+    import datetime
+
+    import srt
+
+    from zunda_w.llm import convert_word_to_kana
+    from zunda_w.postprocess.srt import postprocess
+
+    calls = []
+
+    def fake_convert(texts, llm, kana_cache, mode, max_concurrency):
+        calls.append((mode, max_concurrency))
+        return [to_kana(t) for t in texts]
+
+    monkeypatch.setattr(convert_word_to_kana, "convert_sentences", fake_convert)
+    monkeypatch.setattr(convert_word_to_kana.cache, "user_cache_dir", lambda name: str(tmp_path))
+    monkeypatch.setenv("WORD2KANA_MODE", "sentence")
+    path = tmp_path.joinpath("a.srt")
+    subtitles = [srt.Subtitle(1, datetime.timedelta(0), datetime.timedelta(seconds=1), TEXTS[0])]
+    path.write_text(srt.compose(subtitles), encoding="utf-8")
+    cache_dir = str(tmp_path.joinpath(".layers"))
+
+    options = postprocess.PostProcessOptions(word2kana_mode="word", word2kana_concurrency=2)
+    word = postprocess.post_process_layered(str(path), ["word2kana"], cache_dir, options)
+    assert calls == [("word", 2)]
+    sentence = postprocess.post_process_layered(str(path), ["word2kana"], cache_dir)
+    assert sentence != word and calls == [("word", 2), ("sentence", 8)]
+    # 同時リクエスト数は結果に影響しないのでキャッシュを使う
+    options = postprocess.PostProcessOptions(word2kana_mode="word", word2kana_concurrency=16)
+    assert postprocess.post_process_layered(str(path), ["word2kana"], cache_dir, options) == word
+    assert len(calls) == 2
@@ -1,6 +1,6 @@
 from dotenv import load_dotenv
 
-from .audio import concatenate_from_file
+from .audio import concatenate_from_file, concatenate_to_file
 from .edit import SpeakerCompose
 from .silent import Segment, divide_by_silence
 from .srt_ops import SpeakerUnit, merge
@@ -27,7 +27,7 @@ def _convert(conf, *args, **kwargs):
 
 
 option_arg_commands = ["convert", "preset", "clear", "speaker", "sample_voice"]
-plain_command = ["compose"]
+plain_command = ["compose", "cache", "engine"]
 
 
 def _main():
@@ -35,7 +35,15 @@ def _main():
     subcommand = sys.argv[1]
     if subcommand in plain_command:
         return fire.Fire({
-            "compose": cmd.compose
+            "compose": cmd.compose,
+            "cache": {
+                "stats": cmd.cache_stats,
+                "prune": cmd.cache_prune,
+            },
+            "engine": {
+                "status": cmd.engine_status,
+                "stop": cmd.engine_stop,
+            },
         })
     else:
         with argv_omit(1):
@@ -50,9 +58,14 @@ def _main():
                 "convert": partial_doc(_convert, conf),
                 "preset": partial_doc(cmd.create_preset, conf),
                 "clear": partial_doc(cmd.clear_cache, arg.data_cache_dir),
-                "speaker": partial_doc(cmd.show_speaker, arg.speaker_json, arg.engine_dir),
+                "speaker": partial_doc(
+                    cmd.show_speaker, arg.speaker_json, arg.engine_dir, idle_timeout=arg.engine_idle_timeout
+                ),
                 "sample_voice": partial_doc(
-                    cmd.create_sample_voices, text=arg.text, engine_dir=arg.engine_dir
+                    cmd.create_sample_voices,
+                    text=arg.text,
+                    engine_dir=arg.engine_dir,
+                    idle_timeout=arg.engine_idle_timeout,
                 ),
             }
         )
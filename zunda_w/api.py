@@ -1,3 +1,4 @@
+import contextlib
 import os
 from datetime import timedelta
 from pathlib import Path
@@ -18,6 +19,7 @@ from zunda_w import (
     util,
 )
 from zunda_w.voicevox import download_voicevox, voice_vox
+from zunda_w.voicevox.engine_daemon import shared_engine
 from zunda_w.voicevox.voice_vox import VoiceVoxProfile
 from zunda_w.transcribe import transcribe_non_silence_srt, transcribe_with_config
 
@@ -66,13 +68,16 @@ class API:
         srt: Union[str, List[srt.Subtitle]],
         auto_close: bool = True,
         voicevox_process: Optional[Popen] = None,
-    ) -> Tuple[Sequence[str], Popen]:
-        try:
-            # launch process if not before launch.
+    ) -> Tuple[Sequence[str], Optional[Popen]]:
+        with contextlib.ExitStack() as engine_stack:
+            # 起動済みのprocessが無ければ常駐しているengineを使う.無ければ起動する
             if voicevox_process is None:
-                voicevox_process = voice_vox.launch_voicevox_engine(
-                    download_voicevox.extract_engine(root_dir=self.engine_dir,update=False)
+                engine_stack.enter_context(
+                    shared_engine(lambda: download_voicevox.extract_engine(root_dir=self.engine_dir, update=False))
                 )
+            if auto_close and voicevox_process is not None:
+                engine_stack.callback(voicevox_process.poll)
+                engine_stack.callback(voicevox_process.terminate)
             if self.profile is None:
                 profile = VoiceVoxProfile()
             tts_files = voice_vox.run(
@@ -82,10 +87,6 @@ class API:
                 output_dir=self.cache_tts,
                 query=profile,
             )
-        finally:
-            if voicevox_process is not None and auto_close:
-                voicevox_process.terminate()
-                voicevox_process.poll()
         return tts_files, voicevox_process
 
     def chatgpt_to_speech(
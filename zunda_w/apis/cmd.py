@@ -1,3 +1,4 @@
+import os
 import shutil
 from pathlib import Path
 
@@ -9,6 +10,8 @@ from zunda_w import subtitle_util, SpeakerCompose
 from zunda_w.output import OutputDir
 from zunda_w.util import read_srt, write_json
 from zunda_w.voicevox import download_voicevox, voice_vox
+from zunda_w.voicevox.engine_daemon import IDLE_TIMEOUT, EngineDaemon, shared_engine
+from zunda_w.voicevox.tts_cache import CACHE_DB, TtsCache
 
 
 def clear_cache(cache_dir: str):
@@ -19,6 +22,47 @@ def clear_cache(cache_dir: str):
     return shutil.rmtree(cache_dir, ignore_errors=True)
 
 
+def cache_stats(data_dir: str = ".cache"):
+    """
+    合成音声キャッシュの統計を表示
+    :param data_dir:
+    :return:
+    """
+    with TtsCache(os.path.join(data_dir, CACHE_DB)) as tts_cache:
+        print(tts_cache.stats())
+
+
+def cache_prune(max_mb: int, data_dir: str = ".cache"):
+    """
+    合成音声キャッシュを古いものから削除し，max_mb以下にする
+    :param max_mb:
+    :param data_dir:
+    :return:
+    """
+    with TtsCache(os.path.join(data_dir, CACHE_DB)) as tts_cache:
+        n_removed = tts_cache.evict(max_mb * 1024 * 1024)
+        logger.info(f"Remove {n_removed} entries")
+        print(tts_cache.stats())
+
+
+def engine_status():
+    """
+    常駐しているvoicevox engineの状態を表示
+    :return:
+    """
+    for key, value in EngineDaemon().status().items():
+        print(f"{key:8s}: {value}")
+
+
+def engine_stop():
+    """
+    常駐しているvoicevox engineを停止する.zunda_wで起動したengineのみ対象
+    :return:
+    """
+    if not EngineDaemon().stop():
+        logger.info("No engine launched by zunda_w is running")
+
+
 def create_preset(conf):
     """
     現在の設定をファイルに出力する
@@ -28,34 +72,34 @@ def create_preset(conf):
     return OmegaConf.save(conf, "preset.yaml")
 
 
-def show_speaker(output_json: str, engine_dir: str):
+def show_speaker(output_json: str, engine_dir: str, idle_timeout: float = IDLE_TIMEOUT):
     """
     voicevoxに内蔵されている話者一覧を表示
     :param output_json:
     :param engine_dir:
+    :param idle_timeout: engineを常駐させておく秒数
     :return:
     """
-    with voice_vox.voicevox_engine(
-            download_voicevox.extract_engine(root_dir=engine_dir)
-    ):
+    with shared_engine(lambda: download_voicevox.extract_engine(root_dir=engine_dir), idle_timeout):
         if speakers := voice_vox.get_speakers(output_json):
             print(voice_vox.format_speaker(speakers))
         else:
             logger.warning("Can't get /speakers requests")
 
 
-def create_sample_voices(text: str, engine_dir: str, output: str = "sample_voice"):
+def create_sample_voices(
+        text: str, engine_dir: str, output: str = "sample_voice", idle_timeout: float = IDLE_TIMEOUT
+):
     """voicevoxで実装されているキャラクターに同一を読み上げを行わせる
     :param text:
     :param engine_dir:
     :param output:
+    :param idle_timeout: engineを常駐させておく秒数
     :return:
     """
     output = Path(output)
     output.mkdir(parents=True, exist_ok=True)
-    with voice_vox.voicevox_engine(
-            download_voicevox.extract_engine(root_dir=engine_dir)
-    ):
+    with shared_engine(lambda: download_voicevox.extract_engine(root_dir=engine_dir), idle_timeout):
         if speakers := voice_vox.get_speakers():
             output_names = []
             request_list = []
@@ -79,9 +123,21 @@ def create_sample_voices(text: str, engine_dir: str, output: str = "sample_voice
             logger.warning("Can't get /speakers requests")
 
 
-def compose(srt_file: str, compose_json: str, output_name: str = "compose.json", output_dir="output"):
+def compose(
+        srt_file: str, compose_json: str, output_name: str = "compose.json", output_dir="output", match_keys: bool = False
+):
+    """
+    編集したsrtの字幕でcompose.jsonを更新する
+    :param srt_file:
+    :param compose_json:
+    :param output_name:
+    :param output_dir:
+    :param match_keys: Falseの場合は行数が同じsrtで先頭から順に差し替える.
+     Trueの場合は(index,proprietary)で対応付け，行の追加,削除も反映する
+    :return:
+    """
     srts = read_srt(srt_file)
     compose = SpeakerCompose.from_json(compose_json)
     output_dir = OutputDir(parent=output_dir)
 
-    return write_json(compose.update_srt(srts).to_json(), output_dir(output_name))
+    return write_json(compose.update_srt(srts, match_keys=match_keys).to_json(), output_dir(output_name))
@@ -31,6 +31,8 @@ class Options:
     output_dir: str = "output"
     output: str = "arrange.wav"
     mix_output: str = "mix.wav"
+    # 配置した音声のサンプリングレート.0の場合はv_profileのoutputSamplingRate,未指定ならVOICEVOXの出力のまま
+    arrange_frame_rate: int = 0
     speakers: List[int] = DEFAULT_SPEAKER_IDs
     default_profile: WhisperProfile = WhisperProfile()
     profile_json: str = "profile.json"
@@ -40,7 +42,27 @@ class Options:
     word_filter: str = "config/filter_word.txt"
     prompt: str = "prompt.txt"
     user_dict: str = "config/user_dict.csv"
+    # voicevoxに同時に投げるリクエスト数(engineのワーカー数に合わせる)
+    tts_max_in_flight: int = 4
+    # /multi_synthesisでまとめて合成する行数(1で無効)
+    tts_batch_size: int = 8
+    # 合成済み音声のキャッシュの上限(MB).0で無制限
+    tts_cache_max_mb: int = 0
+    # 合成した音声をメモリ上に保持し，ファイルから読み直さずに音声の配置を行う
+    tts_in_memory: bool = False
+    # 使い終わったengineを常駐させておく秒数.次の実行ではengineの起動を省く.0で使い終わったらすぐ停止
+    engine_idle_timeout: int = 600
+    # ローカルで起動するengineの数(ポート50021から連番).行ごとに空いているengineへ振り分ける
+    tts_engines: int = 1
+    # 起動済みのengineのURL.指定した場合はローカルでengineを起動しない
+    tts_engine_urls: List[str] = []
     no_detect_silence: bool = True
+    # 無音区間で分割した音声(.silence)をファイルにも書き出す
+    keep_silence_segments: bool = False
+    # 話者ごとの文字起こしを並列に行うプロセス数.ワーカーごとにモデルを読み込む
+    stt_workers: int = 1
+    # 音声ファイルのハッシュ関数(md5,blake2b,xxh3_128など).変えると既存のキャッシュは使われない
+    hash_algorithm: str = "md5"
     cache_root_dir: str = os.curdir
     data_cache_dir: str = ".cache"
     temp_dir: str = ".tmp"
@@ -50,6 +72,12 @@ class Options:
     preset: str = ""
     ginza: GinzaSentence = GinzaSentence()
     post_processes: List[str] = []
+    # emotion_analysisの推論方法.torch(GPUがあれば使う) または onnx(CPU,int8量子化)
+    emotion_backend: str = "torch"
+    # word2kanaの変換方法.sentence(文章ごとにLLMへ送る) または word(英単語だけをまとめて送る)
+    word2kana_mode: str = "sentence"
+    # word2kanaのLLMへの同時リクエスト数
+    word2kana_concurrency: int = 8
     text: str = "これはサンプルボイスです"
     ostt: bool = False
     otts: bool = False
@@ -1,19 +1,646 @@
-from typing import Iterator
+import math
+import os
+import struct
+import subprocess
+import threading
+import wave
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
 
+import numpy as np
 from pydub import AudioSegment
 
+try:
+    import audioop
+except ImportError:
+    import pyaudioop as audioop
+
+# sample_width(byte) -> numpyの型
+_SAMPLE_DTYPE = {1: np.int8, 2: np.int16, 4: np.int32}
+# 飽和加算用に一段広い型
+_WIDE_DTYPE = {1: np.int16, 2: np.int32, 4: np.int64}
+
+
+@dataclass(frozen=True)
+class AudioFormat:
+    frame_rate: int = 44100
+    channels: int = 1
+    sample_width: int = 2
+
+    @property
+    def dtype(self):
+        return _SAMPLE_DTYPE[self.sample_width]
+
+    @property
+    def frame_width(self) -> int:
+        return self.channels * self.sample_width
+
+    def frame_count(self, ms: float) -> int:
+        """
+        pydubと同じ計算式でミリ秒をフレーム数に変換
+        """
+        return int(ms * (self.frame_rate / 1000.0))
+
+    def converted_frames(self, n_frames: int, src: "AudioFormat") -> int:
+        """
+        srcのn_framesフレームをこの形式に変換した後のフレーム数
+        audioop.ratecvの出力数と一致する(デコードせずに長さを求めるため)
+        """
+        if n_frames == 0 or src.frame_rate == self.frame_rate:
+            return n_frames
+        g = math.gcd(src.frame_rate, self.frame_rate)
+        return (n_frames - 1) * (self.frame_rate // g) // (src.frame_rate // g) + 1
+
+    @staticmethod
+    def of(segment: AudioSegment) -> "AudioFormat":
+        return AudioFormat(segment.frame_rate, segment.channels, segment.sample_width)
+
+    @staticmethod
+    def sync(formats: Sequence["AudioFormat"]) -> "AudioFormat":
+        """
+        AudioSegment._syncと同様に，最も大きいチャンネル数，サンプリングレート，量子化ビット数に揃える
+        """
+        return AudioFormat(
+            max(f.frame_rate for f in formats),
+            max(f.channels for f in formats),
+            max(f.sample_width for f in formats),
+        )
+
+
+@dataclass(frozen=True)
+class AudioInfo:
+    fmt: AudioFormat
+    n_frames: int
+
+    @property
+    def duration_ms(self) -> int:
+        """
+        len(AudioSegment)と同じ丸め方の長さ(ミリ秒)
+        """
+        return round(1000 * (self.n_frames / self.fmt.frame_rate))
+
+    @staticmethod
+    def of(segment: AudioSegment) -> "AudioInfo":
+        return AudioInfo(AudioFormat.of(segment), int(segment.frame_count()))
+
+
+@dataclass(frozen=True)
+class PcmClip:
+    """
+    wavのバイト列を参照する(frames,channels)の配列.バイト列はコピーしない
+    """
+
+    fmt: AudioFormat
+    samples: np.ndarray
+
+    @property
+    def info(self) -> AudioInfo:
+        return AudioInfo(self.fmt, len(self.samples))
+
+    def to_segment(self) -> AudioSegment:
+        return AudioSegment(
+            self.samples.tobytes(),
+            frame_rate=self.fmt.frame_rate,
+            sample_width=self.fmt.sample_width,
+            channels=self.fmt.channels,
+        )
+
+
+def parse_wav(data: bytes) -> PcmClip:
+    """
+    PCM(16,32bit)のwavをデコードせずにサンプルの配列として参照する
+    :raise ValueError: 対応していない形式
+    """
+    view = memoryview(data)
+    if bytes(view[:4]) != b"RIFF" or bytes(view[8:12]) != b"WAVE":
+        raise ValueError("not a wav file")
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(view):
+        chunk_id = bytes(view[pos: pos + 4])
+        (size,) = struct.unpack_from("<I", view, pos + 4)
+        body = pos + 8
+        if chunk_id == b"fmt ":
+            audio_format, channels, frame_rate, _, _, bits = struct.unpack_from("<HHIIHH", view, body)
+            # 1:PCM, 0xFFFE:WAVE_FORMAT_EXTENSIBLE
+            if audio_format not in (1, 0xFFFE) or bits not in (16, 32):
+                raise ValueError(f"unsupported wav format:{audio_format} {bits}bit")
+            fmt = AudioFormat(frame_rate, channels, bits // 8)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("fmt chunk not found")
+            # 逐次書き出されたwavはサイズが不定の場合がある
+            size = min(size, len(view) - body)
+            size -= size % fmt.frame_width
+            samples = np.frombuffer(view[body: body + size], dtype=fmt.dtype).reshape(-1, fmt.channels)
+            return PcmClip(fmt, samples)
+        pos = body + size + (size & 1)
+    raise ValueError("data chunk not found")
+
+
+class MemoryAudioStore:
+    """
+    ファイルパス -> メモリ上の音声
+    音声合成の結果をファイルから読み直さずに使う.ファイルの書き込みが終わる前でも参照できる
+    """
+
+    def __init__(self):
+        self._data: Dict[str, PcmClip] = {}
+        self._lock = threading.Lock()
+
+    def put(self, path: str, clip: PcmClip):
+        with self._lock:
+            self._data[os.path.abspath(path)] = clip
+
+    def get(self, path: str) -> Optional[PcmClip]:
+        with self._lock:
+            return self._data.get(os.path.abspath(path))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def n_bytes(self) -> int:
+        with self._lock:
+            return sum(c.samples.nbytes for c in self._data.values())
+
+
+memory_audio = MemoryAudioStore()
+
+
+def _file_key(path: str) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+@lru_cache(maxsize=8192)
+def _audio_info(key: Tuple[str, int, int]) -> AudioInfo:
+    path = key[0]
+    try:
+        with wave.open(path, "rb") as wav:
+            # pydubは24bitを32bitに変換して読み込む
+            sample_width = 4 if wav.getsampwidth() == 3 else wav.getsampwidth()
+            fmt = AudioFormat(wav.getframerate(), wav.getnchannels(), sample_width)
+            return AudioInfo(fmt, wav.getnframes())
+    except (wave.Error, EOFError):
+        # wav以外の形式はデコードして調べる
+        return AudioInfo.of(load_audio(path))
+
+
+def audio_info(path: str) -> AudioInfo:
+    """
+    音声ファイルのフォーマットと長さを返す
+    wavファイルの場合はヘッダのみを読み込み，サンプルはデコードしない
+    """
+    clip = memory_audio.get(path)
+    if clip is not None:
+        return clip.info
+    return _audio_info(_file_key(path))
+
+
+class PcmCache:
+    """
+    デコード済み音声のLRUキャッシュ
+    保持するPCMの合計バイト数がmax_bytesを超えたら古いものから破棄する
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[Tuple[str, int, int], AudioSegment]" = OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, int, int]) -> Optional[AudioSegment]:
+        with self._lock:
+            segment = self._data.get(key)
+            if segment is not None:
+                self._data.move_to_end(key)
+            return segment
+
+    def put(self, key: Tuple[str, int, int], segment: AudioSegment):
+        size = len(segment.raw_data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                return
+            self._data[key] = segment
+            self._n_bytes += size
+            while self._n_bytes > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self._n_bytes -= len(old.raw_data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._n_bytes = 0
+
+    @property
+    def n_bytes(self) -> int:
+        return self._n_bytes
+
+
+pcm_cache = PcmCache()
+
+
+def load_audio(path: str) -> AudioSegment:
+    """
+    音声ファイルをデコードして返す.結果はpcm_cacheに保持する
+    memory_audioにあればファイルは読まない
+    """
+    clip = memory_audio.get(path)
+    if clip is not None:
+        return clip.to_segment()
+    key = _file_key(path)
+    segment = pcm_cache.get(key)
+    if segment is None:
+        segment = AudioSegment.from_file(path)
+        pcm_cache.put(key, segment)
+    return segment
+
+
+def is_supported(fmt: AudioFormat) -> bool:
+    return fmt.sample_width in _SAMPLE_DTYPE
+
+
+def as_array(segment: AudioSegment, fmt: AudioFormat) -> np.ndarray:
+    """
+    AudioSegmentをfmtに変換し，(frames,channels)の配列として返す
+    変換順序はAudioSegment._syncと同じ
+    """
+    segment = (
+        segment.set_channels(fmt.channels)
+        .set_frame_rate(fmt.frame_rate)
+        .set_sample_width(fmt.sample_width)
+    )
+    return np.frombuffer(segment.raw_data, dtype=fmt.dtype).reshape(-1, fmt.channels)
+
+
+def to_float32(segment: AudioSegment, frame_rate: int = 16000) -> np.ndarray:
+    """
+    whisperの入力形式(mono,frame_rate,[-1,1]のfloat32)に変換
+    """
+    segment = segment.set_channels(1).set_frame_rate(frame_rate).set_sample_width(2)
+    return np.frombuffer(segment.raw_data, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def _saturate_add(dst: np.ndarray, src: np.ndarray):
+    """
+    audioop.addと同様に飽和させながらdstにsrcを加算
+    """
+    info = np.iinfo(dst.dtype)
+    wide = _WIDE_DTYPE[dst.dtype.itemsize]
+    np.clip(dst.astype(wide) + src, info.min, info.max, out=dst, casting="unsafe")
+
+
+class PcmCanvas:
+    """
+    出力全体を1つのバッファに確保し，そこへ音声を書き込む
+    """
+
+    def __init__(self, fmt: AudioFormat, n_frames: int):
+        self.fmt = fmt
+        self.buffer = np.zeros((n_frames, fmt.channels), dtype=fmt.dtype)
+
+    def mix(self, frame: int, samples: np.ndarray):
+        end = min(frame + len(samples), len(self.buffer))
+        if end <= frame:
+            return
+        _saturate_add(self.buffer[frame:end], samples[: end - frame])
+
+    def to_segment(self) -> AudioSegment:
+        return AudioSegment(
+            self.buffer.tobytes(),
+            frame_rate=self.fmt.frame_rate,
+            sample_width=self.fmt.sample_width,
+            channels=self.fmt.channels,
+        )
+
+
+class Resampler:
+    """
+    線形補間でサンプリングレートを変換する.chunk間で位置を引き継ぐため，分割して渡しても結果は同じ
+    出力のkフレーム目は入力のk*src_rate/dst_rateの位置の値
+    """
+
+    def __init__(self, src_rate: int, dst_rate: int, channels: int, dtype):
+        g = math.gcd(src_rate, dst_rate)
+        self._src = src_rate // g
+        self._dst = dst_rate // g
+        self.dtype = np.dtype(dtype)
+        # 未使用の入力(先頭の入力上の位置は_base)
+        self._buf = np.zeros((0, channels), dtype=np.float64)
+        self._base = 0
+        self._n_in = 0
+        self._n_out = 0
+
+    def n_frames(self, n_in: int) -> int:
+        """
+        n_inフレームを変換した後のフレーム数
+        """
+        return -(-n_in * self._dst // self._src)
+
+    def _emit(self, end: int) -> np.ndarray:
+        k = np.arange(self._n_out, end, dtype=np.int64)
+        pos = k * self._src
+        index = pos // self._dst - self._base
+        frac = ((pos % self._dst) / self._dst)[:, None]
+        # 末尾は最後のフレームを繰り返す
+        nxt = np.minimum(index + 1, len(self._buf) - 1)
+        out = self._buf[index] * (1 - frac) + self._buf[nxt] * frac
+        self._n_out = end
+        info = np.iinfo(self.dtype)
+        return np.clip(np.rint(out), info.min, info.max).astype(self.dtype)
+
+    def _drop_used(self):
+        # 次に出力するフレームが参照する位置より前は不要
+        keep = min(self._n_out * self._src // self._dst, self._n_in) - self._base
+        self._buf = self._buf[keep:]
+        self._base += keep
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        self._buf = np.concatenate([self._buf, samples.astype(np.float64)])
+        self._n_in += len(samples)
+        # 補間に使う次のフレームが揃っている出力まで
+        end = max(self._n_out, -(-(self._n_in - 1) * self._dst // self._src))
+        out = self._emit(end)
+        self._drop_used()
+        return out
+
+    def flush(self) -> np.ndarray:
+        if len(self._buf) == 0:
+            return np.zeros((0, self._buf.shape[1]), dtype=self.dtype)
+        out = self._emit(self.n_frames(self._n_in))
+        self._drop_used()
+        return out
+
+
+def resample(samples: np.ndarray, src_rate: int, dst_rate: int) -> np.ndarray:
+    """
+    (frames,channels)の配列をdst_rateに変換する
+    """
+    if src_rate == dst_rate:
+        return samples
+    resampler = Resampler(src_rate, dst_rate, samples.shape[1], samples.dtype)
+    return np.concatenate([resampler.process(samples), resampler.flush()])
+
+
+class _WavSink:
+    def __init__(self, path: str, fmt: AudioFormat):
+        self._wav = wave.open(str(path), "wb")
+        self._wav.setnchannels(fmt.channels)
+        self._wav.setsampwidth(fmt.sample_width)
+        self._wav.setframerate(fmt.frame_rate)
+
+    def write(self, data: bytes):
+        self._wav.writeframesraw(data)
+
+    def close(self):
+        self._wav.close()
+
+
+# 拡張子 -> ffmpegのエンコーダ
+ENCODERS = {".flac": "flac", ".opus": "libopus", ".ogg": "libopus"}
+# libopusが受け付けるサンプリングレート
+_OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+
+
+class _FfmpegSink:
+    """
+    PCMをffmpegの標準入力に流し込んでエンコードする
+    """
+
+    def __init__(self, path: str, fmt: AudioFormat):
+        codec = ENCODERS[Path(path).suffix.lower()]
+        pcm = {2: "s16le", 4: "s32le"}[fmt.sample_width]
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", pcm, "-ar", str(fmt.frame_rate), "-ac", str(fmt.channels), "-i", "pipe:0",
+            "-c:a", codec,
+        ]
+        if codec == "libopus" and fmt.frame_rate not in _OPUS_RATES:
+            command.extend(["-ar", "48000"])
+        self._process = subprocess.Popen([*command, str(path)], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, data: bytes):
+        self._process.stdin.write(data)
+
+    def close(self):
+        self._process.stdin.close()
+        stderr = self._process.stderr.read()
+        if self._process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace')}")
+
+
+class WavStreamWriter:
+    """
+    開始位置が昇順の音声を受け取り，確定した区間からファイルへ書き出す
+    メモリ上に保持するのは未確定の区間(おおよそ音声1つ分)のみ
+    拡張子が.flac,.opus,.oggの場合はffmpegでエンコードしながら書き出す
+    :param path:
+    :param fmt: 音声を配置する形式
+    :param n_frames: 出力の長さ(fmtのフレーム数)
+    :param frame_rate: 出力のサンプリングレート.fmtと異なる場合は書き出す直前に1回だけ変換する
+    """
+
+    def __init__(self, path: str, fmt: AudioFormat, n_frames: Optional[int] = None, frame_rate: Optional[int] = None):
+        if fmt.sample_width == 1:
+            raise ValueError("8bit wav is not supported")
+        self.fmt = fmt
+        self.n_frames = n_frames
+        self.output_fmt = AudioFormat(frame_rate or fmt.frame_rate, fmt.channels, fmt.sample_width)
+        self._resampler = None
+        if self.output_fmt.frame_rate != fmt.frame_rate:
+            self._resampler = Resampler(fmt.frame_rate, self.output_fmt.frame_rate, fmt.channels, fmt.dtype)
+        sink = _FfmpegSink if Path(path).suffix.lower() in ENCODERS else _WavSink
+        self._sink = sink(path, self.output_fmt)
+        self._written = 0
+        self._pending = np.zeros((0, fmt.channels), dtype=fmt.dtype)
+
+    def _output(self, samples: np.ndarray):
+        if len(samples) > 0:
+            self._sink.write(np.ascontiguousarray(samples).tobytes())
+
+    def _write(self, samples: np.ndarray):
+        if self.n_frames is not None:
+            samples = samples[: max(0, self.n_frames - self._written)]
+        if len(samples) == 0:
+            return
+        self._written += len(samples)
+        self._output(self._resampler.process(samples) if self._resampler else samples)
+
+    def _flush_until(self, frame: int):
+        # pendingの先頭はself._writtenに一致する
+        n = min(max(0, frame - self._written), len(self._pending))
+        self._write(self._pending[:n])
+        self._pending = self._pending[n:]
+        if frame > self._written:
+            self._write(np.zeros((frame - self._written, self.fmt.channels), dtype=self.fmt.dtype))
+
+    def mix(self, frame: int, samples: np.ndarray):
+        if frame < self._written:
+            raise ValueError(f"frame {frame} is already written(written={self._written})")
+        self._flush_until(frame)
+        offset = frame - self._written
+        need = offset + len(samples)
+        if need > len(self._pending):
+            grown = np.zeros((need, self.fmt.channels), dtype=self.fmt.dtype)
+            grown[: len(self._pending)] = self._pending
+            self._pending = grown
+        _saturate_add(self._pending[offset:need], samples)
+
+    def close(self):
+        self._write(self._pending)
+        self._pending = self._pending[:0]
+        if self.n_frames is not None and self._written < self.n_frames:
+            self._flush_until(self.n_frames)
+        if self._resampler:
+            self._output(self._resampler.flush())
+        self._sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+AudioSource = Union[str, AudioSegment, PcmClip]
+# 結合時に一度に変換,書き込むフレーム数
+CHUNK_FRAMES = 1 << 16
+
+
+def _source_format(source: AudioSource) -> AudioFormat:
+    if isinstance(source, AudioSegment):
+        return AudioFormat.of(source)
+    if isinstance(source, PcmClip):
+        return source.fmt
+    return audio_info(source).fmt
+
+
+def _segment_chunks(segment: AudioSegment, chunk_frames: int) -> Iterator[bytes]:
+    data = memoryview(segment.raw_data)
+    step = chunk_frames * segment.frame_width
+    for i in range(0, len(data), step):
+        yield bytes(data[i: i + step])
+
+
+def _source_chunks(source: AudioSource, chunk_frames: int) -> Iterator[Tuple[AudioFormat, bytes]]:
+    """
+    音声をchunk_framesフレームずつ返す
+    16,32bitのwavファイルはデコードせずに順に読む.それ以外の形式は1ファイル分デコードする
+    """
+    if isinstance(source, PcmClip):
+        for i in range(0, len(source.samples), chunk_frames):
+            yield source.fmt, source.samples[i: i + chunk_frames].tobytes()
+        return
+    if isinstance(source, str) and memory_audio.get(source) is not None:
+        yield from _source_chunks(memory_audio.get(source), chunk_frames)
+        return
+    if isinstance(source, str):
+        try:
+            with wave.open(source, "rb") as wav:
+                if wav.getsampwidth() in (2, 4) and wav.getcomptype() == "NONE":
+                    fmt = AudioFormat(wav.getframerate(), wav.getnchannels(), wav.getsampwidth())
+                    while data := wav.readframes(chunk_frames):
+                        yield fmt, data
+                    return
+        except (wave.Error, EOFError):
+            pass
+        source = AudioSegment.from_file(source)
+    fmt = AudioFormat.of(source)
+    for data in _segment_chunks(source, chunk_frames):
+        yield fmt, data
+
+
+class _ChunkConverter:
+    """
+    AudioSegment._syncと同じ順(channels -> frame_rate -> sample_width)でchunkごとに変換する
+    リサンプリングの状態はchunk間で引き継ぐため，音声全体を一度に変換した場合と同じ結果になる
+    """
+
+    def __init__(self, src: AudioFormat, dst: AudioFormat):
+        self.src = src
+        self.dst = dst
+        self._rate_state = None
+
+    def convert(self, data: bytes) -> bytes:
+        if self.src == self.dst:
+            return data
+        segment = AudioSegment(
+            data, frame_rate=self.src.frame_rate, sample_width=self.src.sample_width, channels=self.src.channels
+        ).set_channels(self.dst.channels)
+        data = segment.raw_data
+        if self.src.frame_rate != self.dst.frame_rate:
+            data, self._rate_state = audioop.ratecv(
+                data, self.src.sample_width, self.dst.channels, self.src.frame_rate, self.dst.frame_rate,
+                self._rate_state,
+            )
+        if self.src.sample_width != self.dst.sample_width:
+            data = audioop.lin2lin(data, self.src.sample_width, self.dst.sample_width)
+        return data
+
+
+def concatenate_to_wav(
+        sources: Sequence[AudioSource], output_path: str, fmt: Optional[AudioFormat] = None,
+        chunk_frames: int = CHUNK_FRAMES,
+) -> str:
+    """
+    音声を順番に結合しながらwavファイルへ書き出す
+    メモリ上に保持するのは1chunk分(wav以外の形式の場合は1ファイル分)のみ
+    :param sources: ファイルパス,AudioSegment,PcmClip
+    :param output_path:
+    :param fmt: 出力形式.Noneの場合はconcatenateと同様に最も大きい形式に揃える
+    :param chunk_frames:
+    :return: output_path
+    """
+    fmt = fmt or AudioFormat.sync([_source_format(s) for s in sources])
+    if fmt.sample_width == 1:
+        raise ValueError("8bit wav is not supported")
+    with wave.open(str(output_path), "wb") as output:
+        output.setnchannels(fmt.channels)
+        output.setsampwidth(fmt.sample_width)
+        output.setframerate(fmt.frame_rate)
+        for source in sources:
+            converter = None
+            for src_fmt, data in _source_chunks(source, chunk_frames):
+                converter = converter or _ChunkConverter(src_fmt, fmt)
+                output.writeframesraw(converter.convert(data))
+    return output_path
+
+
+def concatenate_to_file(sources: Sequence[AudioSource], output_path: str) -> str:
+    """
+    wavの場合はconcatenate_to_wavで逐次書き出す.それ以外の形式は結合してからエンコードする
+    """
+    if Path(output_path).suffix.lower() == ".wav":
+        fmt = AudioFormat.sync([_source_format(s) for s in sources])
+        if fmt.sample_width != 1:
+            return concatenate_to_wav(sources, output_path, fmt)
+    segments = (s if isinstance(s, AudioSegment) else s.to_segment() if isinstance(s, PcmClip)
+                else load_audio(s) for s in sources)
+    concatenate(segments).export(output_path, format=Path(output_path).suffix[1:] or "wav")
+    return output_path
+
 
 def concatenate(segment: Iterator[AudioSegment]) -> AudioSegment:
     """
     AudioSegmentを結合.
     時間は全体の長さになる
+    各音声を最も大きい形式に1回だけ変換し，まとめて連結する
     :param segment:
     :return:
     """
-    empty = AudioSegment.empty()
-    for audio in segment:
-        empty += audio
-    return empty
+    segments = list(segment)
+    if len(segments) == 0:
+        return AudioSegment.empty()
+    fmt = AudioFormat.sync([AudioFormat.of(s) for s in segments])
+    data = b"".join(_ChunkConverter(AudioFormat.of(s), fmt).convert(s.raw_data) for s in segments)
+    return AudioSegment(data, frame_rate=fmt.frame_rate, sample_width=fmt.sample_width, channels=fmt.channels)
 
 
 def concatenate_from_file(wav_files: Iterator[str]) -> AudioSegment:
@@ -1,10 +1,24 @@
-import copy
 import datetime
 import itertools
-from typing import Dict, List
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple
 
+import numpy as np
 from pydub import AudioSegment
 
+from zunda_w.audio import (
+    AudioFormat,
+    PcmCanvas,
+    WavStreamWriter,
+    as_array,
+    audio_info,
+    is_supported,
+    resample,
+)
 from zunda_w.srt_ops import SpeakerCompose
 
 
@@ -12,74 +26,274 @@ def millisecond(t: datetime.timedelta) -> float:
     return int(t.total_seconds() * 1000 + t.microseconds / 1000.0)
 
 
-def arrange(compose: SpeakerCompose) -> AudioSegment:
+@dataclass(frozen=True)
+class Placement:
+    # compose.unit上のindex
+    unit_index: int
+    start_ms: int
+    duration_ms: int
+
+
+def plan_arrange(compose: SpeakerCompose) -> List[Placement]:
     """
-    SpeakerComposeをAudioSegmentに再構成
+    各unitの音声の配置位置を計算する
+    音声は前から順番に隙間なく並べる
     :param compose:
     :return:
     """
-    ms = millisecond(compose.audio_duration)
-    empty = AudioSegment.silent(ms, 44100)
     next_sum = 0
-    start_point = []
-    zunda_duration = []
-    for unit in compose.unit:  # tqdm(compose.unit, desc='Audio composing', unit='wav'):
-        seg = unit.audio
-        if seg is None:
+    placements = []
+    for i, unit in enumerate(compose.unit):
+        if not unit.has_audio:
             continue
-        srt = unit.subtitle
-        srt_duration = millisecond((srt.end - srt.start))
-        duration = len(seg)  # millsecond(float)
-        scale = duration / float(srt_duration)
-        diff = duration - srt_duration
-        start_ms = next_sum
-        start_point.append(start_ms)
-        zunda_duration.append(duration)
+        # 長さはwavのヘッダから求める(デコードしない)
+        duration = unit.duration_ms
+        placements.append(Placement(i, next_sum, duration))
         next_sum += duration
-        empty = empty.overlay(seg, position=start_ms)
+    return placements
+
+
+# 旧実装(overlay)のキャンバスの形式
+LEGACY_FORMAT = AudioFormat(44100, 1, 2)
+
+
+def _arrange_format(
+        compose: SpeakerCompose, placements: Sequence[Placement], base_format: Optional[AudioFormat] = None
+) -> AudioFormat:
+    # クリップの形式(VOICEVOXの出力そのまま)に揃える.モノラルのクリップだけならモノラルのまま
+    formats = [base_format] if base_format else []
+    formats.extend(compose.unit[p.unit_index].audio_info.fmt for p in placements)
+    if len(formats) == 0:
+        return LEGACY_FORMAT
+    return AudioFormat.sync(formats)
+
+
+def arrange(
+        compose: SpeakerCompose,
+        engine: str = "buffer",
+        frame_rate: Optional[int] = None,
+        base_format: Optional[AudioFormat] = None,
+) -> AudioSegment:
+    """
+    SpeakerComposeをAudioSegmentに再構成
+    :param compose:
+    :param engine: buffer:確保済みバッファに書き込む, overlay:AudioSegment.overlayを繰り返す(旧実装)
+    :param frame_rate: 出力のサンプリングレート.Noneの場合はクリップのサンプリングレート
+    :param base_format: 配置する形式の下限.LEGACY_FORMATを指定するとoverlayと同じ出力になる
+    :return:
+    """
+    if engine == "overlay":
+        return _arrange_overlay(compose)
+    elif engine == "buffer":
+        return _arrange_buffer(compose, frame_rate, base_format)
+    raise ValueError(f"Unknown arrange engine: {engine}")
+
+
+def _arrange_overlay(compose: SpeakerCompose) -> AudioSegment:
+    ms = millisecond(compose.audio_duration)
+    empty = AudioSegment.silent(ms, LEGACY_FORMAT.frame_rate)
+    for p in plan_arrange(compose):  # tqdm(compose.unit, desc='Audio composing', unit='wav'):
+        empty = empty.overlay(compose.unit[p.unit_index].audio, position=p.start_ms)
     return empty
 
 
-def edit_from_yml(audio_files: List[str], blueprint: Dict) -> AudioSegment:
+def _arrange_buffer(
+        compose: SpeakerCompose, frame_rate: Optional[int], base_format: Optional[AudioFormat]
+) -> AudioSegment:
+    placements = plan_arrange(compose)
+    fmt = _arrange_format(compose, placements, base_format)
+    if not is_supported(fmt):
+        return _arrange_overlay(compose)
+    canvas = PcmCanvas(fmt, fmt.frame_count(millisecond(compose.audio_duration)))
+    for p in placements:
+        canvas.mix(fmt.frame_count(p.start_ms), compose.unit[p.unit_index].samples(fmt))
+    if frame_rate is None or frame_rate == fmt.frame_rate:
+        return canvas.to_segment()
+    # 配置し終えた音声全体を1回だけ変換する
+    samples = resample(canvas.buffer, fmt.frame_rate, frame_rate)
+    return AudioSegment(
+        samples.tobytes(), frame_rate=frame_rate, sample_width=fmt.sample_width, channels=fmt.channels
+    )
+
+
+def arrange_to_wav(
+        compose: SpeakerCompose,
+        output_path: str,
+        frame_rate: Optional[int] = None,
+        base_format: Optional[AudioFormat] = None,
+) -> str:
     """
-    予め指定されたyamlファイルから音声を合成する
-    :param audio_files:
+    SpeakerComposeを再構成しながらファイルへ逐次書き出す
+    メモリ上には出力全体を保持しない
+    拡張子が.flac,.opus,.oggの場合はffmpegでエンコードしながら書き出す
+    :param compose:
+    :param output_path:
+    :param frame_rate: 出力のサンプリングレート.Noneの場合はクリップのサンプリングレート
+    :param base_format: 配置する形式の下限
+    :return: output_path
+    """
+    placements = plan_arrange(compose)
+    fmt = _arrange_format(compose, placements, base_format)
+    if not is_supported(fmt):
+        segment = _arrange_overlay(compose)
+        if frame_rate:
+            segment = segment.set_frame_rate(frame_rate)
+        segment.export(output_path, format=Path(output_path).suffix[1:] or "wav")
+        return output_path
+    n_frames = fmt.frame_count(millisecond(compose.audio_duration))
+    with WavStreamWriter(output_path, fmt, n_frames, frame_rate) as writer:
+        for p in placements:
+            writer.mix(fmt.frame_count(p.start_ms), compose.unit[p.unit_index].samples(fmt))
+    return output_path
+
+
+@dataclass(frozen=True)
+class TimelineEntry:
+    """
+    editorモードの出力上に配置する1つの音声
+    """
+
+    source: str
+    # 出力上の開始位置(フレーム)
+    offset: int
+    # 出力の形式に変換した後の長さ(フレーム)
+    n_frames: int
+    gain_db: float = 0.0
+
+
+@dataclass(frozen=True)
+class EditPlan:
+    fmt: AudioFormat
+    entries: List[TimelineEntry]
+    n_frames: int
+
+
+def _component_body(component: Dict) -> Tuple[str, Dict]:
+    if len(component) != 1:
+        raise ValueError(f"component must have exactly one key: {list(component.keys())}")
+    key = list(component.keys())[0]
+    return key, component[key]
+
+
+def plan_edit(audio_files: List[str], blueprint: Dict) -> EditPlan:
+    """
+    yamlのcomponentsを(音声,開始位置,gain)の並びに解決する
+    audio_placeholderへのファイルの割り当て,ファイルの有無を確認してから長さを求める
+    長さはwavのヘッダから求めるため，音声はデコードしない
+    同じindexのaudio_placeholderは同じ位置に重ね，最も長い音声の分だけ進める
+    :param audio_files: var番目のaudio_placeholderに割り当てるファイル
     :param blueprint:
-    :return: 合成した音声ファイルのパス
+    :return:
     """
-    components = copy.deepcopy(blueprint["components"])
-    placeholders = list(filter(lambda x: "audio_placeholder" in x, components))
+    components = [_component_body(c) for c in blueprint["components"]]
+    placeholders = [body for key, body in components if key == "audio_placeholder"]
     # ファイルをPlaceholderに割り当て
+    paths: Dict[int, Optional[str]] = {}
     for var, audio_file in enumerate(audio_files):
-        if target := next(filter(lambda x: x["audio_placeholder"]["var"] == var, placeholders)):
-            target["audio_placeholder"]["path"] = audio_file
+        target = next((i for i, p in enumerate(placeholders) if p["var"] == var), None)
+        if target is None:
+            raise ValueError(f"No audio placeholder for var:{var} ({audio_file})")
+        paths[target] = audio_file
     # ファイルが割り当てられていない場合はエラー
-    if any(filter(lambda x: x["audio_placeholder"]["path"] is None, placeholders)):
+    if len(paths) < len(placeholders):
         raise ValueError("Not all audio files are assigned")
-    # indexが同じものをmerge
-    for index, group in itertools.groupby(placeholders, key=lambda x: x["audio_placeholder"]["index"]):
-        group = list(group)
-        if len(group) > 1:
-            files = [x["audio_placeholder"]["path"] for x in group]
-            sounds = list(map(AudioSegment.from_file, files))
-            max_length = max(len(sound) for sound in sounds)
-            for i, sound in enumerate(sounds):
-                if len(sound) < max_length:
-                    sounds[i] += AudioSegment.silent(duration=max_length - len(sound))
-            merged = sounds[0]
-            for sound in sounds[1:]:
-                merged = merged.overlay(sound)
-            group[0]["audio_placeholder"]["path"] = merged
-            for other in group[1:]:
-                other["audio_placeholder"]["path"] = None
-        else:
-            pass
-    # 合成
-    export = AudioSegment.empty()
-    for component in filter(lambda x: x[list(x.keys())[0]]["path"] is not None, components):
-        key = list(component.keys())[0]
-        if isinstance(component[key]["path"], str):
-            export += AudioSegment.from_file(component[key]["path"])
-        elif isinstance(component[key]["path"], AudioSegment):
-            export += component[key]["path"]
-    return export
+    # 出力順の(音声,gain)のグループ.indexが同じplaceholderは1つのグループにまとめる
+    groups: List[List[Tuple[str, float]]] = []
+    placeholder_groups = itertools.groupby(enumerate(placeholders), key=lambda x: x[1]["index"])
+    merged = {group[0][0]: group for group in (list(g) for _, g in placeholder_groups)}
+    n_placeholder = 0
+    for key, body in components:
+        if key == "audio_placeholder":
+            if n_placeholder in merged:
+                groups.append([(paths[i], float(p.get("gain", 0))) for i, p in merged[n_placeholder]])
+            n_placeholder += 1
+        elif body.get("path") is not None:
+            groups.append([(str(body["path"]), float(body.get("gain", 0)))])
+    missing = sorted({path for group in groups for path, _ in group if not os.path.exists(path)})
+    if missing:
+        raise FileNotFoundError(f"audio files not found: {missing}")
+    infos = {path: audio_info(path) for group in groups for path, _ in group}
+    if len(infos) == 0:
+        return EditPlan(AudioFormat(44100, 1, 2), [], 0)
+    # AudioSegmentの結合と同じく最も大きい形式に揃える(8bitは16bitとして扱う)
+    fmt = AudioFormat.sync([AudioFormat(1, 1, 2), *(info.fmt for info in infos.values())])
+    entries = []
+    offset = 0
+    for group in groups:
+        group_frames = 0
+        for path, gain in group:
+            n_frames = fmt.converted_frames(infos[path].n_frames, infos[path].fmt)
+            entries.append(TimelineEntry(path, offset, n_frames, gain))
+            group_frames = max(group_frames, n_frames)
+        offset += group_frames
+    return EditPlan(fmt, entries, offset)
+
+
+def _decode_entry(entry: TimelineEntry, fmt: AudioFormat) -> np.ndarray:
+    samples = as_array(AudioSegment.from_file(entry.source), fmt)
+    if entry.gain_db != 0:
+        # AudioSegment.apply_gainと同様に飽和させる
+        info = np.iinfo(fmt.dtype)
+        scaled = np.floor(samples * (10 ** (entry.gain_db / 20)))
+        samples = np.clip(scaled, info.min, info.max).astype(fmt.dtype)
+    return samples
+
+
+def _decode_in_order(plan: EditPlan, n_workers: int) -> Iterator[Tuple[TimelineEntry, np.ndarray]]:
+    """
+    音声をn_workersのスレッドで並列にデコードし，entriesの順に返す
+    先読みはn_workers個までとし，デコード済みの音声を溜め込まない
+    """
+    n_workers = max(1, n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending: Deque[Tuple[TimelineEntry, Future]] = deque()
+        for entry in plan.entries:
+            pending.append((entry, executor.submit(_decode_entry, entry, plan.fmt)))
+            if len(pending) > n_workers:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+
+def render_edit(plan: EditPlan, n_workers: int = 4) -> AudioSegment:
+    """
+    EditPlanを確保済みの1つのバッファに書き込む
+    """
+    if len(plan.entries) == 0:
+        return AudioSegment.empty()
+    canvas = PcmCanvas(plan.fmt, plan.n_frames)
+    for entry, samples in _decode_in_order(plan, n_workers):
+        canvas.mix(entry.offset, samples)
+    return canvas.to_segment()
+
+
+def render_edit_to_wav(plan: EditPlan, output_path: str, n_workers: int = 4) -> str:
+    """
+    EditPlanを確定した区間からwavファイルへ書き出す
+    メモリ上に保持するのは先読み中の音声と未確定の区間のみ
+    """
+    with WavStreamWriter(output_path, plan.fmt, plan.n_frames) as writer:
+        for entry, samples in _decode_in_order(plan, n_workers):
+            writer.mix(entry.offset, samples)
+    return output_path
+
+
+def edit_from_yml(audio_files: List[str], blueprint: Dict, n_workers: int = 4) -> AudioSegment:
+    """
+    予め指定されたyamlファイルから音声を合成する
+    :param audio_files:
+    :param blueprint:
+    :param n_workers: デコードするスレッド数
+    :return: 合成した音声
+    """
+    return render_edit(plan_edit(audio_files, blueprint), n_workers)
+
+
+def edit_from_yml_to_wav(audio_files: List[str], blueprint: Dict, output_path: str, n_workers: int = 4) -> str:
+    """
+    edit_from_ymlの結果をwavファイルへ逐次書き出す
+    :return: output_path
+    """
+    return render_edit_to_wav(plan_edit(audio_files, blueprint), output_path, n_workers)
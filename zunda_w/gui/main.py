@@ -11,13 +11,13 @@ from loguru import logger
 from omegaconf import OmegaConf, SCMode
 
 import rs_downloader
-from zunda_w import file_hash
 from zunda_w.apis import hackmd, share
 from zunda_w.arg import Options
 from zunda_w.constants import list_preset
-from zunda_w.edit import edit_from_yml
+from zunda_w.edit import edit_from_yml_to_wav
 from zunda_w.etc.fille import increment_file
 from zunda_w.etc.timer import Timer
+from zunda_w.hash import cached_file_hash
 from zunda_w.llm import create_podcast_title, shownote, create_blog_categories
 from zunda_w.postprocess import normalize
 from zunda_w.srt_ops import sort_srt_files, srt_as_interview_blog_content
@@ -73,9 +73,8 @@ def convert(files, preset: str, publish_preset: str, output_dir: str, root_dir:
         # TODO 文字おこしの時系列順でショーノートを作る
         conf.preset = preset
         conf = OmegaConf.to_container(conf, structured_config_mode=SCMode.INSTANTIATE)
-        _audio = edit_from_yml(files, publish_conf)
         output_audio = conf.tool_output("mix.wav")
-        _audio.export(output_audio, format="wav")
+        edit_from_yml_to_wav(files, publish_conf, output_audio)
         normalize.ffmpeg_normalize(output_audio, output_audio)
         conf.audio_files = [output_audio]
         print(output_audio)
@@ -85,8 +84,8 @@ def convert(files, preset: str, publish_preset: str, output_dir: str, root_dir:
         )
         with whisper_context(), Timer() as t:
             stt_files = []
+            audio_hash = cached_file_hash(output_audio, conf.data_dir, conf.hash_algorithm)
             for idx, (original_audio, speaker_id) in enumerate(zip(files, conf.speakers)):
-                audio_hash = file_hash(output_audio)
                 stt_file = list(
                     transcribe_with_config(
                         [original_audio],
@@ -1,6 +1,13 @@
-from typing import Dict, List, Sequence
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
 
-from zunda_w.util import text_hash
+from zunda_w.util import file_hash, new_hash, text_hash
+
+HASH_DB = "file_hash.sqlite"
 
 
 def concat_hash(data: Sequence[str]) -> str:
@@ -15,3 +22,80 @@ def concat_hash(data: Sequence[str]) -> str:
 
 def dict_hash(data: Dict) -> str:
     return "".join((map(lambda x: str(x[0]) + str(x[1]), (sorted(data.items())))))
+
+
+def _stat_key(path: Union[str, Path]) -> Tuple[str, int, int, int]:
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class FileHashCache:
+    """
+    (パス,サイズ,mtime_ns,inode,アルゴリズム) -> ハッシュ値 をsqliteに保存する
+    ファイルが変わっていなければ再計算しない
+    :param db_path:
+    """
+
+    def __init__(self, db_path: str):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._memory: Dict[Tuple, str] = {}
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, "
+            "algorithm TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (path, algorithm))"
+        )
+        self._db.commit()
+
+    def file_hash(self, path: Union[str, Path], hash_fun: Union[str, Callable] = hashlib.md5) -> str:
+        algorithm = new_hash(hash_fun).name
+        abspath, size, mtime_ns, inode = _stat_key(path)
+        key = (abspath, size, mtime_ns, inode, algorithm)
+        digest = self._memory.get(key)
+        if digest is not None:
+            return digest
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, inode, digest FROM hashes WHERE path = ? AND algorithm = ?",
+                (abspath, algorithm),
+            ).fetchone()
+        if row is not None and tuple(row[:3]) == (size, mtime_ns, inode):
+            digest = row[3]
+        else:
+            digest = file_hash(path, hash_fun)
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO hashes (path, size, mtime_ns, inode, algorithm, digest) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (abspath, size, mtime_ns, inode, algorithm, digest),
+                )
+                self._db.commit()
+        self._memory[key] = digest
+        return digest
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_file_hash_caches: Dict[str, FileHashCache] = {}
+_file_hash_caches_lock = threading.Lock()
+
+
+def cached_file_hash(
+        path: Union[str, Path], cache_dir: Optional[str] = None, hash_fun: Union[str, Callable] = hashlib.md5
+) -> str:
+    """
+    file_hashの結果をcache_dir/file_hash.sqliteにキャッシュする
+    cache_dirがNoneの場合はキャッシュせずに計算する
+    """
+    if cache_dir is None:
+        return file_hash(path, hash_fun)
+    db_path = os.path.abspath(os.path.join(cache_dir, HASH_DB))
+    with _file_hash_caches_lock:
+        if db_path not in _file_hash_caches:
+            _file_hash_caches[db_path] = FileHashCache(db_path)
+        cache = _file_hash_caches[db_path]
+    return cache.file_hash(path, hash_fun)
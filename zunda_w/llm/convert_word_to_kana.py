@@ -1,13 +1,19 @@
+import os
 import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Sequence
+from typing import Dict, List, Optional, Sequence
 
 import srt
 
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import HumanMessage, SystemMessage
 from loguru import logger
+from more_itertools import chunked
+
+from zunda_w import cache
 from zunda_w.postprocess.srt import tag
 
 
@@ -18,31 +24,222 @@ def contains_alphabet(text) -> bool:
 # https://platform.openai.com/playground/p/KxUoo02lAi0vyTZwW4sIfB13?model=gpt-4
 
 MODEL_NAME = "gpt-4o"
+SENTENCE_PROMPT = "Please convert the English words that appear in the sentence into katakana.\n\n\n# Example\n\n#Input\nそういうWebアプリがありまして、何でこれを探してた、\n\n#Output\nそういうウェブアプリがありまして、何でこれを探してた、\n\n"
+WORD_PROMPT = "Please convert each English word into katakana.\nAnswer every line in the same order as `number: katakana`.\n\n\n# Example\n\n#Input\n1: Web\n2: Python\n\n#Output\n1: ウェブ\n2: パイソン\n\n"
+WORD_PATTERN = re.compile(r"[A-Za-z][A-Za-z0-9]*(?:['.\-+#][A-Za-z0-9+#]+)*")
+_ANSWER_PATTERN = re.compile(r"^\s*(\d+)\s*[:：.]\s*(.+?)\s*$")
+
+
+def sentence_messages(text: str) -> list:
+    return [SystemMessage(content=SENTENCE_PROMPT), HumanMessage(content=f"# Input\n{text}\n\n#Output")]
+
+
+def word_messages(words: Sequence[str]) -> list:
+    lines = "\n".join(f"{i + 1}: {w}" for i, w in enumerate(words))
+    return [SystemMessage(content=WORD_PROMPT), HumanMessage(content=f"# Input\n{lines}\n\n#Output")]
 
 
-def word_to_kana(srt_file: str) -> str:
+def parse_word_answer(answer: str, words: Sequence[str]) -> Dict[str, str]:
+    """
+    `番号: カナ` の行を単語ごとに対応付ける.番号が無い行や範囲外の番号は無視する
+    """
+    result = {}
+    for line in answer.splitlines():
+        m = _ANSWER_PATTERN.match(line)
+        if m is None:
+            continue
+        idx = int(m.group(1)) - 1
+        if 0 <= idx < len(words) and not contains_alphabet(m.group(2)):
+            result[words[idx]] = m.group(2)
+    return result
+
+
+class KanaCache:
+    """
+    文章ごと,単語ごとの変換結果をsqliteに保存する.エピソードをまたいで同じ単語をLLMに送らない
+    :param db_path:
+    :param model_name: 変換に使ったモデル.モデルごとに別の結果として扱う
+    """
+
+    def __init__(self, db_path: str, model_name: str = MODEL_NAME):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        for table in ("sentences", "words"):
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "model TEXT NOT NULL, text TEXT NOT NULL, kana TEXT NOT NULL, PRIMARY KEY (model, text))"
+            )
+        self._db.commit()
+
+    def _get(self, table: str, texts: Sequence[str]) -> Dict[str, str]:
+        result = {}
+        with self._lock:
+            for text in set(texts):
+                row = self._db.execute(
+                    f"SELECT kana FROM {table} WHERE model = ? AND text = ?", (self.model_name, text)
+                ).fetchone()
+                if row is not None:
+                    result[text] = row[0]
+        return result
+
+    def _put(self, table: str, data: Dict[str, str]):
+        with self._lock:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {table} (model, text, kana) VALUES (?, ?, ?)",
+                [(self.model_name, k, v) for k, v in data.items()],
+            )
+            self._db.commit()
+
+    def get_sentences(self, texts: Sequence[str]) -> Dict[str, str]:
+        return self._get("sentences", texts)
+
+    def put_sentences(self, data: Dict[str, str]):
+        self._put("sentences", data)
+
+    def get_words(self, words: Sequence[str]) -> Dict[str, str]:
+        return self._get("words", words)
+
+    def put_words(self, data: Dict[str, str]):
+        self._put("words", data)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _invoke(llm, messages: list) -> str:
+    return llm.invoke(messages).content
+
+
+def convert_sentences(
+        texts: Sequence[str],
+        llm=None,
+        kana_cache: Optional[KanaCache] = None,
+        mode: str = "sentence",
+        max_concurrency: int = 8,
+        words_per_prompt: int = 50,
+) -> List[str]:
+    """
+    英単語をカナに変換する
+    :param texts:
+    :param llm: invoke(messages).contentを返すチャットモデル
+    :param kana_cache:
+    :param mode: "sentence" 文章ごとにLLMに送る.単語ごとのキャッシュにある英単語は置き換えてから送り，全て置き換えられた文章は送らない.
+        "word" 英単語だけを抜き出し,まとめて1つのプロンプトで変換する
+    :param max_concurrency: LLMへの同時リクエスト数
+    :param words_per_prompt: mode="word"で1つのプロンプトに入れる単語数
+    :return: textsと同じ順番の変換結果
+    """
+    if mode not in ("sentence", "word"):
+        raise ValueError(f"Unknown mode:{mode}")
+    llm = llm or ChatOpenAI(temperature=0, model_name=MODEL_NAME)
+    results: Dict[str, str] = kana_cache.get_sentences(texts) if kana_cache else {}
+    new_texts = list(dict.fromkeys(t for t in texts if t not in results))
+    logger.debug(f"word2kana: {len(texts) - len(new_texts)} cached / {len(texts)} sentences")
+    if new_texts:
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+            if mode == "sentence":
+                converted = _convert_sentences(new_texts, llm, kana_cache, pool)
+                cacheable = converted
+            else:
+                converted = _convert_words(new_texts, llm, kana_cache, pool, words_per_prompt)
+                # 変換できなかった英単語が残っている文章はキャッシュしない
+                cacheable = {k: v for k, v in converted.items() if not contains_alphabet(v)}
+        results.update(converted)
+        if kana_cache:
+            kana_cache.put_sentences(cacheable)
+    return [results[t] for t in texts]
+
+
+def _convert_sentences(
+        texts: Sequence[str], llm, kana_cache: Optional[KanaCache], pool: ThreadPoolExecutor
+) -> Dict[str, str]:
+    """
+    単語ごとのキャッシュにある英単語を先にカナに置き換え，英単語が残った文章だけを1文ずつLLMで変換する
+    """
+    words = list(dict.fromkeys(w for t in texts for w in WORD_PATTERN.findall(t)))
+    kana = kana_cache.get_words(words) if kana_cache else {}
+    filled = {t: WORD_PATTERN.sub(lambda m: kana.get(m.group(0), m.group(0)), t) for t in texts}
+    converted = {t: f for t, f in filled.items() if not contains_alphabet(f)}
+    new_texts = [t for t in texts if t not in converted]
+    logger.debug(f"word2kana: {len(converted)} filled from word cache / {len(texts)} sentences")
+    answers = pool.map(lambda t: _invoke(llm, sentence_messages(filled[t])), new_texts)
+    converted.update(zip(new_texts, answers))
+    return converted
+
+
+def _convert_words(
+        texts: Sequence[str], llm, kana_cache: Optional[KanaCache], pool: ThreadPoolExecutor, words_per_prompt: int
+) -> Dict[str, str]:
+    """
+    英単語を重複なく抜き出し，キャッシュに無いものだけをwords_per_promptずつLLMで変換して文章を置き換える
+    """
+    words = list(dict.fromkeys(w for t in texts for w in WORD_PATTERN.findall(t)))
+    kana = kana_cache.get_words(words) if kana_cache else {}
+    new_words = [w for w in words if w not in kana]
+    logger.debug(f"word2kana: {len(words) - len(new_words)} cached / {len(words)} words")
+    batches = list(chunked(new_words, max(1, words_per_prompt)))
+    answers = pool.map(lambda batch: parse_word_answer(_invoke(llm, word_messages(batch)), batch), batches)
+    new_kana = {}
+    for answer in answers:
+        new_kana.update(answer)
+    if kana_cache and new_kana:
+        kana_cache.put_words(new_kana)
+    kana.update(new_kana)
+    missing = [w for w in new_words if w not in kana]
+    if missing:
+        logger.warning(f"word2kana: not converted {missing}")
+    return {t: WORD_PATTERN.sub(lambda m: kana.get(m.group(0), m.group(0)), t) for t in texts}
+
+
+def word_to_kana_subtitles(
+        subtitles: List[srt.Subtitle],
+        llm=None,
+        kana_cache: Optional[KanaCache] = None,
+        mode: str = "sentence",
+        max_concurrency: int = 8,
+) -> List[srt.Subtitle]:
     """
     ChatGPTを使って英単語をカナに変換．
     API仕様にあたって，料金が発生するため，英文字が存在しているセンテンスに限定して，処理を行う．
-    :param srt_file:
+    変換結果は~/.cache/zunda_w/word2kana.sqliteにキャッシュする.
+    :param subtitles:
+    :param llm:
+    :param kana_cache:
+    :param mode: convert_sentences参照
+    :param max_concurrency: convert_sentences参照
     :return:
     """
     logger.debug("Convert English word to カナ with ChatGPT API.")
-    srts: Sequence[srt.Subtitle] = list(srt.parse(Path(srt_file).read_text()))
-    chat = ChatOpenAI(temperature=0, model_name=MODEL_NAME)
-    chat_prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessage(
-                content="Please convert the English words that appear in the sentence into katakana.\n\n\n# Example\n\n#Input\nそういうWebアプリがありまして、何でこれを探してた、\n\n#Output\nそういうウェブアプリがありまして、何でこれを探してた、\n\n"
-            ),
-            HumanMessagePromptTemplate.from_template("# Input\n{input}\n\n#Output"),
-        ]
-    )
     target_subtitles = list(
-        filter(lambda stt: contains_alphabet(stt.content) and not tag.contain_any_tag(stt.content), srts))
-    for s in target_subtitles:
-        s.content = chat(
-            chat_prompt.format_prompt(input=s.content).to_messages()
-        ).content
+        filter(lambda stt: contains_alphabet(stt.content) and not tag.contain_any_tag(stt.content), subtitles))
+    if len(target_subtitles) == 0:
+        return subtitles
+    close_cache = kana_cache is None
+    if kana_cache is None:
+        kana_cache = KanaCache(os.path.join(cache.user_cache_dir("zunda_w"), "word2kana.sqlite"))
+    try:
+        converted = convert_sentences(
+            [s.content for s in target_subtitles],
+            llm,
+            kana_cache,
+            mode=mode,
+            max_concurrency=max_concurrency,
+        )
+    finally:
+        if close_cache:
+            kana_cache.close()
+    for s, content in zip(target_subtitles, converted):
+        s.content = content
+    return subtitles
+
+
+def word_to_kana(
+        srt_file: str, llm=None, kana_cache: Optional[KanaCache] = None, mode: str = "sentence", max_concurrency: int = 8
+) -> str:
+    srts: List[srt.Subtitle] = list(srt.parse(Path(srt_file).read_text()))
+    word_to_kana_subtitles(srts, llm, kana_cache, mode, max_concurrency)
     Path(srt_file).write_text(srt.compose(srts, reindex=False))
     return srt_file
@@ -1,19 +1,21 @@
+import contextlib
 import dataclasses
 import os
-import shutil
+from functools import partial
 from pathlib import Path
-from typing import Any, Iterator, List, Optional, Tuple
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple, Union
 
+import srt
 from loguru import logger
 from omegaconf import OmegaConf, SCMode
-from pydub import AudioSegment
 
-from zunda_w import SpeakerCompose, edit, file_hash, merge, silent
+from zunda_w import SpeakerCompose, edit, merge, stt_pool
 from zunda_w.arg import Options
-from zunda_w.audio import concatenate_from_file
+from zunda_w.audio import concatenate_to_file, memory_audio
 from zunda_w.constants import update_preset
 from zunda_w.etc import alert
-from zunda_w.postprocess.srt import postprocess as srt_postprocess
+from zunda_w.pipeline import BackgroundWriter, Stage
+from zunda_w.postprocess.srt.postprocess import PostProcessOptions
 from zunda_w.srt_ops import sort_srt_files
 from zunda_w.util import (
     file_uri,
@@ -21,11 +23,9 @@ from zunda_w.util import (
     write_srt,
 )
 from zunda_w.voicevox import download_voicevox, voice_vox
-from zunda_w.transcribe import (
-    transcribe_non_silence_srt,
-    transcribe_with_config,
-    whisper_context,
-)
+from zunda_w.voicevox.engine_daemon import shared_engines
+from zunda_w.voicevox.pool import EnginePool
+from zunda_w.voicevox.tts_cache import CACHE_DB, TtsCache, user_dict_version
 from zunda_w.words import WordFilter
 
 
@@ -47,7 +47,6 @@ def main(arg: Options) -> Iterator[Tuple[str, Optional[Any]]]:
     logger.info("Parameters:")
     logger.info(OmegaConf.to_yaml(arg))
     arg = OmegaConf.to_container(arg, structured_config_mode=SCMode.INSTANTIATE)
-    voicevox_process = None
     cache_tts = ".tts"
     cache_general_vv = ".cache/.voicevox"
     sort_srt: bool = True
@@ -65,75 +64,126 @@ def main(arg: Options) -> Iterator[Tuple[str, Optional[Any]]]:
     audio_hashes = []
 
     # speech to text
-    with whisper_context():
-        for idx, (original_audio, speaker_id) in enumerate(zip(audio_files, speakers)):
-            audio_hash = file_hash(original_audio)
-            cache_dir = os.path.join(arg.data_dir, audio_hash)
-            logger.debug("speech to text")
-            post_process: bool = False
-            # srtファイルをそのまま返す
-            if Path(original_audio).suffix == ".srt":
-                logger.debug("Skip Speech to Text : it's srt file")
-                stt_file = shutil.copy(original_audio, arg.tmp_file)
+    stt_tasks = [
+        stt_pool.SttTask(
+            idx,
+            original_audio,
+            speaker_id,
+            arg.data_dir,
+            whisper_profile,
+            arg.tmp_dir,
+            no_detect_silence=arg.no_detect_silence,
+            keep_silence_segments=arg.keep_silence_segments,
+            ginza=arg.ginza,
+            post_processes=tuple(arg.post_processes),
+            post_process_options=PostProcessOptions(
+                emotion_backend=arg.emotion_backend,
+                word2kana_mode=arg.word2kana_mode,
+                word2kana_concurrency=arg.word2kana_concurrency,
+            ),
+            hash_algorithm=arg.hash_algorithm,
+        )
+        for idx, (original_audio, speaker_id) in enumerate(zip(audio_files, speakers))
+    ]
+
+    def speech_to_text(on_chunk: Callable[[stt_pool.SttChunk], None]) -> Iterator[Tuple[int, str, str]]:
+        nonlocal sort_srt
+        for result in stt_pool.run(stt_tasks, n_workers=arg.stt_workers, on_chunk=on_chunk):
+            if result.is_srt:
                 sort_srt = False
-            # オリジナル音声の用意
-            elif arg.no_detect_silence:
-                # 文字起こし
-                stt_file = list(
-                    transcribe_with_config(
-                        [original_audio],
-                        whisper_profile,
-                        root_dir=cache_dir,
-                        meta_data=str(speaker_id),
-                    )
-                )[0]
-                post_process = True
-            # オリジナル音声の無音区間を切り抜き
-            else:
-                # Tuple[meta],Tuple[audio]
-                meta, silent_audio = silent.divide_by_silence(
-                    original_audio, root_dir=cache_dir
-                )
-                # 切り抜き音声から文字おこし
-                stt_file = transcribe_non_silence_srt(
-                    silent_audio,
-                    meta,
-                    whisper_profile,
-                    cache_dir,
-                    meta_data=str(speaker_id),
-                )
-                post_process = True
-            if post_process:
-                # TODO srt_postprocessに移動
-                stt_file = arg.ginza.reconstruct(stt_file, encoding="utf-8")
-
-            if len(arg.post_processes) > 0:
-                plain_stt_files.append(shutil.copy(stt_file, arg.tmp_file))
-            # １# TODO Postprocessの結果がキャッシュにも反映されているため，キャッシュの値が変わってしまうと中身が毎回同じ結果にならない
-            srt_postprocess.post_process(stt_file, arg.post_processes)
-            stt_files.append(stt_file)
-            audio_hashes.append(audio_hash)
+            if result.plain_stt_file is not None:
+                plain_stt_files.append(result.plain_stt_file)
+            stt_files.append(result.stt_file)
+            audio_hashes.append(result.audio_hash)
+            yield result.index, result.stt_file, result.audio_hash
 
     word_filter = WordFilter(arg.word_filter)
     # text to speech
-    with voice_vox.voicevox_engine(
-            download_voicevox.extract_engine(root_dir=arg.engine_dir)):
-        # textファイルを speechする
-        voice_vox.import_word_csv(arg.user_dict)
-        tts_file_list: List[List[str]] = []
+    tts_cache = TtsCache(os.path.join(arg.data_dir, CACHE_DB), max_bytes=arg.tts_cache_max_mb * 1024 * 1024 or None)
+    dict_version = user_dict_version(arg.user_dict)
+    tts_file_list: List[List[str]] = []
+    # 合成した音声は別スレッドで書き込み,全トラックの合成後にまとめてsyncする
+    tts_writer = BackgroundWriter()
+    with contextlib.ExitStack() as engine_stack:
+        tts_client: Optional[EnginePool] = None
 
-        for idx, (stt_file, audio_hash) in enumerate(zip(stt_files, audio_hashes)):
-            logger.debug(f"text to speech {stt_file}")
+        def engine() -> EnginePool:
+            nonlocal tts_client
+            if tts_client is None:
+                # 合成が必要になった時点でengineを起動する
+                if arg.tts_engine_urls:
+                    engine_urls = list(arg.tts_engine_urls)
+                else:
+                    # 常駐しているengineがあれば起動せずに使う
+                    engine_urls = engine_stack.enter_context(
+                        shared_engines(
+                            lambda: download_voicevox.extract_engine(root_dir=arg.engine_dir),
+                            n_engines=arg.tts_engines,
+                            idle_timeout=arg.engine_idle_timeout,
+                        )
+                    )
+                tts_client = engine_stack.enter_context(
+                    EnginePool(engine_urls, max_in_flight=arg.tts_max_in_flight, batch_size=arg.tts_batch_size)
+                )
+                # textファイルを speechする
+                voice_vox.import_word_csv(arg.user_dict, base_urls=engine_urls)
+            return tts_client
+
+        def synthesize(srt_file: Union[str, Sequence[srt.Subtitle]], idx: int, audio_hash: str) -> List[str]:
             # voicevoxによる音声合成
             cache_dir = os.path.join(arg.data_dir, audio_hash)
-            tts_files = voice_vox.run(
-                stt_file,
+            return voice_vox.run(
+                srt_file,
                 root_dir=cache_dir,
                 output_dir=cache_tts,
                 query=voicevox_profiles[idx],
+                client=engine(),
+                tts_cache=tts_cache,
+                dict_version=dict_version,
+                writer=tts_writer,
+                keep_in_memory=arg.tts_in_memory,
             )
-            tts_file_list.append(tts_files)
-            yield "Text to Speech(Voicevox)", tts_files
+
+        def prefetch(chunk: stt_pool.SttChunk) -> None:
+            # 文字起こし中のトラックの確定した行を先に合成する.結果はtts_cacheに入り，トラックの合成で使われる
+            lines = stt_pool.chunk_subtitles(stt_tasks[chunk.index], chunk)
+            if len(lines) > 0:
+                logger.debug(f"text to speech [{chunk.index}] {len(lines)} lines while transcribing")
+                synthesize(lines, chunk.index, chunk.audio_hash)
+
+        def text_to_speech(track: Tuple[int, str, str]) -> List[str]:
+            idx, stt_file, audio_hash = track
+            # 先に合成した行のtts_cacheへの登録を待つ
+            tts_writer.flush()
+            # 全て合成済みならengineを使わない
+            tts_files = voice_vox.lookup_cache(
+                stt_file, tts_cache, query=voicevox_profiles[idx], dict_version=dict_version
+            )
+            if tts_files is not None:
+                logger.debug(f"text to speech {stt_file} : all lines are found in tts cache")
+                return tts_files
+            logger.debug(f"text to speech {stt_file}")
+            return synthesize(stt_file, idx, audio_hash)
+
+        def tts_events(results: Iterator[Optional[List[str]]]) -> Iterator[Tuple[str, List[str]]]:
+            for tts_files in results:
+                # 途中結果の合成(prefetch)はNoneを返す
+                if tts_files is not None:
+                    tts_file_list.append(tts_files)
+                    yield "Text to Speech(Voicevox)", tts_files
+
+        # 文字起こしの途中結果の行とトラックごとの結果を1つのスレッドで順に合成し，文字起こしと重ねる.
+        # トラックの合成の時点で先に合成した行はtts_cacheにあるので，残りの行だけを合成する
+        with Stage(lambda job: job(), name="tts") as tts_stage:
+            for track in speech_to_text(lambda chunk: tts_stage.put(partial(prefetch, chunk))):
+                tts_stage.put(partial(text_to_speech, track))
+                yield from tts_events(tts_stage.ready())
+            yield from tts_events(tts_stage.results())
+    tts_writer.close()
+    logger.debug(f"tts writer: {tts_writer.n_files} files {tts_writer.n_bytes / 1024 / 1024:.1f}MB")
+    logger.debug(f"tts cache:\n{tts_cache.stats()}")
+    tts_cache.evict()
+    tts_cache.close()
 
     # srt,audioのソート
     logger.debug("sort srt and audio")
@@ -158,19 +208,17 @@ def main(arg: Options) -> Iterator[Tuple[str, Optional[Any]]]:
         write_srt(output_prev_srt, psf_compose.srt)
         # 後処理前のsttファイルと後処理後のttsファイルを組み合わせてcompose.jsonを作成
         write_json(merge(plain_stt_files, tts_file_list, word_filter=word_filter).to_json(), output_prev_compose_json)
-    arrange_sound: AudioSegment = edit.arrange(compose)
     logger.debug(f"export directory {file_uri(str(Path(output_srt).parent))}")
     logger.debug(f"export arrange audio to '{file_uri(output_wav)}'", end="")
-    arrange_sound.export(output_wav)
+    frame_rate = arg.arrange_frame_rate or voice_vox.output_sampling_rate(voicevox_profiles)
+    edit.arrange_to_wav(compose, str(output_wav), frame_rate)
+    memory_audio.clear()
     logger.debug(f"export compose json to {file_uri(output_compose_json)}")
     write_json(compose.to_json(), output_compose_json)
     logger.success("finish process")
     yield "Finish", arg.output
     if len(arg.prev_files) > 0 or len(arg.next_files) > 0:
-        mix_audio: AudioSegment = concatenate_from_file(
-            [*arg.prev_files, output_wav, *arg.next_files]
-        )
-        mix_audio.export(output_mix)
+        concatenate_to_file([*arg.prev_files, output_wav, *arg.next_files], output_mix)
         yield "Mix", output_mix
     arg.close()
     if arg.playback:
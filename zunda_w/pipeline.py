@@ -0,0 +1,189 @@
+"""
+処理の段を別スレッドで動かし，前の段と重ねて実行する
+例: 文字起こしが終わったトラックから順に音声合成を始める
+"""
+import queue
+import threading
+import os
+from typing import Callable, Generic, Iterator, Optional, Set, Tuple, TypeVar
+
+from loguru import logger
+
+from zunda_w.util import fsync_dir, write_bytes_atomic
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_END = object()
+
+
+class Stage(Generic[T, R]):
+    """
+    putされた順にfuncを1つずつ実行するワーカースレッド
+    結果はputした順に取り出せる
+
+    :param func:
+    :param name: スレッド名(ログ用)
+    """
+
+    def __init__(self, func: Callable[[T], R], name: str = "stage"):
+        self.func = func
+        self.name = name
+        self._inputs: "queue.Queue" = queue.Queue()
+        self._outputs: "queue.Queue" = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._n_put = 0
+        self._n_get = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._inputs.get()
+            if item is _END:
+                return
+            if self._error is not None:
+                # 前の処理で失敗している場合は残りを捨てる
+                continue
+            try:
+                self._outputs.put(self.func(item))
+            except BaseException as e:
+                logger.exception(f"[{self.name}] failed")
+                self._error = e
+                self._outputs.put(_END)
+
+    def put(self, item: T):
+        if self._closed:
+            raise RuntimeError(f"[{self.name}] is already closed")
+        self._n_put += 1
+        self._inputs.put(item)
+
+    def close(self):
+        """
+        これ以上putしない.残りの処理は続ける
+        """
+        if not self._closed:
+            self._closed = True
+            self._inputs.put(_END)
+
+    def _get(self, block: bool) -> R:
+        result = self._outputs.get(block=block)
+        if result is _END:
+            raise self._error
+        self._n_get += 1
+        return result
+
+    def ready(self) -> Iterator[R]:
+        """
+        終わっている結果だけを待たずに返す
+        """
+        while self._n_get < self._n_put:
+            try:
+                yield self._get(block=False)
+            except queue.Empty:
+                return
+
+    def wait(self) -> Iterator[R]:
+        """
+        closeせずに，これまでputした分の結果を全て待って返す
+        """
+        while self._n_get < self._n_put:
+            yield self._get(block=True)
+
+    def results(self) -> Iterator[R]:
+        """
+        closeして残りの結果を全て待って返す
+        """
+        self.close()
+        yield from self.wait()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:
+            # 呼び出し側で失敗した場合は途中の処理を待たない
+            return
+        self._thread.join()
+
+
+def run_overlapped(
+    producer: Iterator[T], func: Callable[[T], R], name: str = "stage"
+) -> Iterator[R]:
+    """
+    producerから出てきた順にfuncを別スレッドで実行する.producerの次の要素の生成とfuncの実行が重なる
+    :return: funcの結果(producerの順)
+    """
+    with Stage(func, name) as stage:
+        for item in producer:
+            stage.put(item)
+            yield from stage.ready()
+        yield from stage.results()
+
+
+class BackgroundWriter:
+    """
+    ファイルの書き込みを別スレッドで行う.ファイルごとのfsyncは行わず，closeで書き込んだフォルダを1回ずつsyncする
+    submitは複数のスレッドから呼んでよい
+    """
+
+    def __init__(self, name: str = "writer"):
+        self._stage: Stage[Tuple[str, bytes, Optional[Callable[[str], None]]], str] = Stage(self._write, name)
+        self._lock = threading.Lock()
+        self._dirs: Set[str] = set()
+        self.n_files = 0
+        self.n_bytes = 0
+
+    @staticmethod
+    def _write(item: Tuple[str, bytes, Optional[Callable[[str], None]]]) -> str:
+        path, data, on_written = item
+        write_bytes_atomic(path, data)
+        if on_written is not None:
+            on_written(path)
+        return path
+
+    def submit(self, path: str, data: bytes, on_written: Optional[Callable[[str], None]] = None):
+        """
+        :param path:
+        :param data:
+        :param on_written: 書き込み後に書き込みスレッドで呼ぶ
+        """
+        with self._lock:
+            self._dirs.add(os.path.dirname(os.path.abspath(path)))
+            self.n_files += 1
+            self.n_bytes += len(data)
+            self._stage.put((path, data, on_written))
+            # 書き込み済みの結果は溜めない
+            for _ in self._stage.ready():
+                pass
+
+    def flush(self):
+        """
+        これまでsubmitした書き込み(on_writtenを含む)を待つ.fsyncは行わず，続けてsubmitできる
+        """
+        with self._lock:
+            for _ in self._stage.wait():
+                pass
+
+    def close(self):
+        """
+        全ての書き込みを待つ.書き込みに失敗していれば例外を投げる
+        """
+        with self._lock:
+            for _ in self._stage.results():
+                pass
+            for directory in self._dirs:
+                fsync_dir(directory)
+            self._dirs.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stage.close()
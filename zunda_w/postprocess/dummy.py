@@ -1,9 +1,17 @@
+from typing import List
+
+import srt
+
 from zunda_w.util import read_srt, write_srt
 
 
+def dummy_subtitles(subtitles: List[srt.Subtitle]) -> List[srt.Subtitle]:
+    for s in subtitles:
+        s.content = s.content + "_Dummy"
+    return subtitles
+
+
 def dummy(srt_file: str) -> str:
-    srts = read_srt(srt_file)
-    for srt in srts:
-        srt.content = srt.content + "_Dummy"
+    srts = dummy_subtitles(read_srt(srt_file))
     write_srt(srt_file, srts)
     return srt_file
@@ -1,26 +1,208 @@
-from typing import List, Dict, Callable
+import copy
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
 
+import srt
 from loguru import logger
+from more_itertools import chunked
 
-from zunda_w.llm.convert_word_to_kana import word_to_kana
-from zunda_w.postprocess.dummy import dummy
-from zunda_w.sentence.sentiment import add_emotion_tag
+from zunda_w.llm import convert_word_to_kana
+from zunda_w.llm.convert_word_to_kana import word_to_kana_subtitles
+from zunda_w.postprocess.dummy import dummy_subtitles
+from zunda_w.sentence import sentiment
+from zunda_w.sentence.sentiment import add_emotion_subtitles
+from zunda_w.util import read_srt, text_hash, write_srt
 
-_cmd_dict: Dict[str, Callable[[str], str]] = {
-    "word2kana": word_to_kana,
-    "dummy": dummy,
-    "emotion_analysis": add_emotion_tag,
-    # sentiment_analysis
-}
+@dataclass(frozen=True)
+class PostProcessOptions:
+    """
+    後処理の設定(Optionsから作る).結果に影響する値は各処理のconfigでキャッシュのキーに含める
+    """
 
+    # emotion_analysisの推論方法(torch/onnx)
+    emotion_backend: str = "torch"
+    # word2kanaの変換方法(sentence/word)
+    word2kana_mode: str = "sentence"
+    # word2kanaのLLMへの同時リクエスト数.結果には影響しない
+    word2kana_concurrency: int = 8
 
-def post_process(srt_file: str, cmd_list: List[str]) -> str:
-    if len(cmd_list) == 0:
-        logger.debug("No Command.Skip srt post process.")
-        return srt_file
+
+SubtitleStep = Callable[[List[srt.Subtitle], PostProcessOptions], List[srt.Subtitle]]
+StepConfig = Callable[[PostProcessOptions], Dict[str, Any]]
+
+
+def _no_config(options: PostProcessOptions) -> Dict[str, Any]:
+    return {}
+
+
+@dataclass(frozen=True)
+class PostProcessStep:
+    """
+    :param name:
+    :param func: 字幕のリストと設定を受け取り,処理後の字幕のリストを返す
+    :param streaming: Trueの場合は行ごと(一部の行だけ)に処理しても結果が変わらない.
+     Falseの場合は文書全体が必要
+    :param config: 設定のうち結果に影響する値を返す.キャッシュのキーに使う
+    """
+
+    name: str
+    func: SubtitleStep
+    streaming: bool = True
+    config: StepConfig = field(default=_no_config)
+
+
+_steps: Dict[str, PostProcessStep] = {}
+
+
+def register(name: str, func: SubtitleStep, streaming: bool = True, config: StepConfig = _no_config) -> PostProcessStep:
+    step = PostProcessStep(name, func, streaming, config)
+    _steps[name] = step
+    return step
+
+
+register(
+    "word2kana",
+    lambda subtitles, options: word_to_kana_subtitles(
+        subtitles, mode=options.word2kana_mode, max_concurrency=options.word2kana_concurrency
+    ),
+    config=lambda options: {"model": convert_word_to_kana.MODEL_NAME, "mode": options.word2kana_mode},
+)
+register("dummy", lambda subtitles, options: dummy_subtitles(subtitles))
+register(
+    "emotion_analysis",
+    lambda subtitles, options: add_emotion_subtitles(subtitles, options.emotion_backend),
+    config=lambda options: {"model": sentiment.EMOTION_MODEL, "backend": options.emotion_backend},
+)
+# sentiment_analysis
+
+
+def get_steps(cmd_list: Sequence[str]) -> List[PostProcessStep]:
+    steps = []
     for cmd in cmd_list:
-        if cmd not in _cmd_dict:
+        if cmd not in _steps:
             logger.warning(f"{cmd} not found in Command List!. Check command name.")
             continue
-        srt_file = _cmd_dict[cmd](srt_file)
+        steps.append(_steps[cmd])
+    return steps
+
+
+def post_process_subtitles(
+        subtitles: Sequence[srt.Subtitle], cmd_list: Sequence[str], options: Optional[PostProcessOptions] = None
+) -> List[srt.Subtitle]:
+    """
+    字幕をメモリ上のまま順に処理する.引数の字幕は変更しない
+    """
+    options = options or PostProcessOptions()
+    subtitles = [copy.copy(s) for s in subtitles]
+    for step in get_steps(cmd_list):
+        subtitles = step.func(subtitles, options)
+    return subtitles
+
+
+def stream_post_process(
+        subtitles: Iterable[srt.Subtitle],
+        cmd_list: Sequence[str],
+        chunk_size: int = 64,
+        options: Optional[PostProcessOptions] = None,
+) -> Iterator[srt.Subtitle]:
+    """
+    streamingの処理はchunk_size行ずつ処理して順に返す.文書全体が必要な処理の前では全ての行を待つ
+    """
+    options = options or PostProcessOptions()
+    stream: Iterable[srt.Subtitle] = (copy.copy(s) for s in subtitles)
+    for step in get_steps(cmd_list):
+        stream = _apply_step(step, stream, chunk_size, options)
+    return iter(stream)
+
+
+def _apply_step(
+        step: PostProcessStep, subtitles: Iterable[srt.Subtitle], chunk_size: int, options: PostProcessOptions
+) -> Iterator[srt.Subtitle]:
+    if not step.streaming:
+        yield from step.func(list(subtitles), options)
+        return
+    for chunk in chunked(subtitles, chunk_size):
+        yield from step.func(chunk, options)
+
+
+def post_process(srt_file: str, cmd_list: List[str], options: Optional[PostProcessOptions] = None) -> str:
+    """
+    srtファイルを1度だけ読み込み,全ての処理の後に1度だけ書き出す
+    """
+    if len(cmd_list) == 0:
+        logger.debug("No Command.Skip srt post process.")
+        return srt_file
+    write_srt(srt_file, post_process_subtitles(read_srt(srt_file), cmd_list, options))
     return srt_file
+
+
+def layer_key(input_key: str, name: str, config: Dict[str, Any]) -> str:
+    """
+    キャッシュの層のキー.入力のキーと処理の名前,設定から作る
+    """
+    return text_hash(json.dumps({"input": input_key, "step": name, "config": config}, sort_keys=True, default=str))
+
+
+def _layer_path(cache_dir: str, key: str) -> Path:
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    return Path(cache_dir).joinpath(key).with_suffix(".srt")
+
+
+def _write_layer(path: Path, subtitles: Sequence[srt.Subtitle]):
+    tmp_path = path.with_suffix(".tmp")
+    write_srt(tmp_path, subtitles)
+    os.replace(tmp_path, path)
+
+
+def cached_layer(
+        srt_file: str,
+        name: str,
+        config: Dict[str, Any],
+        cache_dir: str,
+        func: Callable[[List[srt.Subtitle]], List[srt.Subtitle]],
+        input_key: Optional[str] = None,
+) -> str:
+    """
+    srt_fileにfuncを適用した結果をcache_dir/<キー>.srtに保存する.同じ入力,設定であれば再計算しない
+    srt_fileは変更しない
+    :param input_key: 入力のキー.Noneの場合はsrt_fileの内容のハッシュ
+    :return: 結果のsrtファイル
+    """
+    key = layer_key(input_key or text_hash(Path(srt_file).read_bytes()), name, config)
+    output = _layer_path(cache_dir, key)
+    if output.exists():
+        logger.debug(f"[{name}] use cache {output}")
+        return str(output)
+    _write_layer(output, func(read_srt(srt_file)))
+    return str(output)
+
+
+def post_process_layered(
+        srt_file: str, cmd_list: Sequence[str], cache_dir: str, options: Optional[PostProcessOptions] = None
+) -> str:
+    """
+    後処理を1段ずつキャッシュしながら適用する.
+    各段は(前の段のキー,処理の名前,設定)をキーにしてcache_dirに保存するので,
+    設定やコマンドの並びが変わった段以降だけを再計算する.srt_fileは変更しない
+    :return: 最後の段のsrtファイル(処理が無い場合はsrt_file)
+    """
+    options = options or PostProcessOptions()
+    key = text_hash(Path(srt_file).read_bytes())
+    path = srt_file
+    subtitles: Optional[List[srt.Subtitle]] = None
+    for step in get_steps(cmd_list):
+        key = layer_key(key, step.name, step.config(options))
+        output = _layer_path(cache_dir, key)
+        if output.exists():
+            logger.debug(f"[{step.name}] use cache {output}")
+            subtitles = None
+        else:
+            if subtitles is None:
+                subtitles = read_srt(path)
+            subtitles = step.func([copy.copy(s) for s in subtitles], options)
+            _write_layer(output, subtitles)
+        path = str(output)
+    return path
@@ -1,34 +1,135 @@
 import copy
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional, Sequence
 
 import spacy
 import srt
 from loguru import logger
 
+from zunda_w.model_cache import ModelCache
+
 GINZA_MODEL = "ja_ginza_electra"
+# 文の分割(parser)と品詞(tokenizer)しか使わないので外す
+DISABLE_PIPES = ("ner", "bunsetu_recognizer")
+
+_model_cache = ModelCache()
+_model_lock = threading.Lock()
+
+
+def load_nlp(model_name: str = GINZA_MODEL, disable: Sequence[str] = DISABLE_PIPES) -> "spacy.Language":
+    """
+    GiNZAのモデルをプロセスごとに1度だけ読み込む
+    :param model_name:
+    :param disable: 無効にするコンポーネント.モデルに無いものは無視する
+    :return:
+    """
+    key = f"{model_name}:{','.join(sorted(disable))}"
+    with _model_lock:
+        if not _model_cache.exist("ginza", key):
+            logger.debug(f"Load GiNZA model {model_name}")
+            nlp = spacy.load(model_name)
+            nlp.select_pipes(disable=[name for name in disable if name in nlp.pipe_names])
+            _model_cache.add("ginza", key, nlp)
+        return _model_cache.get("ginza", key)
+
+
+def clear_nlp():
+    with _model_lock:
+        _model_cache.clear()
 
 
 @dataclass
 class GinzaSentence:
     n_divide_char: int = 12
     min_char: int = 10
+    # nlp.pipeで一度に解析する行数
+    batch_size: int = 256
+    # nlp.pipeのプロセス数.electra(transformer)では1を推奨
+    n_process: int = 1
+
+    def config(self) -> Dict[str, Any]:
+        """
+        結果に影響する設定(キャッシュのキー)
+        """
+        return {"model": GINZA_MODEL, "n_divide_char": self.n_divide_char, "min_char": self.min_char}
+
+    def reconstruct_subtitles(self, subtitles: Sequence[srt.Subtitle]) -> List[srt.Subtitle]:
+        return reconstruct_subtitles(subtitles, self.n_divide_char, self.min_char, self.batch_size, self.n_process)
 
     def reconstruct(
         self, srt_file: str, output: Optional[str] = None, encoding="utf-8"
     ) -> str:
         return _reconstruct(
-            srt_file, self.n_divide_char, self.min_char, output, encoding
+            srt_file,
+            self.n_divide_char,
+            self.min_char,
+            output,
+            encoding,
+            batch_size=self.batch_size,
+            n_process=self.n_process,
         )
 
 
+def _divide_doc(doc, n_divide_char: int = 12, min_char: int = 10) -> List[str]:
+    """
+    接続助詞,終助詞の位置で文章を分割する
+    """
+    reconstructs = []
+    tmp = []
+    tag_group = ["助詞-接続助詞", "助詞-終助詞"]
+    for sent in doc.sents:
+        for token in sent:
+            if token.tag_ in tag_group and len(tmp) >= n_divide_char:
+                tmp.append(token.orth_)
+                reconstructs.append("".join(tmp))
+                tmp.clear()
+            else:
+                tmp.append(token.orth_)
+    # 残った文字がmin_charより大きければ
+    # 独立したセンテンスとする
+    # min_charより小さければ，最後のセンテンスにまとめる.
+    if len(tmp) > min_char:
+        reconstructs.append("".join(tmp))
+    else:
+        if len(reconstructs) > 0:
+            reconstructs[-1] += "".join(tmp)
+        else:
+            reconstructs.append("".join(tmp))
+    return reconstructs
+
+
+def reconstruct_subtitles(
+    subtitles: Sequence[srt.Subtitle],
+    n_divide_char=12,
+    min_char: int = 10,
+    batch_size: int = 256,
+    n_process: int = 1,
+) -> List[srt.Subtitle]:
+    """
+    文章が一定以上長いものをginzaから文章を解析して分割する
+    全ての行をnlp.pipeでまとめて解析する
+    """
+    nlp = load_nlp()
+    re_subtitles = []
+    docs = nlp.pipe((sub.content for sub in subtitles), batch_size=batch_size, n_process=n_process)
+    for sub, doc in zip(subtitles, docs):
+        for sent in _divide_doc(doc, n_divide_char, min_char):
+            sent_sub = copy.copy(sub)
+            sent_sub.content = sent
+            re_subtitles.append(sent_sub)
+    return re_subtitles
+
+
 def _reconstruct(
     srt_file: str,
     n_divide_char=12,
     min_char: int = 10,
     output: Optional[str] = None,
     encoding="utf-8",
+    batch_size: int = 256,
+    n_process: int = 1,
 ) -> str:
     """
     文章が一定以上長いものをginzaから文章を解析して分割する
@@ -36,35 +137,7 @@ def _reconstruct(
     """
     logger.debug("Reconstruct with GinZa")
     subtitles = list(srt.parse(Path(srt_file).read_text(encoding=encoding)))
-    nlp = spacy.load(GINZA_MODEL)
-    re_subtitles = []
-    for sub in subtitles:
-        doc = nlp(sub.content)
-        reconstructs = []
-        tmp = []
-        tag_group = ["助詞-接続助詞", "助詞-終助詞"]
-        for sent in doc.sents:
-            for token in sent:
-                if token.tag_ in tag_group and len(tmp) >= n_divide_char:
-                    tmp.append(token.orth_)
-                    reconstructs.append("".join(tmp))
-                    tmp.clear()
-                else:
-                    tmp.append(token.orth_)
-        # 残った文字がmin_charより大きければ
-        # 独立したセンテンスとする
-        # min_charより小さければ，最後のセンテンスにまとめる.
-        if len(tmp) > min_char:
-            reconstructs.append("".join(tmp))
-        else:
-            if len(reconstructs) > 0:
-                reconstructs[-1] += "".join(tmp)
-            else:
-                reconstructs.append("".join(tmp))
-        for sent in reconstructs:
-            sent_sub = copy.copy(sub)
-            sent_sub.content = sent
-            re_subtitles.append(sent_sub)
+    re_subtitles = reconstruct_subtitles(subtitles, n_divide_char, min_char, batch_size, n_process)
 
     path = Path(output) if output else Path(srt_file)
     path.write_text(srt.compose(re_subtitles), encoding=encoding)
@@ -1,11 +1,18 @@
-from typing import List, Optional
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
 
 import fire
+import srt
+import numpy as np
+from loguru import logger
 from more_itertools import chunked
 import torch
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, LukeConfig
 from transformers import pipeline
 
+from zunda_w import cache
 from zunda_w.postprocess.srt import tag
 from zunda_w.util import read_srt, write_srt
 
@@ -43,47 +50,161 @@ def emotion() -> List[str]:
     return [v.replace("e:", "") for _, v in EMOTION_INDEX.items()]
 
 
-def _get_emotion(text: List[str], batch: int = 8):
+EMOTION_MODEL = "Mizuiro-sakura/luke-japanese-large-sentiment-analysis-wrime"
+
+
+class EmotionClassifier:
     """
     WRIME[https://github.com/ids-cv/wrime]
     https://huggingface.co/Mizuiro-sakura/luke-japanese-large-sentiment-analysis-wrime
     喜び、悲しみ、期待、驚き、怒り、恐れ、嫌悪、信頼 を分類
+
+    モデルは最初の分類時に1度だけ読み込み，同じ文章の結果は使いまわす.
+    バッチはトークン長でソートして作り，バッチ内の最長に合わせてパディングする.
+
+    :param model_name:
+    :param backend: "torch" または "onnx"(CPU,int8量子化)
+    :param batch_size:
+    :param max_length: これより長い文章は切り捨てる
+    :param onnx_dir: onnxに変換したモデルの保存先.Noneの場合はユーザーのキャッシュフォルダのモデルごとのフォルダ
     """
 
-    tokenizer = AutoTokenizer.from_pretrained("Mizuiro-sakura/luke-japanese-large-sentiment-analysis-wrime")
-    config = LukeConfig.from_pretrained('Mizuiro-sakura/luke-japanese-large-sentiment-analysis-wrime',
-                                        output_hidden_states=True)
-    model = AutoModelForSequenceClassification.from_pretrained(
-        'Mizuiro-sakura/luke-japanese-large-sentiment-analysis-wrime', config=config)
-    model.eval()
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    if device == "cuda":
-        model.to("cuda")
-
-    max_seq_length = 512
-    result = []
-
-    with torch.no_grad():
-        for t in chunked(text, batch):
-            token = tokenizer(t,
-                              truncation=True,
-                              max_length=max_seq_length,
-                              padding="max_length",
-                              return_tensors="pt").to(device)
-            output = model(**token)
-            max_index = torch.argmax(output.logits.cpu().detach(), dim=1)
-            max_index = max_index.numpy().tolist()
-            emos = [EMOTION_INDEX[index] for index in max_index]
-            result.extend(emos)
-    return result
-
-
-def add_emotion_tag(srt_file: str, dst_file: Optional[str] = None) -> str:
-    srts = read_srt(srt_file)
-    text = [s.content for s in srts]
-    emotions = _get_emotion(text)
-    for srt, emo in zip(srts, emotions):
-        srt.content = tag.as_tag(emo) + srt.content
+    def __init__(
+            self,
+            model_name: str = EMOTION_MODEL,
+            backend: str = "torch",
+            batch_size: int = 32,
+            max_length: int = 512,
+            onnx_dir: Optional[str] = None,
+    ):
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Unknown backend:{backend}")
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.onnx_dir = onnx_dir or os.path.join(
+            cache.user_cache_dir("zunda_w"), "emotion_onnx", model_name.replace("/", "--")
+        )
+        self.device = "cuda" if backend == "torch" and torch.cuda.is_available() else "cpu"
+        self._tokenizer = None
+        self._model = None
+        self._session = None
+        self._memo: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._tokenizer is not None:
+            return
+        logger.debug(f"Load emotion model {self.model_name} ({self.backend})")
+        self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        if self.backend == "onnx":
+            self._session = self._load_onnx()
+            return
+        config = LukeConfig.from_pretrained(self.model_name, output_hidden_states=True)
+        model = AutoModelForSequenceClassification.from_pretrained(self.model_name, config=config)
+        model.eval()
+        self._model = model.to(self.device)
+
+    def _load_onnx(self):
+        import onnxruntime
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        onnx_dir = Path(self.onnx_dir)
+        model_path = onnx_dir.joinpath("model.onnx")
+        quantized_path = onnx_dir.joinpath("model.int8.onnx")
+        if not quantized_path.exists():
+            logger.info(f"Export emotion model to onnx: {quantized_path}")
+            onnx_dir.mkdir(parents=True, exist_ok=True)
+            model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+            model.eval()
+            dummy = self._tokenizer(["ダミー"], return_tensors="pt")
+            with torch.no_grad():
+                torch.onnx.export(
+                    model,
+                    (dummy["input_ids"], dummy["attention_mask"]),
+                    str(model_path),
+                    input_names=["input_ids", "attention_mask"],
+                    output_names=["logits"],
+                    dynamic_axes={
+                        "input_ids": {0: "batch", 1: "sequence"},
+                        "attention_mask": {0: "batch", 1: "sequence"},
+                        "logits": {0: "batch"},
+                    },
+                    opset_version=14,
+                )
+            quantize_dynamic(str(model_path), str(quantized_path), weight_type=QuantType.QInt8)
+            model_path.unlink()
+        return onnxruntime.InferenceSession(str(quantized_path), providers=["CPUExecutionProvider"])
+
+    def _predict(self, texts: List[str]) -> List[int]:
+        if self.backend == "onnx":
+            token = self._tokenizer(texts, truncation=True, max_length=self.max_length, padding="longest",
+                                    return_tensors="np")
+            logits = self._session.run(
+                ["logits"],
+                {"input_ids": token["input_ids"].astype(np.int64),
+                 "attention_mask": token["attention_mask"].astype(np.int64)},
+            )[0]
+            return np.argmax(logits, axis=1).tolist()
+        token = self._tokenizer(texts, truncation=True, max_length=self.max_length, padding="longest",
+                                return_tensors="pt").to(self.device)
+        with torch.no_grad():
+            output = self._model(**token)
+        return torch.argmax(output.logits.cpu().detach(), dim=1).numpy().tolist()
+
+    def classify(self, texts: Sequence[str]) -> List[str]:
+        """
+        :param texts:
+        :return: textsと同じ順番のEMOTION_INDEXの値
+        """
+        with self._lock:
+            new_texts = list(dict.fromkeys(t for t in texts if t not in self._memo))
+            if new_texts:
+                self._load()
+                # 長さの近い文章を同じバッチにしてパディングを減らす
+                lengths = [len(ids) for ids in self._tokenizer(new_texts, truncation=True,
+                                                               max_length=self.max_length)["input_ids"]]
+                order = sorted(range(len(new_texts)), key=lambda i: lengths[i])
+                for batch in chunked(order, self.batch_size):
+                    batch_texts = [new_texts[i] for i in batch]
+                    for text, index in zip(batch_texts, self._predict(batch_texts)):
+                        self._memo[text] = EMOTION_INDEX[index]
+                logger.debug(f"emotion: {len(new_texts)} new / {len(texts)} lines")
+            return [self._memo[t] for t in texts]
+
+
+_classifiers: Dict[str, EmotionClassifier] = {}
+_classifiers_lock = threading.Lock()
+
+
+def get_classifier(backend: str = "torch") -> EmotionClassifier:
+    """
+    プロセスで共有する分類器.backendごとに1つ作る
+    :param backend: "torch" または "onnx"
+    """
+    with _classifiers_lock:
+        if backend not in _classifiers:
+            _classifiers[backend] = EmotionClassifier(backend=backend)
+        return _classifiers[backend]
+
+
+def _get_emotion(text: List[str], backend: str = "torch"):
+    """
+    喜び、悲しみ、期待、驚き、怒り、恐れ、嫌悪、信頼 を分類
+    """
+    return get_classifier(backend).classify(text)
+
+
+def add_emotion_subtitles(subtitles: List[srt.Subtitle], backend: str = "torch") -> List[srt.Subtitle]:
+    emotions = _get_emotion([s.content for s in subtitles], backend)
+    for s, emo in zip(subtitles, emotions):
+        s.content = tag.as_tag(emo) + s.content
+    return subtitles
+
+
+def add_emotion_tag(srt_file: str, dst_file: Optional[str] = None, backend: str = "torch") -> str:
+    srts = add_emotion_subtitles(read_srt(srt_file), backend)
     if dst_file:
         write_srt(dst_file, srts)
     else:
@@ -1,11 +1,15 @@
 import os.path
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 from dataclasses_json import dataclass_json
 from loguru import logger
 from pydub import AudioSegment, effects, silence
+from pydub.utils import db_to_float, ratio_to_db
+
+from zunda_w.audio import AudioFormat, to_float32
 
 
 @dataclass_json
@@ -15,6 +19,126 @@ class Segment:
     end: int
 
 
+def normalize_gain(segment: AudioSegment, headroom: float = 0.1) -> Optional[float]:
+    """
+    effects.normalizeが適用するゲイン(dB).無音の場合はNone
+    """
+    peak_sample_val = segment.max
+    if peak_sample_val == 0:
+        return None
+    target_peak = segment.max_possible_amplitude * db_to_float(-headroom)
+    return ratio_to_db(target_peak / peak_sample_val)
+
+
+def _ms_square_sums(segment: AudioSegment, gain: Optional[float], chunk_ms: int = 60_000) -> np.ndarray:
+    """
+    1ミリ秒ごとの区間の二乗和(全チャンネル)
+    区間の境界はAudioSegmentのスライスと同じ int(ms * frame_rate / 1000)
+    gainが指定されていればaudioop.mulと同じ丸めで適用してから計算する
+    16bit以下は整数で計算するため誤差はない
+    """
+    fmt = AudioFormat.of(segment)
+    exact = fmt.sample_width <= 2
+    acc_dtype = np.int64 if exact else np.float64
+    samples = np.frombuffer(segment.raw_data, dtype=fmt.dtype)
+    n_frames = len(samples) // fmt.channels
+    seg_len = len(segment)
+    bounds = np.minimum(_ms_bounds(seg_len, fmt.frame_rate), n_frames)
+    factor = db_to_float(float(gain)) if gain is not None else None
+    info = np.iinfo(fmt.dtype)
+    sums = np.zeros(seg_len, dtype=acc_dtype)
+    # 長時間の音声でもメモリを抑えるためchunk_msごとに処理
+    for m0 in range(0, seg_len, chunk_ms):
+        m1 = min(seg_len, m0 + chunk_ms)
+        f0, f1 = bounds[m0], bounds[m1]
+        x = samples[f0 * fmt.channels: f1 * fmt.channels]
+        if factor is not None:
+            x = np.floor(np.clip(x * factor, info.min, info.max))
+        x = x.astype(acc_dtype)
+        frame_sq = (x * x).reshape(-1, fmt.channels).sum(axis=1)
+        cs = np.concatenate([np.zeros(1, dtype=acc_dtype), np.cumsum(frame_sq)])
+        sums[m0:m1] = cs[bounds[m0 + 1: m1 + 1] - f0] - cs[bounds[m0:m1] - f0]
+    return sums
+
+
+def _ms_bounds(seg_len: int, frame_rate: int) -> np.ndarray:
+    return (np.arange(seg_len + 1, dtype=np.float64) * (frame_rate / 1000.0)).astype(np.int64)
+
+
+def _rms(square_sum: np.ndarray, n_samples: np.ndarray) -> np.ndarray:
+    # audioop.rmsと同じく平方根を整数に切り捨て
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rms = np.floor(np.sqrt(square_sum.astype(np.float64) / n_samples))
+    return np.where(n_samples > 0, rms, 0)
+
+
+def detect_nonsilent(
+        segment: AudioSegment,
+        min_silence_len=4000,
+        seek_step=10,
+        silence_thresh_down=-20,
+        gain: Optional[float] = None,
+) -> List[List[int]]:
+    """
+    pydub.silence.detect_nonsilentをnumpyで一括計算する版
+    閾値は(gain適用後の)音声全体のdBFS + silence_thresh_down
+    ミリ秒ごとの二乗和の累積和から各窓のrmsを求めるため，音声長に対して線形
+    :param segment:
+    :param min_silence_len:
+    :param seek_step:
+    :param silence_thresh_down:
+    :param gain: 検出前に適用するゲイン(dB).normalize_gainの値を渡すとeffects.normalize後の音声と同じ結果になる
+    :return: [[start(ms), end(ms)], ...]
+    """
+    seg_len = len(segment)
+    if seg_len < min_silence_len:
+        return [[0, seg_len]]
+    channels = segment.channels
+    sums = _ms_square_sums(segment, gain)
+    cumsum = np.concatenate([np.zeros(1, dtype=sums.dtype), np.cumsum(sums)])
+    # 全体のdBFS
+    n_total = (len(segment.raw_data) // segment.frame_width) * channels
+    total_rms = _rms(cumsum[-1:], np.array([n_total]))[0] if n_total else 0
+    if not total_rms:
+        dbfs = -float("infinity")
+    else:
+        dbfs = ratio_to_db(total_rms / segment.max_possible_amplitude)
+    silence_thresh = db_to_float(dbfs + silence_thresh_down) * segment.max_possible_amplitude
+
+    last_slice_start = seg_len - min_silence_len
+    starts = np.arange(0, last_slice_start + 1, seek_step)
+    if last_slice_start % seek_step:
+        starts = np.append(starts, last_slice_start)
+    ends = starts + min_silence_len
+    # スライスが音声の末尾を超える分は無音で埋められ,サンプル数に含まれる
+    bounds = _ms_bounds(seg_len, segment.frame_rate)
+    n_samples = (bounds[ends] - bounds[starts]) * channels
+    rms = _rms(cumsum[ends] - cumsum[starts], n_samples)
+    silence_starts = starts[rms <= silence_thresh]
+
+    if len(silence_starts) == 0:
+        return [[0, seg_len]]
+    # 無音区間の結合(pydubのdetect_silenceと同じ規則)
+    prev, cur = silence_starts[:-1], silence_starts[1:]
+    breaks = np.flatnonzero((cur != prev + seek_step) & (cur > prev + min_silence_len))
+    range_starts = np.concatenate([silence_starts[:1], cur[breaks]])
+    range_ends = np.concatenate([prev[breaks], silence_starts[-1:]]) + min_silence_len
+    silent_ranges = list(zip(range_starts.tolist(), range_ends.tolist()))
+
+    if silent_ranges[0][0] == 0 and silent_ranges[0][1] == seg_len:
+        return []
+    prev_end_i = 0
+    nonsilent_ranges = []
+    for start_i, end_i in silent_ranges:
+        nonsilent_ranges.append([prev_end_i, start_i])
+        prev_end_i = end_i
+    if end_i != seg_len:
+        nonsilent_ranges.append([prev_end_i, seg_len])
+    if nonsilent_ranges[0] == [0, 0]:
+        nonsilent_ranges.pop(0)
+    return nonsilent_ranges
+
+
 def _divide_by_silence(
     segment: AudioSegment,
     min_silence_len=4000,
@@ -58,22 +182,39 @@ def divide_by_silence(
     min_length=500,
     root_dir: str = os.curdir,
     output_dir: str = ".silence",
+    detector: str = "numpy",
 ) -> Tuple[Tuple[str], Tuple[str]]:
+    """
+    :param detector: numpy:detect_nonsilent, pydub:pydub.silence.detect_nonsilent(旧実装)
+    """
     logger.debug(f"divide by silence:{wave_file}")
     segment = AudioSegment.from_file(wave_file)
-    logger.debug("Effect : Normalize")
-    segment = effects.normalize(segment)
     output_dir = Path(root_dir).joinpath(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    logger.debug(f"dBFS:{segment.dBFS}")
-    dbFS = segment.dBFS
-    result = silence.detect_nonsilent(
-        segment,
-        min_silence_len=min_silence_len,
-        seek_step=seek_step,
-        silence_thresh=dbFS + silence_thresh_down,
-    )
+    logger.debug("Effect : Normalize")
+    gain = normalize_gain(segment)
+    if detector == "pydub":
+        segment = effects.normalize(segment)
+        gain = None
+        logger.debug(f"dBFS:{segment.dBFS}")
+        result = silence.detect_nonsilent(
+            segment,
+            min_silence_len=min_silence_len,
+            seek_step=seek_step,
+            silence_thresh=segment.dBFS + silence_thresh_down,
+        )
+    elif detector == "numpy":
+        # 正規化した音声は作らず，ゲインを渡して検出と切り出しで適用する
+        result = detect_nonsilent(
+            segment,
+            min_silence_len=min_silence_len,
+            seek_step=seek_step,
+            silence_thresh_down=silence_thresh_down,
+            gain=gain,
+        )
+    else:
+        raise ValueError(f"Unknown silence detector: {detector}")
 
     segments = []
     audios = []
@@ -89,6 +230,8 @@ def divide_by_silence(
             f"[{idx:04d}] {int(s / 1000 / 60):02d}:{int(s / 1000 % 60):02d} -> {int(e / 1000 / 60):02d}:{int(e / 1000 % 60):02d}"
         )
         slice = segment[s:e]
+        if gain is not None:
+            slice = slice.apply_gain(gain)
         output_path = os.path.join(output_dir, f"{idx:04d}.wav")
         seg = Segment(s, e)
         segment_path = Path(output_path).with_suffix(".meta")
@@ -100,3 +243,56 @@ def divide_by_silence(
         idx += 1
 
     return tuple(segments), tuple(audios)
+
+
+def iter_nonsilent(
+    wave_file: Union[str, AudioSegment],
+    min_silence_len=4000,
+    seek_step=10,
+    silence_thresh_down=-20,
+    min_length=500,
+    frame_rate: int = 16000,
+    root_dir: Optional[str] = None,
+    output_dir: str = ".silence",
+) -> Iterator[Tuple[Segment, np.ndarray]]:
+    """
+    無音区間で分割した音声を(Segment,float32の配列)としてメモリ上で順に返す
+    配列は区間ごとに正規化し,whisperの入力形式(mono,frame_rate)に変換済み
+    root_dirを指定した場合はdivide_by_silenceと同じ形式でwavと.metaも書き出す
+    :param wave_file:
+    :param min_silence_len:
+    :param seek_step:
+    :param silence_thresh_down:
+    :param min_length: これより短い区間(millisecond)は返さない
+    :param frame_rate:
+    :param root_dir:
+    :param output_dir:
+    :return:
+    """
+    segment = AudioSegment.from_file(wave_file) if isinstance(wave_file, str) else wave_file
+    gain = normalize_gain(segment)
+    result = detect_nonsilent(
+        segment,
+        min_silence_len=min_silence_len,
+        seek_step=seek_step,
+        silence_thresh_down=silence_thresh_down,
+        gain=gain,
+    )
+    if root_dir is not None:
+        output_dir = Path(root_dir).joinpath(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+    idx = 0
+    for s, e in result:
+        if e - s < min_length:
+            continue
+        slice = segment[s:e]
+        if gain is not None:
+            slice = slice.apply_gain(gain)
+        seg = Segment(s, e)
+        if root_dir is not None:
+            output_path = os.path.join(output_dir, f"{idx:04d}.wav")
+            Path(output_path).with_suffix(".meta").write_text(Segment.to_json(seg, indent=2), encoding="UTF-8")
+            slice.export(output_path)
+        idx += 1
+        # 文字起こし前に区間ごとに正規化する(transcribe_non_silenceと同じ)
+        yield seg, to_float32(effects.normalize(slice), frame_rate)
@@ -1,49 +1,109 @@
+import copy
 import datetime
 import os
 from dataclasses import dataclass, field
 from functools import cached_property
-from itertools import chain
 from pathlib import Path
 from typing import Any, List, Optional, Sequence, Tuple, Dict
 
+import numpy as np
 import srt
 from pydub import AudioSegment
 from pydub.playback import play
 from srt import Subtitle
 
+from zunda_w.audio import AudioFormat, AudioInfo, as_array, audio_info, load_audio, memory_audio
 from zunda_w.etc.placeholder import render
-from zunda_w.util import read_srt, read_json, write_srt
+from zunda_w.subtitle_table import SubtitleTable
+from zunda_w.timeline import TimelineIndex
+from zunda_w.util import read_json, write_srt
 from zunda_w.words import WordFilter
 
 
+def _timedelta(value: Any) -> datetime.timedelta:
+    """
+    to_jsonで書き出したstr(timedelta)("1 day, 0:00:01.500000"など)を読み込む
+    """
+    if isinstance(value, datetime.timedelta):
+        return value
+    days, _, clock = str(value).rpartition(", ")
+    hours, minutes, seconds = clock.split(":")
+    return datetime.timedelta(
+        days=int(days.split()[0]) if days else 0, hours=int(hours), minutes=int(minutes), seconds=float(seconds)
+    )
+
+
 @dataclass
 class SpeakerUnit:
     subtitle: Subtitle
     audio_file_path: Optional[str]
-    audio: Optional[AudioSegment] = field(init=False)
+    # 直接設定された音声.Noneの場合はaudio_file_pathから必要な時に読み込む
+    _audio: Optional[AudioSegment] = field(init=False, default=None, repr=False, compare=False)
+
+    @property
+    def has_audio(self) -> bool:
+        if self._audio is not None:
+            return True
+        if not self.audio_file_path or self.audio_file_path == 'empty':
+            return False
+        return memory_audio.get(self.audio_file_path) is not None or os.path.exists(self.audio_file_path)
+
+    @property
+    def audio(self) -> Optional[AudioSegment]:
+        """
+        音声は参照されるまで読み込まない
+        デコード結果はaudio.pcm_cacheで保持する
+        """
+        if self._audio is not None:
+            return self._audio
+        if not self.has_audio:
+            return None
+        return load_audio(self.audio_file_path)
 
-    def __post_init__(self):
-        if self.audio_file_path and os.path.exists(self.audio_file_path):
-            if self.audio_file_path == 'empty':
-                self.audio = None
-            else:
-                self.audio = AudioSegment.from_file(self.audio_file_path)
-        else:
-            self.audio = None
+    @audio.setter
+    def audio(self, segment: Optional[AudioSegment]):
+        self._audio = segment
+
+    def samples(self, fmt: AudioFormat) -> np.ndarray:
+        """
+        音声をfmtの(frames,channels)の配列で返す
+        メモリ上の合成音声がfmtと同じ形式であればコピーせずにそのまま返す
+        """
+        if self._audio is None:
+            clip = memory_audio.get(self.audio_file_path)
+            if clip is not None and clip.fmt == fmt:
+                return clip.samples
+        return as_array(self.audio, fmt)
+
+    @property
+    def audio_info(self) -> Optional[AudioInfo]:
+        """
+        音声のフォーマットと長さ.wavであればヘッダのみを読む
+        """
+        if self._audio is not None:
+            return AudioInfo.of(self._audio)
+        if not self.has_audio:
+            return None
+        return audio_info(self.audio_file_path)
+
+    @property
+    def duration_ms(self) -> int:
+        info = self.audio_info
+        return info.duration_ms if info else 0
 
     def to_dict(self) -> dict:
-        srt_dict = vars(self.subtitle)
+        srt_dict = dict(vars(self.subtitle))
         srt_dict["start"] = str(srt_dict["start"])
         srt_dict["end"] = str(srt_dict["end"])
         return {
             "subtitle": srt_dict,
-            "audio_file": os.path.abspath(self.audio_file_path),
+            "audio_file": os.path.abspath(self.audio_file_path) if self.audio_file_path else None,
         }
 
     @staticmethod
     def from_dict(data: dict):
         s = data['subtitle']
-        subtitle = Subtitle(s['index'], s['start'], s['end'], s['content'], s["proprietary"])
+        subtitle = Subtitle(s['index'], _timedelta(s['start']), _timedelta(s['end']), s['content'], s["proprietary"])
         return SpeakerUnit(subtitle, data['audio_file'])
 
 
@@ -62,21 +122,14 @@ class SpeakerCompose:
         :return:
         """
         assert len(subtitles) == len(tts_files)
-        compose = list(
-            map(
-                lambda x: SpeakerUnit(
-                    x[0], AudioSegment.from_file(x[1]), audio_file_path=x[1]
-                ),
-                zip(subtitles, tts_files),
-            )
-        )
+        compose = list(map(lambda x: SpeakerUnit(x[0], x[1]), zip(subtitles, tts_files)))
         last_end = subtitles[-1].end
         return SpeakerCompose(tuple(compose), last_end)
 
     @staticmethod
     def from_json(json_file: str):
         _json = read_json(json_file)
-        return SpeakerCompose(tuple(map(SpeakerUnit.from_dict, _json["unit"])), _json["n_length"])
+        return SpeakerCompose(tuple(map(SpeakerUnit.from_dict, _json["unit"])), _timedelta(_json["n_length"]))
 
     def to_json(self) -> dict:
         return {
@@ -91,11 +144,10 @@ class SpeakerCompose:
     def audio_duration(self) -> datetime.timedelta:
         """
         unit.audioの総時間
+        音声のデコードは行わない
         :return:
         """
-        return datetime.timedelta(
-            milliseconds=sum(map(lambda x: len(x.audio) if x.audio is not None else 0, self.unit))
-        )
+        return datetime.timedelta(milliseconds=sum(map(lambda x: x.duration_ms, self.unit)))
 
     @cached_property
     def srt(self) -> Sequence[srt.Subtitle]:
@@ -106,30 +158,121 @@ class SpeakerCompose:
 
     def playback(self):
         for unit in self.unit:
-            if unit:
+            if unit.has_audio:
                 play(unit.audio)
 
-    def update_srt(self, srts: Sequence[Subtitle]):
-        if len(srts) != len(self.unit):
-            for s, u in zip(srts, self.unit):
-                print(f'srt:{s.index} == compose:{u.subtitle.index}')
+    @cached_property
+    def timeline(self) -> TimelineIndex:
+        """
+        unitの開始時刻順の索引.unitの並びは変えない.insert,remove,retimeで更新する
+        """
+        return TimelineIndex(self.unit)
+
+    def _invalidate(self):
+        for name in ("srt", "audio_duration"):
+            self.__dict__.pop(name, None)
+
+    def _extend_length(self, units: Sequence[SpeakerUnit]):
+        if units:
+            self.n_length = max(self.n_length, max(u.subtitle.end for u in units))
+
+    def _position(self, unit: SpeakerUnit) -> int:
+        for i, u in enumerate(self.unit):
+            if u is unit:
+                return i
+        raise ValueError(f"unit is not in compose: {unit.subtitle.index}")
 
-                assert s.index == u.subtitle.index, f'{s.index}:{s.content}!={u.subtitle.index}:{u.subtitle.content}'
-            raise ValueError(f'Not Equal n line of srt = {len(srts)} and n units = {len(self.unit)}')
-        for unit, s in zip(self.unit, srts):
-            unit.subtitle = s
+    def _place(self, unit: SpeakerUnit, t: int) -> int:
+        """
+        索引のt番目に入れたunitを，索引で次にあるunitの直前に置く(無ければ末尾)
+        unitが開始時刻順に並んでいれば開始時刻の位置になる
+        :return: unit上の位置
+        """
+        timeline = self.timeline
+        i = self._position(timeline[t + 1]) if t + 1 < len(timeline) else len(self.unit)
+        self.unit = (*self.unit[:i], unit, *self.unit[i:])
+        return i
+
+    def insert(self, unit: SpeakerUnit) -> int:
+        """
+        開始時刻の位置にunitを追加する
+        :return: 追加した位置
+        """
+        i = self._place(unit, self.timeline.insert(unit))
+        self._extend_length([unit])
+        self._invalidate()
+        return i
+
+    def remove(self, unit: SpeakerUnit) -> int:
+        """
+        :return: 削除した位置
+        """
+        self.timeline.remove(unit)
+        i = self._position(unit)
+        self.unit = (*self.unit[:i], *self.unit[i + 1:])
+        self._invalidate()
+        return i
+
+    def retime(self, unit: SpeakerUnit, start: datetime.timedelta, end: datetime.timedelta) -> int:
+        """
+        unitの時刻を変更し，開始時刻順の位置へ移す
+        :return: 変更後の位置
+        """
+        _, new = self.timeline.retime(unit, start, end)
+        i = self._position(unit)
+        self.unit = (*self.unit[:i], *self.unit[i + 1:])
+        i = self._place(unit, new)
+        self._extend_length([unit])
+        self._invalidate()
+        return i
+
+    def update_srt(self, srts: Sequence[Subtitle], match_keys: bool = False):
+        """
+        編集したsrtの内容を反映する.unitはコピーして字幕を差し替え，元のunit,subtitleは変更しない
+        :param srts:
+        :param match_keys: Falseの場合は行数が一致している必要があり，先頭から順に字幕を差し替える.
+         Trueの場合は(index,proprietary)が一致するunitの字幕を差し替え，srtにしか無い行は音声の無いunitとして追加,
+         srtに無いunitは削除する.unitはsrtの順に並ぶ
+        :return:
+        """
+        if not match_keys:
+            if len(srts) != len(self.unit):
+                raise ValueError(f'Not Equal n line of srt = {len(srts)} and n units = {len(self.unit)}')
+            pairs = zip(self.unit, srts)
+        else:
+            by_key: Dict[Tuple[int, str], SpeakerUnit] = {}
+            for u in self.unit:
+                by_key.setdefault((u.subtitle.index, u.subtitle.proprietary), u)
+            keys = [(s.index, s.proprietary) for s in srts]
+            if len(set(keys)) != len(keys) or len(by_key) != len(self.unit):
+                raise ValueError("(index,proprietary) is duplicated. update by position (match_keys=False)")
+            pairs = ((by_key.get(key), s) for key, s in zip(keys, srts))
+        units = []
+        for unit, s in pairs:
+            if unit is None:
+                unit = SpeakerUnit(s, None)
+            else:
+                unit = copy.copy(unit)
+                unit.subtitle = s
+            units.append(unit)
+        self.unit = tuple(units)
+        self.__dict__.pop("timeline", None)
+        self._extend_length(self.unit)
+        self._invalidate()
         return self
 
 
-def _parse_with_id(
-        srt_file_path: str, id: int, encoding: str, wave_paths: Sequence[str]
-) -> List[SpeakerUnit]:
-    subtitles = list(srt.parse(Path(srt_file_path).read_text(encoding=encoding)))
-    for s in subtitles:
-        s.speaker = id
+def units_from_table(table: SubtitleTable) -> List[SpeakerUnit]:
+    """
+    表の各行をSpeakerUnitに変換する.音声は参照されるまで読み込まない
+    """
+    return [SpeakerUnit(s, a) for s, a in zip(table.subtitles(), table.audio_files())]
 
-    # audio = list(read_output_waves(wave_paths))
-    return [SpeakerUnit(s, a) for s, a in zip(subtitles, wave_paths)]
+
+def _filter_words(table: SubtitleTable, word_filter: Optional[WordFilter]) -> SubtitleTable:
+    if not word_filter:
+        return table
+    return table.filter(table.text_mask(word_filter.is_exclude))
 
 
 def sort_srt_files(files: Sequence[str], word_filter: WordFilter = None,
@@ -139,13 +282,8 @@ def sort_srt_files(files: Sequence[str], word_filter: WordFilter = None,
     :param files: 
     :return: 
     """
-    srts = map(read_srt, files)
-    units = list(map(lambda subtitle: SpeakerUnit(subtitle, None), chain.from_iterable(srts)))
-    units.sort(key=lambda s: s.subtitle.start)
-    if word_filter:
-        units = list(
-            filter(lambda unit: word_filter.is_exclude(unit.subtitle.content), units)
-        )
+    table = SubtitleTable.concat([SubtitleTable.read(f) for f in files]).sort()
+    units = units_from_table(_filter_words(table, word_filter))
     time_length = units[-1].subtitle.end
     return SpeakerCompose(tuple(units), time_length)
 
@@ -159,23 +297,17 @@ def merge(
 ) -> SpeakerCompose:
     """
     SubtitleとAudiosを読み込み，時間順にソートする
+    トラックごとの字幕はSubtitleTableに読み込み，結合,並べ替え,絞り込みを配列の操作で行う
 
     :return 合成結果のインスタンス
     """
-    units: List[SpeakerUnit] = list(
-        chain.from_iterable(
-            map(
-                lambda x: _parse_with_id(x[1][0], x[0], encoding, x[1][1]),
-                enumerate(zip(srt_files, tts_files)),
-            )
-        )
-    )
+    table = SubtitleTable.concat([
+        SubtitleTable.read(srt_file, speaker_id, audio_files, encoding)
+        for speaker_id, (srt_file, audio_files) in enumerate(zip(srt_files, tts_files))
+    ])
     if sort:
-        units.sort(key=lambda s: s.subtitle.start)
-    if word_filter:
-        units = list(
-            filter(lambda unit: word_filter.is_exclude(unit.subtitle.content), units)
-        )
+        table = table.sort()
+    units = units_from_table(_filter_words(table, word_filter))
     time_length = units[-1].subtitle.end
     return SpeakerCompose(units, time_length)
 
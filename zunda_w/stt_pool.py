@@ -0,0 +1,244 @@
+"""
+話者ごとの音声ファイルの文字起こしを並列に行う
+ワーカーはプロセスごとにモデルを1つずつ持ち，複数のトラックを順に処理する
+"""
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import srt
+from loguru import logger
+
+from zunda_w.hash import cached_file_hash
+from zunda_w.postprocess.srt import postprocess as srt_postprocess
+from zunda_w.sentence.ginza_sentence import GinzaSentence
+from zunda_w.transcribe import (
+    WhisperProfile,
+    raw_to_sentences,
+    transcribe_audio_non_silence_srt,
+    transcribe_with_config,
+    whisper_context,
+)
+from zunda_w.whisper_util import write_srt
+
+
+LAYER_DIR = ".layers"
+
+
+@dataclass(frozen=True)
+class SttTask:
+    """
+    1トラック(1話者)分の文字起こしの設定
+    """
+
+    index: int
+    audio_file: str
+    speaker_id: int
+    data_dir: str
+    whisper_profile: WhisperProfile
+    tmp_dir: str
+    no_detect_silence: bool = True
+    keep_silence_segments: bool = False
+    ginza: GinzaSentence = field(default_factory=GinzaSentence)
+    post_processes: Sequence[str] = ()
+    post_process_options: srt_postprocess.PostProcessOptions = field(
+        default_factory=srt_postprocess.PostProcessOptions
+    )
+    # キャッシュフォルダ名に使う音声ファイルのハッシュ関数
+    hash_algorithm: str = "md5"
+
+
+@dataclass(frozen=True)
+class SttResult:
+    index: int
+    stt_file: str
+    audio_hash: str
+    # post_processを行う前のsrtファイル
+    plain_stt_file: Optional[str]
+    # 入力がsrtファイルで文字起こしをしなかった
+    is_srt: bool
+    pid: int
+    # ワーカーのピークメモリ(byte).取得できない場合はNone
+    peak_memory: Optional[int]
+    elapsed: float
+
+
+@dataclass(frozen=True)
+class SttChunk:
+    """
+    文字起こしの途中結果.無音区間(まとめた場合はまとめた単位)ごとのwhisperXのsegment
+    """
+
+    index: int
+    audio_hash: str
+    raw_segments: List[Dict]
+
+
+def peak_memory() -> Optional[int]:
+    """
+    現在のプロセスのピークメモリ(byte)
+    """
+    try:
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linuxはKB,macはbyte
+        return rss if sys.platform == "darwin" else rss * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    except ImportError:
+        return None
+
+
+def _tmp_file(tmp_dir: str) -> str:
+    Path(tmp_dir).mkdir(exist_ok=True, parents=True)
+    return os.path.join(tmp_dir, str(uuid.uuid4()))
+
+
+def _as_srt_file(subtitles: Sequence[srt.Subtitle]) -> List[srt.Subtitle]:
+    # ファイルに書き出して読み直した場合と同じ内容にする
+    return list(srt.parse(srt.compose(subtitles, reindex=False)))
+
+
+def chunk_subtitles(task: SttTask, chunk: SttChunk) -> List[srt.Subtitle]:
+    """
+    途中結果をspeech_to_textと同じ手順(GiNZA,後処理)で字幕にする.
+    どの処理も行ごとに独立しているので，内容と話者(proprietary)は最終的なsrtの行と一致する(時刻,indexは一致しない)
+    文書全体が必要な後処理(streaming=False)がある場合は一致しないため空のリストを返す
+    """
+    steps = srt_postprocess.get_steps(task.post_processes)
+    if not all(step.streaming for step in steps):
+        return []
+    buffer = io.StringIO()
+    write_srt(raw_to_sentences(chunk.raw_segments), file=buffer)
+    subtitles = list(srt.parse(buffer.getvalue()))
+    if len(subtitles) == 0:
+        return []
+    for s in subtitles:
+        s.proprietary = str(task.speaker_id)
+    subtitles = _as_srt_file(task.ginza.reconstruct_subtitles(_as_srt_file(subtitles)))
+    for step in steps:
+        subtitles = _as_srt_file(step.func(subtitles, task.post_process_options))
+    return subtitles
+
+
+def speech_to_text(task: SttTask, on_chunk: Optional[Callable[[SttChunk], None]] = None) -> SttResult:
+    """
+    1トラック分の ハッシュ計算 -> 無音区間の分割 -> Whisper -> GiNZA -> post process
+    キャッシュはdata_dir/<音声のハッシュ>以下に保存する
+    :param task:
+    :param on_chunk: 無音区間で分割して文字起こしする場合に，区間ごとの途中結果を次の区間の文字起こしの前に受け取る
+    """
+    start = time.perf_counter()
+    audio_hash = cached_file_hash(task.audio_file, task.data_dir, task.hash_algorithm)
+    cache_dir = os.path.join(task.data_dir, audio_hash)
+    logger.debug(f"speech to text [{task.index}] {task.audio_file}")
+    post_process: bool = False
+    is_srt: bool = False
+    # srtファイルをそのまま返す
+    if Path(task.audio_file).suffix == ".srt":
+        logger.debug("Skip Speech to Text : it's srt file")
+        stt_file = shutil.copy(task.audio_file, _tmp_file(task.tmp_dir))
+        is_srt = True
+    # オリジナル音声の用意
+    elif task.no_detect_silence:
+        # 文字起こし
+        stt_file = list(
+            transcribe_with_config(
+                [task.audio_file],
+                task.whisper_profile,
+                root_dir=cache_dir,
+                meta_data=str(task.speaker_id),
+            )
+        )[0]
+        post_process = True
+    # オリジナル音声の無音区間を切り抜き
+    else:
+        # 切り抜き音声をメモリ上で文字おこし
+        stt_file = transcribe_audio_non_silence_srt(
+            task.audio_file,
+            task.whisper_profile,
+            cache_dir,
+            meta_data=str(task.speaker_id),
+            keep_segments=task.keep_silence_segments,
+            on_segments=None if on_chunk is None else lambda raw: on_chunk(SttChunk(task.index, audio_hash, raw)),
+        )
+        post_process = True
+    # 文字起こしの結果を変更しないよう，GiNZA,後処理の結果はそれぞれ別の層としてキャッシュする
+    layer_dir = os.path.join(cache_dir, LAYER_DIR)
+    if post_process:
+        stt_file = srt_postprocess.cached_layer(
+            stt_file, "ginza", task.ginza.config(), layer_dir, task.ginza.reconstruct_subtitles
+        )
+
+    plain_stt_file = None
+    if len(task.post_processes) > 0:
+        plain_stt_file = stt_file
+        stt_file = srt_postprocess.post_process_layered(
+            stt_file, task.post_processes, layer_dir, task.post_process_options
+        )
+    return SttResult(
+        task.index,
+        stt_file,
+        audio_hash,
+        plain_stt_file,
+        is_srt,
+        os.getpid(),
+        peak_memory(),
+        time.perf_counter() - start,
+    )
+
+
+def _log_workers(results: List[SttResult]):
+    workers: Dict[int, List[SttResult]] = defaultdict(list)
+    for result in results:
+        workers[result.pid].append(result)
+    for pid, worker_results in workers.items():
+        peak = max((r.peak_memory or 0) for r in worker_results)
+        tracks = ",".join(str(r.index) for r in worker_results)
+        elapsed = sum(r.elapsed for r in worker_results)
+        peak_text = f"{peak / 1024 / 1024:.0f}MB" if peak else "-"
+        logger.info(f"[STT] worker pid:{pid} tracks:[{tracks}] {elapsed:.1f}s peak memory:{peak_text}")
+
+
+def run(
+    tasks: Sequence[SttTask], n_workers: int = 1, on_chunk: Optional[Callable[[SttChunk], None]] = None
+) -> Iterator[SttResult]:
+    """
+    トラックごとの文字起こしをn_workersのプロセスで並列に実行する
+    結果はtasksと同じ順番で返す
+    :param tasks:
+    :param n_workers: 1以下の場合は現在のプロセスで順に実行する
+    :param on_chunk: speech_to_text参照.現在のプロセスで実行する場合(n_workersが1以下)だけ呼ばれる
+    :return:
+    """
+    n_workers = min(n_workers, len(tasks))
+    results = []
+    if n_workers <= 1:
+        with whisper_context():
+            for task in tasks:
+                result = speech_to_text(task, on_chunk)
+                results.append(result)
+                yield result
+    else:
+        logger.info(f"[STT] run {len(tasks)} tracks with {n_workers} workers")
+        # CUDAを使うためforkではなくspawnで起動する
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for result in executor.map(speech_to_text, tasks):
+                results.append(result)
+                yield result
+    _log_workers(results)
@@ -0,0 +1,193 @@
+"""
+字幕を列ごとのnumpy配列で持つ表
+  start,end   : 開始,終了時刻(ミリ秒,int64)
+  speaker     : 話者(トラック)番号.-1は未設定
+  index       : srtのindex
+  text_start,text_end : 1つの文字列textの中の本文の範囲
+  proprietary,audio   : proprietaries,pathsの番号.audioの-1は音声無し
+結合,並べ替え,絞り込みは配列の操作で行い，srt.Subtitleには必要になった時に変換する
+"""
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import srt
+
+_MS = timedelta(milliseconds=1)
+
+
+def _intern(values: Sequence[str], ids: Dict[str, int]) -> np.ndarray:
+    return np.array([ids.setdefault(v, len(ids)) for v in values], dtype=np.int64)
+
+
+@dataclass(frozen=True, eq=False)
+class SubtitleTable:
+    start: np.ndarray
+    end: np.ndarray
+    speaker: np.ndarray
+    index: np.ndarray
+    text_start: np.ndarray
+    text_end: np.ndarray
+    proprietary: np.ndarray
+    audio: np.ndarray
+    text: str
+    proprietaries: Tuple[str, ...]
+    # 音声ファイルのパス(dtype=object).結合の際にポインタのコピーで済むよう配列で持つ
+    paths: np.ndarray
+
+    @staticmethod
+    def from_subtitles(
+            subtitles: Sequence[srt.Subtitle], speaker: int = -1, audio_files: Optional[Sequence[str]] = None
+    ) -> "SubtitleTable":
+        """
+        :param subtitles:
+        :param speaker: 全ての行に設定する話者番号
+        :param audio_files: 行ごとの音声ファイル.zipと同じく短い方に揃える
+        """
+        subtitles = list(subtitles)
+        if audio_files is not None:
+            subtitles = subtitles[: len(audio_files)]
+        n = len(subtitles)
+        contents = [s.content for s in subtitles]
+        lengths = np.fromiter(map(len, contents), dtype=np.int64, count=n)
+        text_end = np.cumsum(lengths)
+        proprietaries: Dict[str, int] = {}
+        paths: Dict[str, int] = {}
+        return SubtitleTable(
+            start=np.fromiter((s.start // _MS for s in subtitles), dtype=np.int64, count=n),
+            end=np.fromiter((s.end // _MS for s in subtitles), dtype=np.int64, count=n),
+            speaker=np.full(n, speaker, dtype=np.int64),
+            index=np.fromiter((s.index for s in subtitles), dtype=np.int64, count=n),
+            text_start=text_end - lengths,
+            text_end=text_end,
+            proprietary=_intern([s.proprietary for s in subtitles], proprietaries),
+            audio=(
+                np.full(n, -1, dtype=np.int64) if audio_files is None
+                else _intern(list(audio_files[:n]), paths)
+            ),
+            text="".join(contents),
+            proprietaries=tuple(proprietaries),
+            paths=np.array(list(paths), dtype=object),
+        )
+
+    @staticmethod
+    def read(
+            path: str, speaker: int = -1, audio_files: Optional[Sequence[str]] = None, encoding: str = "UTF-8"
+    ) -> "SubtitleTable":
+        return SubtitleTable.from_subtitles(
+            srt.parse(Path(path).read_text(encoding=encoding)), speaker, audio_files
+        )
+
+    @staticmethod
+    def concat(tables: Sequence["SubtitleTable"]) -> "SubtitleTable":
+        """
+        表を縦に結合する.proprietariesは重複を除いて番号を振り直す
+        pathsはトラックごとに異なるため，番号をずらしてそのまま繋げる
+        """
+        proprietaries: Dict[str, int] = {}
+        columns: Dict[str, List[np.ndarray]] = {
+            name: [] for name in ("start", "end", "speaker", "index", "text_start", "text_end", "proprietary", "audio")
+        }
+        text_offset, path_offset = 0, 0
+        for table in tables:
+            # 末尾の-1は番号-1(未設定)をそのまま-1に写すため
+            proprietary_map = np.append(_intern(table.proprietaries, proprietaries), -1)
+            for name in ("start", "end", "speaker", "index"):
+                columns[name].append(getattr(table, name))
+            columns["text_start"].append(table.text_start + text_offset)
+            columns["text_end"].append(table.text_end + text_offset)
+            columns["proprietary"].append(proprietary_map[table.proprietary])
+            columns["audio"].append(np.where(table.audio >= 0, table.audio + path_offset, -1))
+            text_offset += len(table.text)
+            path_offset += len(table.paths)
+        return SubtitleTable(
+            **{name: np.concatenate(c) if c else np.zeros(0, dtype=np.int64) for name, c in columns.items()},
+            text="".join(t.text for t in tables),
+            proprietaries=tuple(proprietaries),
+            paths=np.concatenate([t.paths for t in tables]) if tables else np.zeros(0, dtype=object),
+        )
+
+    def take(self, rows: np.ndarray) -> "SubtitleTable":
+        """
+        rowsの行だけを順に並べた表.本文の文字列はコピーせずに共有する
+        """
+        return SubtitleTable(
+            start=self.start[rows],
+            end=self.end[rows],
+            speaker=self.speaker[rows],
+            index=self.index[rows],
+            text_start=self.text_start[rows],
+            text_end=self.text_end[rows],
+            proprietary=self.proprietary[rows],
+            audio=self.audio[rows],
+            text=self.text,
+            proprietaries=self.proprietaries,
+            paths=self.paths,
+        )
+
+    def sort(self) -> "SubtitleTable":
+        """
+        開始時刻順.開始時刻が同じ行は元の順番(list.sortと同じく安定)
+        """
+        return self.take(np.argsort(self.start, kind="stable"))
+
+    def filter(self, mask: np.ndarray) -> "SubtitleTable":
+        return self.take(np.flatnonzero(mask))
+
+    def text_mask(self, predicate: Callable[[str], bool]) -> np.ndarray:
+        """
+        本文ごとのpredicateの結果.同じ本文は1回だけ評価する
+        """
+        contents = list(self.contents())
+        results = {content: bool(predicate(content)) for content in dict.fromkeys(contents)}
+        return np.fromiter(map(results.__getitem__, contents), dtype=bool, count=len(contents))
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def content(self, row: int) -> str:
+        return self.text[self.text_start[row]: self.text_end[row]]
+
+    def contents(self) -> Iterator[str]:
+        text = self.text
+        for s, e in zip(self.text_start.tolist(), self.text_end.tolist()):
+            yield text[s:e]
+
+    def audio_file(self, row: int) -> Optional[str]:
+        audio = self.audio[row]
+        return None if audio < 0 else self.paths[audio]
+
+    def subtitle(self, row: int) -> srt.Subtitle:
+        """
+        row行目をsrt.Subtitleに変換する.話者が設定されていればspeakerも設定する
+        """
+        subtitle = srt.Subtitle(
+            int(self.index[row]),
+            timedelta(milliseconds=int(self.start[row])),
+            timedelta(milliseconds=int(self.end[row])),
+            self.content(row),
+            self.proprietaries[self.proprietary[row]],
+        )
+        if self.speaker[row] >= 0:
+            subtitle.speaker = int(self.speaker[row])
+        return subtitle
+
+    def subtitles(self) -> Iterator[srt.Subtitle]:
+        columns = zip(
+            self.index.tolist(), self.start.tolist(), self.end.tolist(), self.contents(),
+            self.proprietary.tolist(), self.speaker.tolist(),
+        )
+        for index, start, end, content, proprietary, speaker in columns:
+            subtitle = srt.Subtitle(
+                index, timedelta(milliseconds=start), timedelta(milliseconds=end), content,
+                self.proprietaries[proprietary],
+            )
+            if speaker >= 0:
+                subtitle.speaker = speaker
+            yield subtitle
+
+    def audio_files(self) -> Iterator[Optional[str]]:
+        for audio in self.audio.tolist():
+            yield None if audio < 0 else self.paths[audio]
@@ -0,0 +1,198 @@
+"""
+SpeakerComposeのunitを開始時刻順に並べた索引
+開始,終了時刻(ミリ秒)と話者をnumpyの配列で持ち，二分探索で時刻の問い合わせに答える
+  at      : 時刻tに発話中のunit
+  between : 区間と重なるunit(話者で絞り込み可)
+  nearest : 時刻tに最も近いunit
+  find    : (index,proprietary)からunitを引く
+insert,remove,retimeは配列の該当位置だけを更新し，全体を並べ替えない
+"""
+import datetime
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from srt import Subtitle
+
+Time = Union[datetime.timedelta, int]
+
+_MS = datetime.timedelta(milliseconds=1)
+
+
+def to_ms(t: Time) -> int:
+    """
+    timedeltaはミリ秒に変換する.intはミリ秒としてそのまま使う
+    """
+    return t // _MS if isinstance(t, datetime.timedelta) else int(t)
+
+
+def speaker_of(subtitle: Subtitle) -> str:
+    """
+    merge()で設定されるspeakerがあればそれを，無ければproprietaryを話者とする
+    """
+    return str(getattr(subtitle, "speaker", subtitle.proprietary))
+
+
+class TimelineIndex:
+    """
+    unit(subtitleを持つもの)の開始時刻順の索引
+    開始時刻が同じ場合は追加した順(list.sortと同じく安定)
+    :param units:
+    """
+
+    def __init__(self, units: Sequence = ()):
+        units = list(units)
+        start = np.array([to_ms(u.subtitle.start) for u in units], dtype=np.int64)
+        order = np.argsort(start, kind="stable")
+        self._units: List = [units[i] for i in order]
+        self._start = start[order]
+        self._end = np.array([to_ms(u.subtitle.end) for u in self._units], dtype=np.int64)
+        self._codes: Dict[str, int] = {}
+        self._speaker = np.array([self._code(u.subtitle) for u in self._units], dtype=np.int64)
+        # subtitle.index -> unit.複数のsrtを結合するとindexは重複する
+        self._by_index: Dict[int, List] = defaultdict(list)
+        for u in self._units:
+            self._by_index[u.subtitle.index].append(u)
+        # 最も長いunitの長さ.時刻tと重なるunitは開始時刻がt-_max_duration以降にある
+        self._max_duration: Optional[int] = None
+
+    def _code(self, subtitle: Subtitle) -> int:
+        return self._codes.setdefault(speaker_of(subtitle), len(self._codes))
+
+    @property
+    def max_duration(self) -> int:
+        if self._max_duration is None:
+            self._max_duration = int((self._end - self._start).max(initial=0))
+        return self._max_duration
+
+    def __len__(self) -> int:
+        return len(self._units)
+
+    def __iter__(self) -> Iterator:
+        return iter(self._units)
+
+    def __getitem__(self, i: int):
+        return self._units[i]
+
+    def position(self, unit) -> int:
+        """
+        unitの索引上の位置.同じ開始時刻のunitの中から同一のものを探す
+        """
+        start = to_ms(unit.subtitle.start)
+        lo = int(np.searchsorted(self._start, start, side="left"))
+        hi = int(np.searchsorted(self._start, start, side="right"))
+        for i in range(lo, hi):
+            if self._units[i] is unit:
+                return i
+        # 索引に入れた後でsubtitleの時刻を直接書き換えた場合
+        for i, u in enumerate(self._units):
+            if u is unit:
+                return i
+        raise ValueError(f"unit is not in timeline: {unit.subtitle.index}")
+
+    def insert(self, unit) -> int:
+        """
+        :return: 追加した位置
+        """
+        start, end = to_ms(unit.subtitle.start), to_ms(unit.subtitle.end)
+        i = int(np.searchsorted(self._start, start, side="right"))
+        self._units.insert(i, unit)
+        self._start = np.insert(self._start, i, start)
+        self._end = np.insert(self._end, i, end)
+        self._speaker = np.insert(self._speaker, i, self._code(unit.subtitle))
+        self._by_index[unit.subtitle.index].append(unit)
+        if self._max_duration is not None:
+            self._max_duration = max(self._max_duration, end - start)
+        return i
+
+    def remove(self, unit) -> int:
+        """
+        :return: 削除した位置
+        """
+        i = self.position(unit)
+        if self._max_duration == self._end[i] - self._start[i]:
+            self._max_duration = None
+        del self._units[i]
+        self._start = np.delete(self._start, i)
+        self._end = np.delete(self._end, i)
+        self._speaker = np.delete(self._speaker, i)
+        same_index = self._by_index[unit.subtitle.index]
+        same_index[:] = [u for u in same_index if u is not unit]
+        if not same_index:
+            del self._by_index[unit.subtitle.index]
+        return i
+
+    def retime(self, unit, start: Time, end: Time) -> Tuple[int, int]:
+        """
+        unitの時刻を変更し，索引上の位置を移す
+        :return: 変更前の位置,変更後の位置
+        """
+        old = self.remove(unit)
+        unit.subtitle.start = datetime.timedelta(milliseconds=to_ms(start))
+        unit.subtitle.end = datetime.timedelta(milliseconds=to_ms(end))
+        return old, self.insert(unit)
+
+    def _window(self, start: int, end: int) -> Tuple[int, int]:
+        # 区間[start,end)と重なり得るunitの範囲
+        lo = int(np.searchsorted(self._start, start - self.max_duration, side="left"))
+        hi = int(np.searchsorted(self._start, end, side="left"))
+        return lo, hi
+
+    def _speaker_mask(self, lo: int, hi: int, speaker: Optional[str]) -> np.ndarray:
+        if speaker is None:
+            return np.ones(hi - lo, dtype=bool)
+        code = self._codes.get(str(speaker))
+        return self._speaker[lo:hi] == (-1 if code is None else code)
+
+    def at(self, t: Time, speaker: Optional[str] = None) -> List:
+        """
+        時刻tに発話中(start<=t<end)のunit
+        """
+        t = to_ms(t)
+        lo, hi = self._window(t, t + 1)
+        mask = (self._end[lo:hi] > t) & self._speaker_mask(lo, hi, speaker)
+        return [self._units[lo + i] for i in np.flatnonzero(mask)]
+
+    def between(self, start: Time, end: Time, speaker: Optional[str] = None) -> List:
+        """
+        区間[start,end)と重なるunit.開始時刻順
+        """
+        start, end = to_ms(start), to_ms(end)
+        lo, hi = self._window(start, end)
+        mask = (self._end[lo:hi] > start) & self._speaker_mask(lo, hi, speaker)
+        return [self._units[lo + i] for i in np.flatnonzero(mask)]
+
+    def nearest(self, t: Time, speaker: Optional[str] = None):
+        """
+        時刻tとの距離(発話区間の外側からの距離.発話中なら0)が最も小さいunit
+        距離が同じ場合は開始時刻が早いもの
+        """
+        t = to_ms(t)
+        best, best_distance = None, None
+        # tより後に始まるunit
+        after = int(np.searchsorted(self._start, t, side="right"))
+        mask = self._speaker_mask(after, len(self._units), speaker)
+        if mask.any():
+            i = after + int(np.argmax(mask))
+            best, best_distance = i, int(self._start[i]) - t
+        # t以前に始まるunitのうち，best_distance以内に終わり得るもの
+        lo = 0
+        if best_distance is not None:
+            lo = int(np.searchsorted(self._start, t - best_distance - self.max_duration, side="left"))
+        mask = self._speaker_mask(lo, after, speaker)
+        if mask.any():
+            distance = np.where(mask, np.maximum(0, t - self._end[lo:after]), np.iinfo(np.int64).max)
+            i = int(np.argmin(distance))
+            if best_distance is None or distance[i] <= best_distance:
+                best = lo + i
+        return None if best is None else self._units[best]
+
+    def find(self, index: int, proprietary: Optional[str] = None):
+        """
+        subtitleのindex,proprietaryが一致するunit(util.searchと同じ条件)
+        proprietaryを省略した場合はindexのみで探す
+        """
+        for u in self._by_index.get(index, ()):
+            if proprietary is None or u.subtitle.proprietary == proprietary:
+                return u
+        return None
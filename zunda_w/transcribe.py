@@ -1,12 +1,17 @@
 import contextlib
 import copy
 import hashlib
+import importlib.metadata
+import json
 import os
-import tempfile
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from typing import Any, Dict, Iterator, List, Literal, Sequence
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Literal, Optional, Sequence, Tuple, Union
+
+import numpy as np
 
 import whisper
 from dataclasses_json import dataclass_json
@@ -16,12 +21,16 @@ from tqdm import tqdm
 from whisperx.types import AlignedTranscriptionResult, SingleAlignedSegment
 
 from zunda_w import srt_ops
+from zunda_w.audio import to_float32
+from zunda_w.hash import cached_file_hash, concat_hash
 from zunda_w.model_cache import ModelCache
-from zunda_w.silent import Segment
-from zunda_w.util import text_hash
+from zunda_w.silent import Segment, iter_nonsilent
+from zunda_w.util import file_hash, text_hash
 from zunda_w.whisper_util import write_srt
 
 _in_memory_cache = ModelCache()
+WHISPER_X_MODEL = "large-v2"
+WHISPER_X_COMPUTE_TYPE = "float16"
 
 
 class ModelSize(Enum):
@@ -38,6 +47,8 @@ class WhisperProfile:
     model: ModelSize = ModelSize.small
     language: str = "ja"
     prompt: str = ""
+    # whisperXのバッチサイズ.2以上の場合は無音区間で分割した音声をまとめて文字起こしする
+    batch_size: int = 1
 
     def __hash__(self):
         data = f"{self.model}-{self.language}-{self.prompt}".encode("utf-8")
@@ -56,15 +67,15 @@ def whisper_context():
 
 
 def _transcribe_with_whisper_x(
-    profile: WhisperProfile, audio_file: str
+    profile: WhisperProfile, audio_file: Union[str, np.ndarray]
 ) -> AlignedTranscriptionResult:
     import whisperx
 
     logger.info("transcribe with whisper x")
     device = "cuda"
-    batch_size = 1  # reduce if low on GPU mem
-    compute_type = "float16"  # change to "int8" if low on GPU mem (may reduce accuracy)
-    model_size = "large-v2"
+    batch_size = max(1, profile.batch_size)  # reduce if low on GPU mem
+    compute_type = WHISPER_X_COMPUTE_TYPE  # change to "int8" if low on GPU mem (may reduce accuracy)
+    model_size = WHISPER_X_MODEL
     need_cache = False
     options = {
         "initial_prompt": profile.prompt,
@@ -73,7 +84,7 @@ def _transcribe_with_whisper_x(
     if not _in_memory_cache.exist("whisper_x", model_size):
         # if model_name not in _model_cache_whisper_x:
         model = whisperx.load_model(
-            "large-v2",
+            model_size,
             device,
             compute_type=compute_type,
             language=profile.language,
@@ -105,7 +116,7 @@ def _transcribe_with_whisper_x(
     return result_aligned
 
 
-def _transcribe_whisper(profile: WhisperProfile, audio_file: str):
+def _transcribe_whisper(profile: WhisperProfile, audio_file: Union[str, np.ndarray]):
     # match parameters whisper CLI default(best_of,fp16,beam_size,suppress_tokens...)
     logger.info("transcribe with whisper")
     if not _in_memory_cache.exist("whisper", profile.model):
@@ -202,7 +213,10 @@ def _whisper_x_post_process(result: AlignedTranscriptionResult):
     return result
 
 
-def _transcribe(model_name: str, profile: WhisperProfile, audio_file: str):
+def _transcribe(model_name: str, profile: WhisperProfile, audio_file: Union[str, np.ndarray]):
+    """
+    :param audio_file: ファイルパスか16kHz,monoのfloat32の配列
+    """
     if model_name == "whisper":
         return _transcribe_whisper(profile, audio_file)
     elif model_name == "whisper_x":
@@ -217,6 +231,162 @@ def _align_segment(seg: Dict, meta: Segment, idx: int) -> Dict:
     return seg
 
 
+def _shift_raw_segment(seg: Dict, to_original: Callable[[float], float]) -> Dict:
+    """
+    whisperXのsegment(単語の時刻を含む)の時刻を元の音声の時刻に変換する
+    """
+    for item in [seg, *seg.get("words", [])]:
+        for k in ("start", "end"):
+            if k in item:
+                item[k] = to_original(item[k])
+    return seg
+
+
+@dataclass
+class PackedAudio:
+    """
+    無音区間で分割した音声を間に無音を挟んで1つの配列に並べたもの
+    packed_starts[i]秒からsegments[i]の音声が始まる
+    """
+
+    audio: np.ndarray
+    segments: List[Segment]
+    packed_starts: np.ndarray
+    frame_rate: int = 16000
+
+    def to_original(self, t: float) -> float:
+        """
+        packした音声上の時刻(秒)を元の音声の時刻(秒)に変換する
+        区間の間の無音にあたる時刻は直前の区間の終わりに丸める
+        """
+        i = max(int(np.searchsorted(self.packed_starts, t, side="right")) - 1, 0)
+        segment = self.segments[i]
+        local = min(max(t - float(self.packed_starts[i]), 0.0), (segment.end - segment.start) / 1000.0)
+        return segment.start / 1000.0 + local
+
+
+def pack_segments(
+    segments: Sequence[Tuple[Segment, np.ndarray]], gap_ms: int = 500, frame_rate: int = 16000
+) -> PackedAudio:
+    """
+    :param segments: (Segment,float32の配列)
+    :param gap_ms: 区間の間に挟む無音の長さ(millisecond)
+    :param frame_rate:
+    :return:
+    """
+    gap = np.zeros(frame_rate * gap_ms // 1000, dtype=np.float32)
+    arrays = []
+    packed_starts = []
+    n = 0
+    for i, (_, audio) in enumerate(segments):
+        if i > 0:
+            arrays.append(gap)
+            n += len(gap)
+        packed_starts.append(n / frame_rate)
+        arrays.append(audio)
+        n += len(audio)
+    audio = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.float32)
+    return PackedAudio(audio, [meta for meta, _ in segments], np.asarray(packed_starts), frame_rate)
+
+
+def _chunk_segments(
+    segments: Iterable[Tuple[Segment, np.ndarray]], max_seconds: float, frame_rate: int = 16000
+) -> Iterator[List[Tuple[Segment, np.ndarray]]]:
+    chunk = []
+    n = 0
+    for meta, audio in segments:
+        if chunk and n + len(audio) > max_seconds * frame_rate:
+            yield chunk
+            chunk, n = [], 0
+        chunk.append((meta, audio))
+        n += len(audio)
+    if chunk:
+        yield chunk
+
+
+def transcribe_segments_raw(
+    segments: Iterable[Tuple[Segment, np.ndarray]],
+    profile: WhisperProfile,
+    max_seconds: float = 1800,
+) -> Iterator[List[Dict]]:
+    """
+    無音区間で分割した音声(Segment,float32の配列)をメモリ上のまま文字起こしし,
+    whisperXのalign後のsegment(単語ごとの時刻を含む)を元の音声の時刻に合わせて返す.
+
+    profile.batch_sizeが2以上の場合は区間をまとめて1つの配列にし，
+    whisperXのtranscribe,alignをまとめて1回ずつ実行する(1回にまとめる長さはmax_seconds秒まで)
+    :param segments:
+    :param profile:
+    :param max_seconds:
+    :return: 区間(まとめた場合はまとめた単位)ごとのsegment
+    """
+    logger.debug("Whisper profile:")
+    logger.debug(profile)
+    if profile.batch_size > 1:
+        for chunk in _chunk_segments(segments, max_seconds):
+            packed = pack_segments(chunk)
+            logger.debug(f"pack {len(chunk)} segments ({len(packed.audio) / packed.frame_rate:.1f}s)")
+            result = _transcribe_with_whisper_x(profile, packed.audio)
+            yield [_shift_raw_segment(seg, packed.to_original) for seg in result["segments"]]
+        return
+
+    for meta, audio in tqdm(segments, desc="Whisper Speech to Text"):
+        logger.debug(f"{meta}")
+        result = _transcribe_with_whisper_x(profile, audio)
+        offset = meta.start / 1000.0
+        yield [_shift_raw_segment(seg, lambda t: t + offset) for seg in result["segments"]]
+
+
+def _notify_segments(
+    packs: Iterable[List[Dict]], on_segments: Optional[Callable[[List[Dict]], None]]
+) -> Iterator[List[Dict]]:
+    """
+    区間(まとめた場合はまとめた単位)ごとの結果をon_segmentsに渡してから返す.次の区間の文字起こしの前に呼ばれる
+    """
+    for pack in packs:
+        if on_segments is not None:
+            on_segments(pack)
+        yield pack
+
+
+def raw_to_sentences(raw_segments: Sequence[Dict]) -> List[Dict]:
+    """
+    保存したwhisperXの結果からsrtの行を作る.元の結果は変更しない
+    """
+    return _whisper_x_post_process({"segments": copy.deepcopy(list(raw_segments))})["segments"]
+
+
+def transcribe_segments(
+    segments: Iterable[Tuple[Segment, np.ndarray]],
+    profile: WhisperProfile,
+    close_model: bool = False,
+) -> Iterator[List[Dict]]:
+    """
+    無音区間で分割した音声(Segment,float32の配列)をメモリ上のまま文字起こしする
+    結果の時刻はSegment.startだけずらして元の音声の時刻に合わせる
+    :param segments:
+    :param profile:
+    :param close_model:
+    :return:
+    """
+    idx = 0
+    for raw in transcribe_segments_raw(segments, profile):
+        result = raw_to_sentences(raw)
+        for seg in result:
+            seg["id"] += idx
+        idx += len(result)
+        yield result
+
+    if close_model:
+        clean_model()
+
+
+def _read_segments(wave_files: Sequence[str], meta_files: Sequence[str]) -> Iterator[Tuple[Segment, np.ndarray]]:
+    for audio_file, meta_file in zip(wave_files, meta_files):
+        meta = Segment.from_json(Path(meta_file).read_text(encoding="UTF-8"))
+        yield meta, to_float32(effects.normalize(AudioSegment.from_file(audio_file)))
+
+
 def transcribe_non_silence(
     wave_files: List[str],
     meta_files: List[str],
@@ -231,30 +401,85 @@ def transcribe_non_silence(
     :param close_model:
     :return:
     """
-    logger.debug("Whisper profile:")
-    logger.debug(profile)
+    return transcribe_segments(_read_segments(wave_files, meta_files), profile, close_model)
 
-    model = "whisper_x"
-    idx = 0
-    for audio_file, meta_file in tqdm(
-        zip(wave_files, meta_files), desc="Whisper Speech to Text"
-    ):
-        logger.debug(f"{audio_file},{meta_file}")
-        meta = Segment.from_json(Path(meta_file).read_text(encoding="UTF-8"))
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            audio = effects.normalize(AudioSegment.from_file(audio_file))
-            tmp_file_path = Path(tmp_dir).joinpath(Path(audio_file).name)
-            audio.export(tmp_file_path)
-
-            result = _transcribe(model, profile, str(tmp_file_path))
-        result = list(
-            map(lambda seg: _align_segment(seg, meta, idx), result["segments"])
-        )
-        idx += len(result)
-        yield result
 
-    if close_model:
-        clean_model()
+@lru_cache()
+def library_versions() -> Dict[str, Optional[str]]:
+    """
+    文字起こしの結果に影響するライブラリのバージョン
+    """
+    versions = {}
+    for name in ("whisperx", "faster-whisper", "ctranslate2", "torch"):
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def stt_cache_key(audio_hash: str, profile: WhisperProfile, **settings) -> str:
+    """
+    文字起こし結果のキャッシュのキー
+    音声のハッシュ,WhisperProfile(モデル,言語,プロンプト,バッチサイズ),
+    モデルの設定,無音区間の分割の設定(settings),ライブラリのバージョンから作る
+    """
+    data = {
+        "audio": audio_hash,
+        "profile": json.loads(profile.to_json()),
+        "model": {"name": WHISPER_X_MODEL, "compute_type": WHISPER_X_COMPUTE_TYPE},
+        "settings": settings,
+        "versions": library_versions(),
+    }
+    return text_hash(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str))
+
+
+def _stt_paths(key: str, root_dir: str, output_dir: str) -> Tuple[Path, Path]:
+    """
+    :return: (srtファイル, whisperXの結果(単語ごとの時刻を含む)のjson)
+    """
+    output_dir = Path(root_dir).joinpath(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    return output_dir.joinpath(key).with_suffix(".srt"), output_dir.joinpath(key).with_suffix(".raw.json")
+
+
+def load_raw(raw_path: Union[str, Path]) -> List[Dict]:
+    return json.loads(Path(raw_path).read_text(encoding="UTF-8"))
+
+
+def _save_raw(raw_path: Path, raw_segments: Sequence[Dict]):
+    tmp_path = raw_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(list(raw_segments), ensure_ascii=False, default=float), encoding="UTF-8")
+    os.replace(tmp_path, raw_path)
+
+
+def _cached_stt(
+    key: str, root_dir: str, output_dir: str, meta_data: Any, transcribe: Callable[[], Iterable[Dict]]
+) -> str:
+    """
+    srtがあればそのまま返す.whisperXの結果のjsonがあれば文字起こしせずにsrtを作り直す
+    どちらも無ければtranscribeを実行してjson,srtを保存する
+    """
+    output_srt_path, raw_path = _stt_paths(key, root_dir, output_dir)
+    logger.debug(f"srt path{output_srt_path}")
+    if output_srt_path.exists():
+        logger.debug("Skip Whisper transcribe use cache.")
+        return str(output_srt_path)
+    if raw_path.exists():
+        logger.debug("Rebuild srt from cached whisper result.")
+        raw_segments = load_raw(raw_path)
+    else:
+        raw_segments = list(transcribe())
+        _save_raw(raw_path, raw_segments)
+    _write_stt_srt(output_srt_path, raw_to_sentences(raw_segments), meta_data)
+    return str(output_srt_path)
+
+
+def _write_stt_srt(output_srt_path: Path, srts: Sequence[Dict], meta_data: Any, encoding: str = "UTF-8"):
+    with open(output_srt_path, "w", encoding=encoding) as srt_file:
+        write_srt(srts, file=srt_file)
+    if meta_data:
+        srt_ops.write_srt_with_meta(output_srt_path, meta_data, encoding=encoding)
 
 
 def transcribe_non_silence_srt(
@@ -264,6 +489,7 @@ def transcribe_non_silence_srt(
     root_dir: str = os.curdir,
     output_dir: str = ".stt",
     meta_data: Any = "",
+    on_segments: Optional[Callable[[List[Dict]], None]] = None,
 ) -> str:
     """
     無音区間を切り抜いた音声ファイル列からsrtファイルを生成．
@@ -274,29 +500,64 @@ def transcribe_non_silence_srt(
     :param root_dir:
     :param output_dir:
     :param meta_data
+    :param on_segments: 文字起こしの途中結果(区間ごとのwhisperXのsegment)を受け取る.変更してはいけない
+     キャッシュを使った場合は呼ばれない
     :return:
     """
-    output_dir = Path(root_dir).joinpath(output_dir)
-    output_dir.mkdir(exist_ok=True, parents=True)
-    encoding = "UTF-8"
-    file_name = text_hash(profile.to_json().encode(encoding=encoding))
-    output_srt_path = output_dir.joinpath(file_name).with_suffix(".srt")
-    logger.debug(f"srt path{output_srt_path} hash:{profile.__hash__()}")
-    if output_srt_path.exists():
-        logger.debug("Skip Whisper transcribe use cache.")
-        return str(output_srt_path)
-    srts = []
-    i = 0
-    for result in transcribe_non_silence(wave_files, meta_files, profile):
-        logger.debug(f"{i} wav:{wave_files[i]},meta:{meta_files[i]}")
-        srts.extend(result)
-        i += 1
+    audio_hash = concat_hash(
+        [cached_file_hash(f, root_dir) for f in wave_files] + [file_hash(f) for f in meta_files]
+    )
+    key = stt_cache_key(audio_hash, profile, mode="silence_files")
+    return _cached_stt(
+        key,
+        root_dir,
+        output_dir,
+        meta_data,
+        lambda: chain.from_iterable(
+            _notify_segments(transcribe_segments_raw(_read_segments(wave_files, meta_files), profile), on_segments)
+        ),
+    )
 
-    with open(output_srt_path, "w", encoding=encoding) as srt_file:
-        write_srt(srts, file=srt_file)
-    if meta_data:
-        srt_ops.write_srt_with_meta(output_srt_path, meta_data, encoding=encoding)
-    return str(output_srt_path)
+
+def transcribe_audio_non_silence_srt(
+    audio_file: str,
+    profile: WhisperProfile,
+    root_dir: str = os.curdir,
+    output_dir: str = ".stt",
+    meta_data: Any = "",
+    keep_segments: bool = False,
+    on_segments: Optional[Callable[[List[Dict]], None]] = None,
+    **silence_settings,
+) -> str:
+    """
+    音声ファイルを無音区間で分割し，分割した音声をファイルに書き出さずに文字起こししてsrtファイルを生成．
+
+    :param audio_file:
+    :param profile:
+    :param root_dir:
+    :param output_dir:
+    :param meta_data:
+    :param keep_segments: Trueの場合は分割した音声と.metaもroot_dirに書き出す
+    :param on_segments: transcribe_non_silence_srt参照
+    :param silence_settings: silent.iter_nonsilentの引数
+    :return:
+    """
+    key = stt_cache_key(cached_file_hash(audio_file, root_dir), profile, mode="silence", **silence_settings)
+    return _cached_stt(
+        key,
+        root_dir,
+        output_dir,
+        meta_data,
+        lambda: chain.from_iterable(
+            _notify_segments(
+                transcribe_segments_raw(
+                    iter_nonsilent(audio_file, root_dir=root_dir if keep_segments else None, **silence_settings),
+                    profile,
+                ),
+                on_segments,
+            )
+        ),
+    )
 
 
 def transcribe_with_config(
@@ -306,8 +567,10 @@ def transcribe_with_config(
     output_dir: str = ".stt",
     close_model: bool = False,
     meta_data: Any = "",
-) -> List[str]:
+) -> Iterator[str]:
     """
+    音声ファイルごとに文字起こししてsrtファイルを生成.
+    キャッシュは音声の内容とWhisperProfile,モデル,ライブラリのバージョンをキーにする
 
     :param wave_files:
     :param profile:
@@ -317,30 +580,14 @@ def transcribe_with_config(
     :param meta_data: 文字起こしした結果のsrtのproprietaryに設定するメタデータ
     :return:
     """
-    output_dir = Path(root_dir).joinpath(output_dir)
-    output_dir.mkdir(exist_ok=True, parents=True)
-    model = "whisper_x"
-
-    encoding = "UTF-8"
     for audio_file in tqdm(wave_files, desc="Whisper Speech to Text"):
-        file_name = Path(audio_file).stem
-        output_srt_path = output_dir.joinpath(file_name).with_suffix(".srt")
-        # TODO 設定に基づくキャッシュを行う(現在はパラメータ関係なくキャッシュしている)b
-        if output_srt_path.exists():
-            logger.debug("Skip Whisper transcribe use cache.")
-            yield str(output_srt_path)
-            break
-        with tempfile.TemporaryDirectory() as tmpdir:
-            audio = effects.normalize(AudioSegment.from_file(audio_file))
-            tmp_file_path = os.path.join(tmpdir, file_name)
-            audio.export(tmp_file_path)
-            result = _transcribe(model, profile, tmp_file_path)
-
-        with open(output_srt_path, "w", encoding=encoding) as srt_file:
-            write_srt(result["segments"], file=srt_file)
-        if meta_data:
-            srt_ops.write_srt_with_meta(output_srt_path, meta_data, encoding=encoding)
-        yield str(output_srt_path)
+        key = stt_cache_key(cached_file_hash(audio_file, root_dir), profile, mode="whole")
+
+        def transcribe() -> List[Dict]:
+            audio = to_float32(effects.normalize(AudioSegment.from_file(audio_file)))
+            return _transcribe_with_whisper_x(profile, audio)["segments"]
+
+        yield _cached_stt(key, root_dir, output_dir, meta_data, transcribe)
 
     if close_model:
         clean_model()
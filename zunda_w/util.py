@@ -1,17 +1,49 @@
 import hashlib
 import json
 import os
+import threading
 from pathlib import Path
-from typing import Sequence, Union, Optional
+from typing import Callable, Optional, Sequence, Union
 
 import srt
 import yaml
 from loguru import logger
 
 
-def file_hash(path: Union[str, Path], hash_fun=hashlib.md5) -> str:
-    with open(path, "rb") as fp:
-        return hash_fun(fp.read()).hexdigest()
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def new_hash(hash_fun: Union[str, Callable] = hashlib.md5):
+    """
+    ハッシュ関数(hashlib.md5など)か名前("md5","blake2b","xxh3_128"...)からハッシュオブジェクトを作成
+    xxhashはインストールされている場合のみ使える
+    """
+    if callable(hash_fun):
+        return hash_fun()
+    if hash_fun.startswith("xxh"):
+        try:
+            import xxhash
+        except ImportError as e:
+            raise ImportError(f"{hash_fun} requires xxhash. pip install xxhash") from e
+        return getattr(xxhash, hash_fun)()
+    return hashlib.new(hash_fun)
+
+
+def file_hash(path: Union[str, Path], hash_fun: Union[str, Callable] = hashlib.md5,
+              chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """
+    ファイルをchunk_sizeずつ読んでハッシュ値を計算する.ファイル全体をメモリに載せない
+    """
+    h = new_hash(hash_fun)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as fp:
+        while True:
+            n = fp.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
 
 
 def text_hash(content: Union[bytes, str], hash_fun=hashlib.md5) -> str:
@@ -34,6 +66,32 @@ def write_json(data: dict, json_path: Union[str, Path]):
     return json_path
 
 
+def write_bytes_atomic(path: Union[str, Path], data: bytes) -> str:
+    """
+    一時ファイルに書き込んでから置き換える.fsyncは行わない
+    書き込み途中のファイルを他のスレッド,プロセスが読むことは無い
+    """
+    path = str(path)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+    return path
+
+
+def fsync_dir(directory: Union[str, Path]):
+    """
+    フォルダのエントリ(作成,置き換えたファイル)をディスクに反映させる.windowsでは何もしない
+    """
+    if os.name == "nt":
+        return
+    fd = os.open(str(directory), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def write_srt(
         path: Union[str, Path],
         data: Sequence[srt.Subtitle],
@@ -0,0 +1,216 @@
+"""
+VOICEVOX engineへのHTTPクライアント
+コネクションを使いまわし，同時リクエスト数を制限する
+"""
+import io
+import json
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from zunda_w.voicevox.health import Backoff, CircuitBreaker, EngineUnavailableError
+
+DEFAULT_URL = "http://localhost:50021"
+TIMEOUT = (10.0, 300.0)
+
+
+class RequestRejected(ConnectionError):
+    """
+    engineが4xxを返した.リトライしても結果は変わらない
+    """
+
+
+@dataclass
+class ClientStats:
+    """
+    エンドポイントごとのリクエスト数と所要時間
+    """
+
+    n_requests: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    elapsed: Dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    n_retry: int = 0
+    retries: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    n_lines: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, endpoint: str, elapsed: float):
+        with self._lock:
+            self.n_requests[endpoint] += 1
+            self.elapsed[endpoint] += elapsed
+
+    def add_retry(self, endpoint: str = ""):
+        with self._lock:
+            self.n_retry += 1
+            self.retries[endpoint] += 1
+
+    def add_lines(self, n: int):
+        with self._lock:
+            self.n_lines += n
+
+    def summary(self, wall_time: Optional[float] = None) -> str:
+        requests_text = ", ".join(
+            f"{k}:{v}({self.elapsed[k]:.2f}s)" for k, v in sorted(self.n_requests.items())
+        )
+        text = f"lines:{self.n_lines} requests[{requests_text}] retry:{self.n_retry}"
+        if self.n_retry:
+            text += "(" + ", ".join(f"{k}:{v}" for k, v in sorted(self.retries.items())) + ")"
+        if wall_time:
+            text += f" {wall_time:.2f}s ({self.n_lines / wall_time:.2f} lines/s)"
+        return text
+
+
+class VoiceVoxClient:
+    """
+    :param base_url: engineのURL
+    :param max_in_flight: engineに同時に投げるリクエストの上限.engineのワーカー数に合わせる
+    :param batch_size: /multi_synthesisで一度に合成する行数.1の場合は/synthesisのみ使う
+    :param max_retry:
+    :param retry_interval: 最初のリトライまでの待ち時間(秒).以降は指数的に伸ばす
+    :param max_retry_interval: リトライまでの待ち時間の上限(秒)
+    :param stats: 複数のクライアントで統計をまとめる場合に渡す
+    :param breaker: 失敗が続いた場合にリクエストを止める.Noneの場合はこのengine用に作る
+    """
+
+    def __init__(
+            self,
+            base_url: str = DEFAULT_URL,
+            max_in_flight: int = 4,
+            batch_size: int = 8,
+            max_retry: int = 20,
+            retry_interval: float = 0.1,
+            max_retry_interval: float = 2.0,
+            stats: Optional[ClientStats] = None,
+            breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.max_in_flight = max(1, max_in_flight)
+        self.batch_size = max(1, batch_size)
+        self.max_retry = max_retry
+        self.backoff = Backoff(initial=retry_interval, maximum=max_retry_interval)
+        self.stats = stats or ClientStats()
+        self.breaker = breaker or CircuitBreaker(self.base_url)
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight * 2)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._multi_synthesis: Optional[bool] = None
+
+    def _post(self, path: str, **kwargs) -> Optional[requests.Response]:
+        """
+        同時リクエストの枠を取ってからbreakerを確認して送る.枠を待つ間にbreakerが開いた場合は送らずにNone
+        成功,失敗は同じ枠の中でbreakerに記録する(4xxはengineの異常ではないので成功として扱う)
+        """
+        with self._slots:
+            if not self.breaker.allow():
+                return None
+            start = time.perf_counter()
+            try:
+                r = self._session.post(f"{self.base_url}{path}", timeout=TIMEOUT, **kwargs)
+            except requests.RequestException:
+                self.breaker.record_failure()
+                raise
+            self.stats.add(path, time.perf_counter() - start)
+            if r.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return r
+
+    def _post_with_retry(
+            self, path: str, description: str, max_retry: Optional[int] = None, **kwargs
+    ) -> requests.Response:
+        """
+        5xx,接続エラーは待ち時間を伸ばしながらリトライする.4xxはリトライしても変わらないのでそのまま失敗する
+        """
+        error = ""
+        unavailable = False
+        for attempt in range(max_retry or self.max_retry):
+            if attempt > 0:
+                self.stats.add_retry(path)
+                time.sleep(max(self.backoff.delay(attempt - 1), self.breaker.retry_after()))
+            try:
+                r = self._post(path, **kwargs)
+            except requests.RequestException as e:
+                unavailable = False
+                error = str(e)
+                continue
+            unavailable = r is None
+            if unavailable:
+                continue
+            if r.status_code == 200:
+                return r
+            error = r.text
+            if r.status_code < 500:
+                raise RequestRejected(f"{r.status_code} {path} : {description}", error)
+        if unavailable:
+            raise EngineUnavailableError(f"{self.base_url} is unavailable. {path} : {description}")
+        raise ConnectionError(f"リトライ回数が上限に到達しました。 {path} : {description}", error)
+
+    def audio_query(self, text: str, speaker: int, max_retry: Optional[int] = None) -> Dict:
+        r = self._post_with_retry(
+            "/audio_query", text[:30], max_retry, params={"text": text, "speaker": speaker}
+        )
+        return r.json()
+
+    def synthesis(self, query_data: Dict, speaker: int, max_retry: Optional[int] = None) -> bytes:
+        r = self._post_with_retry(
+            "/synthesis", str(speaker), max_retry, params={"speaker": speaker}, data=json.dumps(query_data)
+        )
+        return r.content
+
+    @property
+    def supports_multi_synthesis(self) -> bool:
+        """
+        engineが/multi_synthesisを実装しているか/openapi.jsonで確認する
+        """
+        if self._multi_synthesis is None:
+            try:
+                r = self._session.get(f"{self.base_url}/openapi.json", timeout=TIMEOUT)
+                self._multi_synthesis = r.status_code == 200 and "/multi_synthesis" in r.json().get("paths", {})
+            except (requests.RequestException, ValueError):
+                self._multi_synthesis = False
+            logger.debug(f"[VOICEVOX] multi_synthesis:{self._multi_synthesis}")
+        return self._multi_synthesis
+
+    def multi_synthesis(
+            self, queries: Sequence[Dict], speaker: int, max_retry: Optional[int] = None
+    ) -> List[bytes]:
+        """
+        複数のaudio_queryを1リクエストで合成する
+        engineはwavをzipにまとめて返す(001.wav,002.wav,...)
+        """
+        r = self._post_with_retry(
+            "/multi_synthesis", str(speaker), max_retry, params={"speaker": speaker}, data=json.dumps(list(queries))
+        )
+        with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+            names = sorted(archive.namelist())
+            if len(names) != len(queries):
+                raise ConnectionError(f"multi_synthesis returned {len(names)} files for {len(queries)} queries")
+            return [archive.read(name) for name in names]
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_default_client: Optional[VoiceVoxClient] = None
+
+
+def default_client() -> VoiceVoxClient:
+    global _default_client
+    if _default_client is None:
+        _default_client = VoiceVoxClient()
+    return _default_client
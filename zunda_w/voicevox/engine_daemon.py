@@ -0,0 +1,438 @@
+"""
+VOICEVOX engineを常駐させ，CLI,GUIの複数の実行で使いまわす
+
+ポートで既にengineが起動していればそれに接続し，無ければ親プロセスから切り離してengineを起動する
+状態は<state_dir>/engine-<port>.* に保存する
+  .json        : 起動したengineと監視プロセスのpid
+  .lock        : 起動,停止の排他
+  .leases/     : engineを使用中のプロセスごとのファイル
+  .last_used   : 最後に使い終わった時刻(mtime)
+使用中のプロセスが無い状態がidle_timeout秒続くと監視プロセスがengineを停止する
+
+監視プロセスはこのファイルをスクリプトとして実行するため，zunda_wパッケージをimportしない
+python engine_daemon.py watch --port 50021 --state_dir ~/.cache/voicevox/daemon
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+import requests
+from loguru import logger
+
+DEFAULT_PORT = 50021
+# 使用中のプロセスが無くなってからengineを停止するまでの秒数
+IDLE_TIMEOUT = 600.0
+STARTUP_TIMEOUT = 60.0
+WATCH_INTERVAL = 5.0
+
+ExePath = Union[str, Callable[[], Optional[str]]]
+
+
+def pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    if os.name == "nt":
+        import ctypes
+
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        ok = kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        # STILL_ACTIVE
+        return bool(ok) and code.value == 259
+    try:
+        # 自分の子プロセスの場合はゾンビを回収する
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        # 他のプロセスの子でまだ回収されていないゾンビ(linux)
+        return Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+def terminate(pid: int, timeout: float = 10.0):
+    """
+    プロセスを終了させる.timeout秒以内に終了しなければ強制終了する
+    """
+    if not pid_alive(pid):
+        return
+    if os.name == "nt":
+        subprocess.run(["taskkill", "/PID", str(pid), "/T", "/F"], capture_output=True)
+        return
+    os.kill(pid, signal.SIGTERM)
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if not pid_alive(pid):
+            return
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+
+
+def _detached_kwargs() -> Dict:
+    """
+    親プロセス(CLI,GUI)が終了しても動き続けるようにする
+    """
+    kwargs = dict(stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True)
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    return kwargs
+
+
+class LockFile:
+    """
+    O_EXCLで作成するロックファイル.中身は保持しているプロセスのpid
+    保持したままプロセスが落ちた場合は次に取得するプロセスが削除する
+    """
+
+    def __init__(self, path: str, timeout: float = STARTUP_TIMEOUT + 30):
+        self.path = path
+        self.timeout = timeout
+
+    def _owner(self) -> Optional[int]:
+        try:
+            return int(Path(self.path).read_text() or 0)
+        except (OSError, ValueError):
+            return None
+
+    def __enter__(self):
+        start = time.perf_counter()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                owner = self._owner()
+                if owner is not None and not pid_alive(owner):
+                    logger.debug(f"[VOICEVOX] remove stale lock {self.path} (pid:{owner})")
+                    Path(self.path).unlink(missing_ok=True)
+                    continue
+                if time.perf_counter() - start > self.timeout:
+                    raise TimeoutError(f"lock {self.path} is held by pid:{owner}")
+                time.sleep(0.1)
+                continue
+            with os.fdopen(fd, "w") as fp:
+                fp.write(str(os.getpid()))
+            return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        Path(self.path).unlink(missing_ok=True)
+
+
+@dataclass
+class EngineState:
+    pid: int
+    port: int
+    exe_path: str
+    started: float
+    watcher_pid: Optional[int] = None
+
+
+class EngineDaemon:
+    """
+    :param port:
+    :param state_dir: pidfile,lockfileなどを置くフォルダ.Noneの場合は~/.cache/voicevox/daemon
+    :param idle_timeout: 使用中のプロセスが無くなってからengineを停止するまでの秒数
+    :param startup_timeout: engineの起動を待つ秒数
+    :param watch_interval: 監視プロセスがアイドル状態を確認する間隔(秒)
+    :param cpu_num_threads: engineの推論スレッド数.複数のengineでCPUを分け合う場合に指定する
+    """
+
+    def __init__(
+            self,
+            port: int = DEFAULT_PORT,
+            state_dir: Optional[str] = None,
+            idle_timeout: float = IDLE_TIMEOUT,
+            startup_timeout: float = STARTUP_TIMEOUT,
+            watch_interval: float = WATCH_INTERVAL,
+            cpu_num_threads: Optional[int] = None,
+    ):
+        if state_dir is None:
+            from zunda_w import cache
+
+            state_dir = os.path.join(cache.user_cache_dir("voicevox"), "daemon")
+        self.port = port
+        self.state_dir = state_dir
+        self.idle_timeout = idle_timeout
+        self.startup_timeout = startup_timeout
+        self.watch_interval = watch_interval
+        self.cpu_num_threads = cpu_num_threads
+        Path(self.lease_dir).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://localhost:{self.port}"
+
+    def _path(self, suffix: str) -> str:
+        return os.path.join(self.state_dir, f"engine-{self.port}{suffix}")
+
+    @property
+    def state_file(self) -> str:
+        return self._path(".json")
+
+    @property
+    def lease_dir(self) -> str:
+        return self._path(".leases")
+
+    def lock(self) -> LockFile:
+        return LockFile(self._path(".lock"), timeout=self.startup_timeout + 30)
+
+    def is_ready(self) -> bool:
+        try:
+            return requests.get(f"{self.url}/version", timeout=1.0).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def read_state(self) -> Optional[EngineState]:
+        try:
+            return EngineState(**json.loads(Path(self.state_file).read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _write_state(self, state: Optional[EngineState]):
+        if state is None:
+            Path(self.state_file).unlink(missing_ok=True)
+            return
+        tmp = f"{self.state_file}.{os.getpid()}.tmp"
+        Path(tmp).write_text(json.dumps(asdict(state)))
+        os.replace(tmp, self.state_file)
+
+    def command(self, exe_path: str) -> List[str]:
+        command = [exe_path, "--use_gpu", "--port", str(self.port)]
+        if self.cpu_num_threads:
+            command += ["--cpu_num_threads", str(self.cpu_num_threads)]
+        return command
+
+    def _launch(self, exe_path: ExePath) -> EngineState:
+        exe_path = exe_path() if callable(exe_path) else exe_path
+        if not exe_path:
+            raise FileNotFoundError("voicevox engine is not found")
+        # 監視プロセスからは呼ばないためここでimportする
+        from zunda_w.voicevox import health
+
+        logger.info(f"[VOICEVOX] Launch {exe_path} on port {self.port}")
+        process = subprocess.Popen(self.command(exe_path), **_detached_kwargs())
+        state = EngineState(process.pid, self.port, exe_path, time.time())
+        self._write_state(state)
+        try:
+            elapsed = health.wait_until_ready(self.url, self.startup_timeout, alive=lambda: process.poll() is None)
+        except (health.EngineNotReadyError, ChildProcessError):
+            terminate(process.pid)
+            self._write_state(None)
+            raise
+        logger.info(f"[VOICEVOX] engine ready in {elapsed:.1f}s (pid:{process.pid})")
+        return state
+
+    def _spawn_watcher(self, state: EngineState) -> EngineState:
+        args = [
+            sys.executable, os.path.abspath(__file__), "watch",
+            "--port", str(self.port),
+            "--state_dir", self.state_dir,
+            "--idle_timeout", str(self.idle_timeout),
+            "--interval", str(self.watch_interval),
+        ]
+        state.watcher_pid = subprocess.Popen(args, **_detached_kwargs()).pid
+        self._write_state(state)
+        return state
+
+    def ensure_running(self, exe_path: ExePath) -> bool:
+        """
+        lockを取得した状態で呼ぶ.engineが無ければ起動する
+        :return: 既に起動しているengineに接続した場合True
+        """
+        state = self.read_state()
+        if self.is_ready():
+            # 自分たちで起動したengineの監視が止まっていれば再開する
+            if state is not None and pid_alive(state.pid) and not pid_alive(state.watcher_pid):
+                self._spawn_watcher(state)
+            logger.debug(f"[VOICEVOX] attach running engine {self.url}")
+            return True
+        if state is not None:
+            # 応答しないengineが残っている
+            terminate(state.pid)
+            self._write_state(None)
+        self._spawn_watcher(self._launch(exe_path))
+        return False
+
+    def _add_lease(self) -> str:
+        lease = os.path.join(self.lease_dir, f"{os.getpid()}-{uuid.uuid4().hex}")
+        Path(lease).touch()
+        return lease
+
+    def _release(self, lease: str):
+        Path(lease).unlink(missing_ok=True)
+        Path(self._path(".last_used")).touch()
+
+    def active_leases(self) -> List[str]:
+        """
+        使用中のプロセスのリース.終了したプロセスのものは削除する
+        """
+        leases = []
+        for lease in Path(self.lease_dir).iterdir():
+            pid = lease.name.split("-")[0]
+            if pid.isdigit() and pid_alive(int(pid)):
+                leases.append(str(lease))
+            else:
+                lease.unlink(missing_ok=True)
+        return leases
+
+    @contextmanager
+    def session(self, exe_path: ExePath) -> Iterator[str]:
+        """
+        engineを使用している間のコンテキスト.抜けてもengineは停止しない
+        :param exe_path: engineの実行ファイル.起動が必要な場合だけ呼ぶ関数でもよい
+        :return: engineのURL
+        """
+        with self.lock():
+            self.ensure_running(exe_path)
+            lease = self._add_lease()
+        try:
+            yield self.url
+        finally:
+            self._release(lease)
+
+    def idle_seconds(self) -> float:
+        state = self.read_state()
+        last_used = [state.started] if state else []
+        if os.path.exists(self._path(".last_used")):
+            last_used.append(os.path.getmtime(self._path(".last_used")))
+        return time.time() - max(last_used, default=time.time())
+
+    def stop(self) -> bool:
+        """
+        起動したengineと監視プロセスを停止する.他で起動されたengineは停止しない
+        :return: 停止した場合True
+        """
+        with self.lock():
+            return self._stop()
+
+    def _stop(self) -> bool:
+        state = self.read_state()
+        if state is None:
+            return False
+        logger.info(f"[VOICEVOX] stop engine pid:{state.pid} port:{self.port}")
+        terminate(state.pid)
+        if state.watcher_pid != os.getpid():
+            terminate(state.watcher_pid)
+        self._write_state(None)
+        return True
+
+    def check_idle(self) -> bool:
+        """
+        使用中のプロセスが無く，idle_timeout秒経過していればengineを停止する
+        :return: engineが停止している場合True
+        """
+        state = self.read_state()
+        if state is None or not pid_alive(state.pid):
+            with self.lock():
+                self._write_state(None)
+            return True
+        if self.active_leases() or self.idle_seconds() < self.idle_timeout:
+            return False
+        with self.lock():
+            # lockを取る間に使い始めたプロセスがいないか確認
+            if self.active_leases():
+                return False
+            return self._stop()
+
+    def watch(self):
+        while not self.check_idle():
+            time.sleep(self.watch_interval)
+
+    def status(self) -> Dict:
+        state = self.read_state()
+        return {
+            "url": self.url,
+            "ready": self.is_ready(),
+            "managed": state is not None and pid_alive(state.pid),
+            "pid": state.pid if state else None,
+            "leases": len(self.active_leases()),
+            "idle": round(self.idle_seconds(), 1),
+        }
+
+
+@contextmanager
+def shared_engine(
+        exe_path: ExePath, idle_timeout: float = IDLE_TIMEOUT, port: int = DEFAULT_PORT
+) -> Iterator[str]:
+    """
+    常駐しているengineを使う.無ければ起動し，idle_timeout秒使われなければ停止する
+    :return: engineのURL
+    """
+    with EngineDaemon(port=port, idle_timeout=idle_timeout).session(exe_path) as url:
+        yield url
+
+
+def _resolve_once(exe_path: ExePath) -> Callable[[], Optional[str]]:
+    """
+    複数のengineを起動する場合もengineの展開は1回だけ行う
+    """
+    lock = threading.Lock()
+    resolved = []
+
+    def resolve() -> Optional[str]:
+        with lock:
+            if not resolved:
+                resolved.append(exe_path() if callable(exe_path) else exe_path)
+            return resolved[0]
+
+    return resolve
+
+
+@contextmanager
+def shared_engines(
+        exe_path: ExePath, n_engines: int = 1, idle_timeout: float = IDLE_TIMEOUT, port: int = DEFAULT_PORT
+) -> Iterator[List[str]]:
+    """
+    port,port+1,...のn_engines個のengineを使う.起動が必要なものは並列に起動する
+    複数の場合はCPUのコアをengineで等分する
+    :return: engineのURL
+    """
+    cpu_num_threads = max(1, (os.cpu_count() or 1) // n_engines) if n_engines > 1 else None
+    resolve = _resolve_once(exe_path)
+    daemons = [
+        EngineDaemon(port=port + i, idle_timeout=idle_timeout, cpu_num_threads=cpu_num_threads)
+        for i in range(n_engines)
+    ]
+    with ExitStack() as stack:
+        with ThreadPoolExecutor(max(1, n_engines)) as pool:
+            futures = [pool.submit(stack.enter_context, daemon.session(resolve)) for daemon in daemons]
+        yield [future.result() for future in futures]
+
+
+def watch(port: int = DEFAULT_PORT, state_dir: str = ".", idle_timeout: float = IDLE_TIMEOUT,
+          interval: float = WATCH_INTERVAL):
+    logger.remove()
+    logger.add(os.path.join(state_dir, f"engine-{port}.log"), rotation="1 MB", retention=1)
+    daemon = EngineDaemon(port, state_dir, idle_timeout=idle_timeout, watch_interval=interval)
+    logger.info(f"[VOICEVOX] watch engine port:{port} idle_timeout:{idle_timeout}s")
+    daemon.watch()
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire({"watch": watch})
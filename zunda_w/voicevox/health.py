@@ -0,0 +1,184 @@
+"""
+VOICEVOX engineの死活確認とリトライ制御
+  Backoff        : 指数バックオフ+ジッタの待ち時間
+  wait_until_ready: /versionが応答するまで待つ.タイムアウトでEngineNotReadyError
+  CircuitBreaker : 失敗が続いたengineへのリクエストを一定時間止める
+起動時間,リトライ回数などはmetricsに記録する
+"""
+import random
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional
+
+import requests
+from loguru import logger
+
+
+class EngineNotReadyError(TimeoutError):
+    pass
+
+
+class EngineUnavailableError(ConnectionError):
+    """
+    circuit breakerが開いているためリクエストを送らなかった
+    """
+
+
+@dataclass
+class HealthMetrics:
+    """
+    engine(URL)ごとの起動時間,死活確認の回数,circuit breakerが開いた回数
+    """
+
+    startup: Dict[str, float] = field(default_factory=dict)
+    n_probes: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    n_breaker_open: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add_startup(self, url: str, elapsed: float):
+        with self._lock:
+            self.startup[url] = elapsed
+
+    def add_probe(self, url: str):
+        with self._lock:
+            self.n_probes[url] += 1
+
+    def add_breaker_open(self, url: str):
+        with self._lock:
+            self.n_breaker_open[url] += 1
+
+    def summary(self) -> str:
+        with self._lock:
+            return ", ".join(
+                f"{url}[startup:{self.startup.get(url, 0):.2f}s probe:{self.n_probes[url]} "
+                f"breaker:{self.n_breaker_open[url]}]"
+                for url in sorted(set(self.startup) | set(self.n_probes) | set(self.n_breaker_open))
+            )
+
+
+metrics = HealthMetrics()
+
+
+@dataclass(frozen=True)
+class Backoff:
+    """
+    attempt回目(0始まり)の待ち時間 initial * factor ** attempt (上限maximum)
+    jitterの割合だけランダムに短くし，複数のスレッド,プロセスのリトライが揃わないようにする
+    """
+
+    initial: float = 0.1
+    maximum: float = 2.0
+    factor: float = 2.0
+    jitter: float = 0.5
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.maximum, self.initial * self.factor ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+
+def probe(url: str, timeout: float = 1.0) -> bool:
+    metrics.add_probe(url)
+    try:
+        return requests.get(f"{url}/version", timeout=timeout).status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def wait_until_ready(
+        url: str,
+        timeout: float = 30,
+        backoff: Backoff = Backoff(initial=0.05, maximum=1.0),
+        alive: Optional[Callable[[], bool]] = None,
+) -> float:
+    """
+    /versionが応答するまで待つ
+    :param url:
+    :param timeout:
+    :param backoff:
+    :param alive: engineのプロセスが生きているか.Falseになったら待たずに失敗する
+    :return: 応答までの秒数
+    """
+    start = time.perf_counter()
+    attempt = 0
+    while not probe(url, timeout=min(1.0, timeout)):
+        elapsed = time.perf_counter() - start
+        if alive is not None and not alive():
+            raise ChildProcessError(f"voicevox engine({url}) exited before ready")
+        if elapsed >= timeout:
+            raise EngineNotReadyError(f"voicevox engine({url}) is not ready after {timeout}s")
+        time.sleep(min(backoff.delay(attempt), timeout - elapsed))
+        attempt += 1
+    elapsed = time.perf_counter() - start
+    metrics.add_startup(url, elapsed)
+    logger.debug(f"[VOICEVOX] {url} ready in {elapsed:.2f}s ({attempt + 1} probes)")
+    return elapsed
+
+
+class CircuitBreaker:
+    """
+    failure_threshold回連続で失敗したら開き,reset_timeout秒はリクエストを止める
+    その後1つだけ試しのリクエストを通し(half open),成功すれば閉じる.失敗すれば再び開く
+    :param name: ログ,metrics用(engineのURL)
+    :param failure_threshold:
+    :param reset_timeout:
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 5.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def retry_after(self) -> float:
+        """
+        試しのリクエストを送れるようになるまでの秒数.閉じていれば0
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def available(self) -> bool:
+        """
+        allow()がTrueを返すか.状態は変えない
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            return not self._trial and time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"[VOICEVOX] {self.name} recovered")
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._opened_at is None and self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    logger.warning(f"[VOICEVOX] {self.name} failed {self._failures} times. stop requests for a while")
+                    metrics.add_breaker_open(self.name)
+                self._opened_at = time.monotonic()
+                self._trial = False
@@ -0,0 +1,151 @@
+"""
+複数のVOICEVOX engineに音声合成を振り分ける
+VoiceVoxClientと同じメソッドを持つため，text_to_speech_orderにそのまま渡せる
+"""
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Set, TypeVar
+
+import requests
+from loguru import logger
+
+from zunda_w.voicevox.client import ClientStats, RequestRejected, VoiceVoxClient
+from zunda_w.voicevox import health
+from zunda_w.voicevox.health import Backoff, EngineUnavailableError
+
+T = TypeVar("T")
+
+
+class EnginePool:
+    """
+    リクエストごとに処理待ちの少ないengineを選ぶ.失敗したリクエストは別のengineでやり直す
+    失敗が続いたengine(circuit breakerが開いている)には一定時間リクエストを送らない
+    :param urls: engineのURL
+    :param max_in_flight: engineごとの同時リクエスト数
+    :param batch_size: /multi_synthesisで一度に合成する行数.1の場合は/synthesisのみ使う
+    :param max_retry: 1つのリクエストを試す回数(全engineの合計)
+    :param retry_interval: 全てのengineで失敗した場合の最初の待ち時間(秒).以降は指数的に伸ばす
+    :param max_retry_interval: 待ち時間の上限(秒)
+    """
+
+    def __init__(
+            self,
+            urls: Sequence[str],
+            max_in_flight: int = 4,
+            batch_size: int = 8,
+            max_retry: int = 20,
+            retry_interval: float = 0.1,
+            max_retry_interval: float = 2.0,
+    ):
+        if len(urls) == 0:
+            raise ValueError("EnginePool needs at least one engine url")
+        self.stats = ClientStats()
+        # リトライはPool側で別のengineに振り直すため，clientは1回だけ試す
+        self.clients = [
+            VoiceVoxClient(url, max_in_flight, batch_size, max_retry=1, stats=self.stats)
+            for url in urls
+        ]
+        self.max_in_flight = sum(c.max_in_flight for c in self.clients)
+        self.batch_size = max(1, batch_size)
+        self.max_retry = max_retry
+        self.backoff = Backoff(initial=retry_interval, maximum=max_retry_interval)
+        self._lock = threading.Lock()
+        # engineごとの処理待ち+処理中のリクエスト数
+        self._depth = [0 for _ in self.clients]
+        self.n_requests = [0 for _ in self.clients]
+        self.n_failures = [0 for _ in self.clients]
+        # breakerが開いていて送らなかったリクエスト数
+        self.n_skipped = [0 for _ in self.clients]
+
+    @property
+    def urls(self) -> List[str]:
+        return [c.base_url for c in self.clients]
+
+    @property
+    def supports_multi_synthesis(self) -> bool:
+        return all(c.supports_multi_synthesis for c in self.clients)
+
+    def _acquire(self, exclude: Set[int]) -> Optional[int]:
+        """
+        処理待ちの少ないengineを選ぶ.使えるengineが無い場合はNone
+        """
+        with self._lock:
+            candidates = [
+                i for i in range(len(self.clients)) if i not in exclude and self.clients[i].breaker.available()
+            ]
+            if not candidates:
+                return None
+            i = min(candidates, key=lambda i: (self._depth[i] / self.clients[i].max_in_flight, self.n_requests[i]))
+            self._depth[i] += 1
+            return i
+
+    def _wait(self, n_round: int):
+        retry_after = min(c.breaker.retry_after() for c in self.clients)
+        time.sleep(max(self.backoff.delay(n_round), retry_after))
+
+    def _call(
+            self, path: str, description: str, func: Callable[[VoiceVoxClient], T], max_retry: Optional[int] = None
+    ) -> T:
+        failed: Set[int] = set()
+        error: Optional[Exception] = None
+        n_round = 0
+        for attempt in range(max_retry or self.max_retry):
+            if attempt > 0:
+                self.stats.add_retry(path)
+            i = self._acquire(failed)
+            if i is None:
+                # 全てのengineで失敗したか,全て止まっている
+                failed.clear()
+                self._wait(n_round)
+                n_round += 1
+                continue
+            try:
+                result = func(self.clients[i])
+                with self._lock:
+                    self.n_requests[i] += 1
+                return result
+            except RequestRejected:
+                # リクエストの内容が原因なので他のengineでも失敗する
+                raise
+            except (requests.RequestException, ConnectionError) as e:
+                error = e
+                failed.add(i)
+                with self._lock:
+                    if isinstance(e, EngineUnavailableError):
+                        self.n_skipped[i] += 1
+                    else:
+                        self.n_failures[i] += 1
+                logger.debug(f"[VOICEVOX] {self.clients[i].base_url} failed: {description} ({e})")
+            finally:
+                with self._lock:
+                    self._depth[i] -= 1
+        raise ConnectionError(f"リトライ回数が上限に到達しました。 {path} : {description}", str(error))
+
+    def audio_query(self, text: str, speaker: int, max_retry: Optional[int] = None) -> Dict:
+        return self._call("/audio_query", text[:30], lambda c: c.audio_query(text, speaker), max_retry)
+
+    def synthesis(self, query_data: Dict, speaker: int, max_retry: Optional[int] = None) -> bytes:
+        return self._call("/synthesis", str(speaker), lambda c: c.synthesis(query_data, speaker), max_retry)
+
+    def multi_synthesis(self, queries: Sequence[Dict], speaker: int) -> List[bytes]:
+        return self._call("/multi_synthesis", str(speaker), lambda c: c.multi_synthesis(queries, speaker))
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{c.base_url}:{n}(failed {f}{', open' if c.breaker.is_open else ''})"
+            for c, n, f in zip(self.clients, self.n_requests, self.n_failures)
+        )
+
+    def close(self):
+        if len(self.clients) > 1:
+            logger.info(f"[VOICEVOX] engines {self.summary()}")
+        if health_summary := health.metrics.summary():
+            logger.info(f"[VOICEVOX] health {health_summary}")
+        for c in self.clients:
+            c.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
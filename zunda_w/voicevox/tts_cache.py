@@ -0,0 +1,174 @@
+"""
+音声合成結果のキャッシュ
+(文章,style id,VoiceVoxProfile,ユーザー辞書のバージョン)から合成済みのwavファイルを引く
+engineへ問い合わせずにキャッシュの有無を判定できる
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+from loguru import logger
+
+from zunda_w.util import file_hash
+
+CACHE_DB = "tts_cache.sqlite"
+
+
+def user_dict_version(csv_file: Optional[str]) -> str:
+    """
+    ユーザー辞書の内容のハッシュ.辞書が無い場合は空文字
+    """
+    if not csv_file or not os.path.exists(csv_file):
+        return ""
+    return file_hash(csv_file)
+
+
+def cache_key(text: str, speaker: int, profile: Optional[Dict], dict_version: str = "") -> str:
+    data = json.dumps(
+        {"text": text, "speaker": int(speaker), "profile": profile or {}, "dict": dict_version},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    n_entries: int
+    total_bytes: int
+    total_hits: int
+    session_hits: int
+    session_misses: int
+    oldest_access: Optional[float]
+    newest_access: Optional[float]
+
+    def __str__(self) -> str:
+        def _time(t: Optional[float]) -> str:
+            return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) if t else "-"
+
+        return "\n".join(
+            [
+                f"entries      : {self.n_entries}",
+                f"size         : {self.total_bytes / 1024 / 1024:.1f} MB",
+                f"total hits   : {self.total_hits}",
+                f"session      : hit {self.session_hits} / miss {self.session_misses}",
+                f"last access  : {_time(self.oldest_access)} ~ {_time(self.newest_access)}",
+            ]
+        )
+
+
+class TtsCache:
+    """
+    sqliteに キー -> wavファイルパス を保持する
+    :param db_path:
+    :param max_bytes: wavファイルの合計サイズの上限.Noneの場合は無制限
+    """
+
+    def __init__(self, db_path: str, max_bytes: Optional[int] = None):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT path, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            path, size = row
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                # ファイルが消えているか書き換わっている
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._db.commit()
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+            self.hits += 1
+            return path
+
+    def contains(self, key: str) -> bool:
+        """
+        統計やアクセス時刻を更新せずに確認する
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path, size FROM entries WHERE key = ?", (key,)).fetchone()
+        return row is not None and os.path.exists(row[0]) and os.path.getsize(row[0]) == row[1]
+
+    def put(self, key: str, path: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, path, size, created, last_access, hits) VALUES (?, ?, ?, ?, ?, "
+                "COALESCE((SELECT hits FROM entries WHERE key = ?), 0))",
+                (key, os.path.abspath(path), os.path.getsize(path), now, now, key),
+            )
+            self._db.commit()
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """
+        最後に参照された時刻が古いものから削除し，合計サイズをmax_bytes以下にする
+        :return: 削除したエントリ数
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return 0
+        total = self.total_bytes()
+        n_removed = 0
+        with self._lock:
+            rows = self._db.execute("SELECT key, path, size FROM entries ORDER BY last_access").fetchall()
+            for key, path, size in rows:
+                if total <= max_bytes:
+                    break
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                # 同じファイルを参照している別のキーが無ければ削除
+                shared = self._db.execute("SELECT 1 FROM entries WHERE path = ? LIMIT 1", (path,)).fetchone()
+                if shared is None and os.path.exists(path):
+                    os.unlink(path)
+                total -= size
+                n_removed += 1
+            self._db.commit()
+        if n_removed:
+            logger.debug(f"[TTS Cache] evict {n_removed} entries")
+        return n_removed
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            n, size, hits, oldest, newest = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0), MIN(last_access), MAX(last_access) "
+                "FROM entries"
+            ).fetchone()
+        return CacheStats(n, size, hits, self.hits, self.misses, oldest, newest)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
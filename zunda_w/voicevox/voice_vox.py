@@ -4,6 +4,7 @@ import json
 import os
 import subprocess
 import time
+from collections import defaultdict
 from concurrent.futures import as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
 from contextlib import contextmanager
@@ -30,14 +31,20 @@ from dataclasses_json import dataclass_json
 from loguru import logger
 from pydub import AudioSegment
 
-from zunda_w.cache import cached_file
+from zunda_w.audio import memory_audio, parse_wav
 from zunda_w.hash import concat_hash, dict_hash
+from zunda_w.pipeline import BackgroundWriter
 from zunda_w.sentence.sentiment import EMO_TAG
+from zunda_w.voicevox import health
+from zunda_w.voicevox.client import DEFAULT_URL, VoiceVoxClient, default_client
+from zunda_w.voicevox.health import Backoff
+from zunda_w.voicevox.tts_cache import TtsCache, cache_key
 from zunda_w.voicevox.voicevox_user_dict import parse_user_dict_from_csv
 from zunda_w.postprocess.srt import tag, tag_pattern
+from zunda_w.util import write_bytes_atomic
 
 # TODO ポート番号の仕様チェック
-ROOT_URL = "http://localhost:50021"
+ROOT_URL = DEFAULT_URL
 
 
 class VoiceVoxProfile(TypedDict, total=False):
@@ -55,6 +62,14 @@ class VoiceVoxProfile(TypedDict, total=False):
 VoiceVoxProfiles = List[VoiceVoxProfile]
 
 
+def output_sampling_rate(profiles: VoiceVoxProfiles) -> Optional[int]:
+    """
+    全てのprofileで同じoutputSamplingRateが指定されていればその値.それ以外はNone
+    """
+    rates = {int(p["outputSamplingRate"]) if p.get("outputSamplingRate") else None for p in profiles}
+    return rates.pop() if len(rates) == 1 else None
+
+
 def replace_query(src_query: Dict, trt_query: Dict) -> Dict:
     ret_query = src_query.copy()
     for k, v in trt_query.items():
@@ -70,38 +85,46 @@ def launch_voicevox_engine(exe_path: str) -> subprocess.Popen:
 
 @contextmanager
 def voicevox_engine(exe_path: str):
-    voicevox_process = None
+    voicevox_process = launch_voicevox_engine(exe_path)
     try:
-        voicevox_process = launch_voicevox_engine(exe_path)
         logger.debug("wait voicevox")
-        wait_until_voicevox_ready()
+        health.wait_until_ready(ROOT_URL, alive=lambda: voicevox_process.poll() is None)
         yield voicevox_process
-    except Exception as e:
-        logger.exception(e)
     finally:
-        if voicevox_process:
-            voicevox_process.terminate()
-            voicevox_process.poll()
+        voicevox_process.terminate()
+        voicevox_process.poll()
 
 
-def _request_and_write(filename: str, synth_payload, query_data) -> Optional[str]:
-    r = requests.post(
-        f"{ROOT_URL}/synthesis",
-        params=synth_payload,
-        data=json.dumps(query_data),
-        timeout=(10.0, 300.0),
-    )
-    if r.status_code == 200:
-        # 別スレッドで既に保存されている可能性も考慮.
-        if os.path.exists(filename):
-            return filename
-
-        with open(filename, "wb") as fp:
-            fp.write(r.content)
-            fp.flush()
-            os.fsync(fp.fileno())
+def _write_wav(filename: str, content: bytes) -> str:
+    # 別スレッドで既に保存されている可能性も考慮.
+    if os.path.exists(filename):
         return filename
-    return None
+    return write_bytes_atomic(filename, content)
+
+
+def _resolve_speaker(text: str, speaker: int, query: VoiceVoxProfile) -> Optional[Tuple[str, int]]:
+    """
+    タグを解釈して読み上げる文章とstyle idを返す
+    音声を作らない行(SPAN_TAG)の場合はNone
+    """
+    tags = tag.extract_tag_key(text)
+    # check text is tag
+    if tag.contain_tag_in_tag_list(tags, tag_pattern.SPAN_TAG):
+        return None
+
+    if tag_pattern.has_tag(tags, EMO_TAG):
+        emo_tag = tag_pattern.get_tag(tags, EMO_TAG)
+        # 感情タグをvoicevoxのstyleに割り当て
+        speaker = query["emotionStyleMap"][str(speaker)].get(emo_tag)
+    return tag.extract_text(text), speaker
+
+
+def _output_file(query_data: Dict, output_name: Optional[str], output_dir: str) -> str:
+    if output_name:
+        return os.path.join(output_dir, f"{output_name}.wav")
+    # リクエストパラメータからキャッシュ値を計算
+    cache_hash: str = str(concat_hash([dict_hash(query_data)]))
+    return os.path.join(output_dir, f"{cache_hash}.wav")
 
 
 def synthesis(
@@ -112,6 +135,7 @@ def synthesis(
         max_retry=20,
         query: VoiceVoxProfile = None,
         use_cache=True,
+        client: Optional[VoiceVoxClient] = None,
 ):
     """
     テキストから音声を作成する
@@ -123,75 +147,86 @@ def synthesis(
     :param max_retry:
     :param query:
     :param use_cache: False,強制的に上書きする
+    :param client: Noneの場合はdefault_client()
     :return:
     """
-    tags = tag.extract_tag_key(text)
-    # check text is tag
-    if tag.contain_tag_in_tag_list(tags, tag_pattern.SPAN_TAG):
+    client = client or default_client()
+    resolved = _resolve_speaker(text, speaker, query)
+    if resolved is None:
         empty_audio_file = 'empty'
         return empty_audio_file
-
-    if tag_pattern.has_tag(tags, EMO_TAG):
-        emo_tag = tag_pattern.get_tag(tags, EMO_TAG)
-        # 感情タグをvoicevoxのstyleに割り当て
-        speaker = query["emotionStyleMap"][str(speaker)].get(emo_tag)
-    voice_line = tag.extract_text(text)
+    voice_line, speaker = resolved
     # audio_query
-    query_payload = {"text": voice_line, "speaker": speaker}
-    for query_i in range(max_retry):
-        r = requests.post(
-            f"{ROOT_URL}/audio_query", params=query_payload, timeout=(10.0, 300.0)
-        )
-        if r.status_code == 200:
-            query_data = r.json()
-            break
-        time.sleep(1)
-    else:
-        raise ConnectionError(
-            "リトライ回数が上限に到達しました。 audio_query : ", output_dir, "/", text[:30], r.text
-        )
-
-    # synthesis
-    synth_payload = {"speaker": speaker}
-    query_data = replace_query(query_data, query)
-    # リクエストパラメータからキャッシュ値を計算
-    cache_hash: str = str(concat_hash([dict_hash(query_data)]))
-    if output_name:
-        output_file = os.path.join(output_dir, f"{output_name}.wav")
-    else:
-        output_file = os.path.join(output_dir, f"{cache_hash}.wav")
+    query_data = replace_query(client.audio_query(voice_line, speaker, max_retry=max_retry), query)
+    output_file = _output_file(query_data, output_name, output_dir)
+    if use_cache and os.path.exists(output_file):
+        logger.debug(f'{text[:15].ljust(15)} ->[cache] {output_file} ')
+        return output_file
     if not use_cache and os.path.exists(output_file):
         os.unlink(output_file)
-    for synth_i in range(max_retry):
+    # synthesis
+    _write_wav(output_file, client.synthesis(query_data, speaker, max_retry=max_retry))
+    logger.debug(f'{text[:15].ljust(15)} -> {output_file} ')
+    return output_file
+
+
+@dataclass
+class _SynthesisJob:
+    index: int
+    text: str
+    voice_line: str
+    speaker: int
+    output_name: Optional[str]
+    query_data: Optional[Dict] = None
+    output_file: Optional[str] = None
+    cached: bool = False
+    cache_key: Optional[str] = None
+
+
+def _query_job(
+        client: VoiceVoxClient, job: _SynthesisJob, query: VoiceVoxProfile, output_dir: str, use_cache: bool
+) -> _SynthesisJob:
+    job.query_data = replace_query(client.audio_query(job.voice_line, job.speaker), query)
+    job.output_file = _output_file(job.query_data, job.output_name, output_dir)
+    if os.path.exists(job.output_file):
         if use_cache:
-            cached, output_file_name = cached_file(
-                output_file,
-                lambda: _request_and_write(output_file, synth_payload, query_data),
-            )
+            job.cached = True
         else:
-            cached, output_file_name = False, _request_and_write(
-                output_file, synth_payload, query_data
-            )
-        if output_file_name is not None:
-            logger.debug(
-                f'{text[:15].ljust(15)} ->{"[cache] " if cached else ""} {output_file_name} '
-            )
-            return output_file_name
+            os.unlink(job.output_file)
+    return job
+
+
+def _synthesis_jobs(
+        client: VoiceVoxClient,
+        jobs: Sequence[_SynthesisJob],
+        writer: BackgroundWriter,
+        keep_in_memory: bool,
+        tts_cache: Optional[TtsCache],
+) -> Sequence[_SynthesisJob]:
+    """
+    同じspeakerのjobをまとめて合成する.複数の場合は/multi_synthesisを使う
+    ファイルへの書き込みとtts_cacheへの登録はwriterのスレッドで行う
+    """
+    if len(jobs) == 1:
+        contents = [client.synthesis(jobs[0].query_data, jobs[0].speaker)]
     else:
-        raise ConnectionError(
-            "リトライ回数が上限に到達しました。 synthesis : ", output_dir, "/", text[:30], r, text
-        )
+        contents = client.multi_synthesis([j.query_data for j in jobs], jobs[0].speaker)
+    for job, content in zip(jobs, contents):
+        if keep_in_memory:
+            try:
+                memory_audio.put(job.output_file, parse_wav(content))
+            except ValueError as e:
+                logger.debug(f"keep {job.output_file} on disk only: {e}")
+        on_written = None
+        if tts_cache is not None and job.cache_key:
+            on_written = partial(_put_cache, tts_cache, job.cache_key)
+        writer.submit(job.output_file, content, on_written)
+        logger.debug(f'{job.text[:15].ljust(15)} -> {job.output_file} ')
+    return jobs
 
 
-def synthesis_map(data: Tuple[str, int, Optional[str]], output_dir: str, query: VoiceVoxProfile, use_cache: bool):
-    return synthesis(
-        data[0],
-        data[1],
-        data[2],
-        output_dir=output_dir,
-        query=query,
-        use_cache=use_cache,
-    )
+def _put_cache(tts_cache: TtsCache, key: str, path: str):
+    tts_cache.put(key, path)
 
 
 def output_path(idx: int, root: str) -> str:
@@ -223,21 +258,77 @@ def text_to_speech_order(
         query: VoiceVoxProfile,
         output_names: Optional[Sequence[str]] = None,
         use_cache: bool = False,
+        client: Optional[VoiceVoxClient] = None,
+        tts_cache: Optional[TtsCache] = None,
+        dict_version: str = "",
+        writer: Optional[BackgroundWriter] = None,
+        keep_in_memory: bool = False,
 ) -> Sequence[str]:
+    """
+    audio_queryとsynthesisをパイプライン化して音声合成する
+    audio_queryが返ってきた行から順にsynthesisへ回すため，N+1行目のqueryとN行目の合成が重なる
+    engineが/multi_synthesisに対応していれば同じspeakerの行をclient.batch_size行ずつまとめて合成する
+    tts_cacheにある行はaudio_queryも行わない
+    :param writer: 合成したwavを書き込むスレッド.Noneの場合はこの関数の中で作り，書き込みを待って返す
+    :param keep_in_memory: 合成したwavをaudio.memory_audioに保持し，後段でファイルを読み直さない
+    :return: contentsと同じ順番の音声ファイルパス.writerを渡した場合はwriter.close()まで書き込みが終わっていない
+    """
     if output_names is None:
         output_names = [None for _ in range(len(contents))]
     elif len(contents) != len(output_names):
         raise ValueError("output_names length not equal contents")
-    with ThreadPoolExecutor() as executor:
-        results = []
-        for result in executor.map(
-                partial(
-                    synthesis_map, output_dir=output_dir, query=query, use_cache=use_cache
-                ),
-                zip(contents, speaker, output_names),
-        ):
-            logger.debug(result)
-            results.append(result)
+    client = client or default_client()
+    results: List[Optional[str]] = [None for _ in range(len(contents))]
+    jobs = []
+    for i, (text, _speaker, name) in enumerate(zip(contents, speaker, output_names)):
+        resolved = _resolve_speaker(text, _speaker, query)
+        if resolved is None:
+            results[i] = 'empty'
+            continue
+        job = _SynthesisJob(i, text, resolved[0], resolved[1], name)
+        # 出力ファイル名が指定されている場合はキャッシュのファイルを返せない
+        if tts_cache is not None and name is None:
+            job.cache_key = cache_key(job.voice_line, job.speaker, query, dict_version)
+            if use_cache and (cached_file := tts_cache.get(job.cache_key)):
+                logger.debug(f'{text[:15].ljust(15)} ->[cache] {cached_file} ')
+                results[i] = cached_file
+                continue
+        jobs.append(job)
+
+    batch_size = client.batch_size if client.batch_size > 1 and client.supports_multi_synthesis else 1
+    start = time.perf_counter()
+    own_writer = writer is None
+    writer = writer or BackgroundWriter()
+    synthesis = partial(_synthesis_jobs, writer=writer, keep_in_memory=keep_in_memory, tts_cache=tts_cache)
+    with ThreadPoolExecutor(client.max_in_flight) as query_pool, ThreadPoolExecutor(
+            client.max_in_flight) as synthesis_pool:
+        query_futures = [
+            query_pool.submit(_query_job, client, job, query, output_dir, use_cache) for job in jobs
+        ]
+        synthesis_futures = []
+        batches: Dict[int, List[_SynthesisJob]] = defaultdict(list)
+        for future in as_completed(query_futures):
+            job = future.result()
+            if job.cached:
+                logger.debug(f'{job.text[:15].ljust(15)} ->[cache] {job.output_file} ')
+                results[job.index] = job.output_file
+                if tts_cache is not None and job.cache_key:
+                    tts_cache.put(job.cache_key, job.output_file)
+                continue
+            batches[job.speaker].append(job)
+            if len(batches[job.speaker]) >= batch_size:
+                synthesis_futures.append(synthesis_pool.submit(synthesis, client, batches.pop(job.speaker)))
+        for batch in batches.values():
+            synthesis_futures.append(synthesis_pool.submit(synthesis, client, batch))
+        for future in as_completed(synthesis_futures):
+            for job in future.result():
+                results[job.index] = job.output_file
+    if own_writer:
+        writer.close()
+    client.stats.add_lines(len(jobs))
+    logger.info(f"[VOICEVOX] {client.stats.summary(time.perf_counter() - start)}")
+    for result in results:
+        logger.debug(result)
     return results
 
 
@@ -266,6 +357,35 @@ def text_to_speech(
     return output_dir
 
 
+def _srt_lines(
+        srt_file: Union[str, Sequence[srt.Subtitle]], speaker: Union[None, int, Sequence[int]] = None
+) -> Tuple[List[str], List[int]]:
+    """
+    srtから読み上げる文章と話者のリストを作成
+    """
+    if type(srt_file) == str:
+        subtitles = list(srt.parse(Path(srt_file).read_text(encoding="utf-8")))
+    else:
+        subtitles = srt_file
+    if speaker is None:
+        logger.debug("Speaker ID from srt file")
+        speaker = list(map(lambda s: s.proprietary, subtitles))
+    elif isinstance(speaker, Sequence):
+        assert len(speaker) == len(
+            srt_file
+        ), "speakersがリストの場合,srt_fileとspeakersの個数は一致しなければいけません"
+    else:
+        speaker = list(repeat(speaker, len(subtitles)))
+
+    subtitles = list(map(lambda x: x.content, subtitles))
+
+    # 読み上げように，無駄な空白をなくす
+    def non_empty(x: str) -> str:
+        return "".join(filter(lambda c: c != " ", x))
+
+    return list(map(non_empty, subtitles)), list(speaker)
+
+
 def run(
         srt_file: Union[str, Sequence[srt.Subtitle]],
         root_dir: str,
@@ -274,6 +394,11 @@ def run(
         output_dir: str = ".tts",
         output_names: Optional[Sequence[str]] = None,
         use_cache: bool = True,
+        client: Optional[VoiceVoxClient] = None,
+        tts_cache: Optional[TtsCache] = None,
+        dict_version: str = "",
+        writer: Optional[BackgroundWriter] = None,
+        keep_in_memory: bool = False,
 ):
     """
     srt(text) to speech を実行.
@@ -284,6 +409,11 @@ def run(
     :param query:
     :param output_dir:
     :param use_cache: Falseの場合キャッシュをつかわない
+    :param client: engineへのリクエストに使うクライアント
+    :param tts_cache: 文章からwavを引くキャッシュ.ヒットした行はengineへ問い合わせない
+    :param dict_version: ユーザー辞書のバージョン(tts_cacheのキーに含める)
+    :param writer: text_to_speech_order参照
+    :param keep_in_memory: text_to_speech_order参照
     :return:
     """
     output_dir = Path(root_dir).joinpath(output_dir)
@@ -292,38 +422,48 @@ def run(
     if query is None:
         query = VoiceVoxProfile()
 
-    if type(srt_file) == str:
-        subtitles = list(srt.parse(Path(srt_file).read_text(encoding="utf-8")))
-    else:
-        subtitles = srt_file
-    if speaker is None:
-        logger.debug("Speaker ID from srt file")
-        speaker = list(map(lambda s: s.proprietary, subtitles))
-    elif isinstance(speaker, Sequence):
-        assert len(speaker) == len(
-            srt_file
-        ), "speakersがリストの場合,srt_fileとspeakersの個数は一致しなければいけません"
-    else:
-        speaker = list(repeat(speaker, len(subtitles)))
-
-    subtitles = list(map(lambda x: x.content, subtitles))
-
-    # 読み上げように，無駄な空白をなくす
-    def non_empty(x: str) -> str:
-        return "".join(filter(lambda c: c != " ", x))
-
-    subtitles = list(map(non_empty, subtitles))
-
+    contents, speaker = _srt_lines(srt_file, speaker)
     return text_to_speech_order(
-        subtitles,
+        contents,
         speaker,
         str(output_dir),
         query,
         output_names=output_names,
         use_cache=use_cache,
+        client=client,
+        tts_cache=tts_cache,
+        dict_version=dict_version,
+        writer=writer,
+        keep_in_memory=keep_in_memory,
     )
 
 
+def lookup_cache(
+        srt_file: Union[str, Sequence[srt.Subtitle]],
+        tts_cache: TtsCache,
+        speaker: Union[None, int, Sequence[int]] = None,
+        query: VoiceVoxProfile = None,
+        dict_version: str = "",
+) -> Optional[List[str]]:
+    """
+    全ての行がtts_cacheにあればrunと同じ結果を返す.1行でも無ければNone
+    engineを起動せずに判定できる
+    """
+    if query is None:
+        query = VoiceVoxProfile()
+    contents, speaker = _srt_lines(srt_file, speaker)
+    keys = []
+    for text, _speaker in zip(contents, speaker):
+        resolved = _resolve_speaker(text, _speaker, query)
+        keys.append(None if resolved is None else cache_key(resolved[0], resolved[1], query, dict_version))
+    if not all(key is None or tts_cache.contains(key) for key in keys):
+        return None
+    results = ['empty' if key is None else tts_cache.get(key) for key in keys]
+    if any(r is None for r in results):
+        return None
+    return results
+
+
 @dataclass_json
 @dataclass
 class Style:
@@ -417,36 +557,31 @@ def get_version():
     return requests.get(f"{ROOT_URL}/version")
 
 
-def is_voicevox_launch(n_try: int = 5) -> bool:
+def is_voicevox_launch(n_try: int = 5, url: str = ROOT_URL) -> bool:
     """
     voicevoxが立ち上がっているか確認
-    :param n_try:
+    :param n_try: 応答が無い場合に待ち時間を伸ばしながら確認する回数
+    :param url:
     :return:
     """
-    version = get_version()
+    backoff = Backoff(initial=0.1, maximum=1.0)
     for i in range(n_try):
-        if version.status_code == 200:
+        if health.probe(url):
             return True
+        if i < n_try - 1:
+            time.sleep(backoff.delay(i))
     return False
 
 
-def wait_until_voicevox_ready(timeout: float = 30):
+def wait_until_voicevox_ready(timeout: float = 30, url: str = ROOT_URL) -> float:
     """
     /version で導通確認を行う
     :param timeout:
-    :return:
+    :param url:
+    :return: 起動までの秒数
+    :raise EngineNotReadyError: timeout秒以内に応答しない
     """
-    start = time.perf_counter()
-    while (time.perf_counter() - start) < timeout:
-        try:
-            logger.debug("waiting...")
-            version = get_version()
-            if version.status_code == 200:
-                # 接続確認できたので終了
-                break
-        except Exception as e:
-            logger.debug(f"waiting voicevox start...:{str(e)}")
-            time.sleep(0.1)
+    return health.wait_until_ready(url, timeout)
 
 
 def add_word(word: str, pronunce: str, accent_type: int = 1):
@@ -463,16 +598,24 @@ def add_word(word: str, pronunce: str, accent_type: int = 1):
         query_data = r.json()
 
 
-def import_word_csv(csv_file: str, override: bool = True):
+def import_word_csv(csv_file: str, override: bool = True, base_urls: Sequence[str] = (ROOT_URL,)):
+    """
+    ユーザー辞書をengineに登録する
+    :param csv_file:
+    :param override:
+    :param base_urls: 複数のengineを使う場合は全てのengineに同じ辞書を登録する
+    :return:
+    """
     logger.debug("Import User Dict to Voicevox")
     if not os.path.exists(csv_file):
         logger.warning(f"Not Found: user word dict : {csv_file}")
         return
     word_map = parse_user_dict_from_csv(csv_file)
-    r = requests.post(
-        f"{ROOT_URL}/import_user_dict", params={"override": override}, json=word_map
-    )
-    if r.status_code == 204:
-        logger.success("Import Success")
-    else:
-        logger.warning(f"Something Wrong:{r.content}")
+    for base_url in base_urls:
+        r = requests.post(
+            f"{base_url}/import_user_dict", params={"override": override}, json=word_map
+        )
+        if r.status_code == 204:
+            logger.success(f"Import Success {base_url}")
+        else:
+            logger.warning(f"Something Wrong {base_url}:{r.content}")